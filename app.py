@@ -7,7 +7,9 @@ Servidor Flask para deployment em Cloud Run com webhook do Telegram
 import os
 import sys
 import json
+import hmac
 import logging
+import threading
 from flask import Flask, request, jsonify
 import asyncio
 from datetime import datetime
@@ -26,6 +28,47 @@ app = Flask(__name__)
 telegram_app = None
 bot_initialized = False
 
+# Loop asyncio único (thread dedicada) e fila de updates por chat
+_bot_loop = None
+_bot_loop_lock = threading.Lock()
+update_dispatcher = None
+db_manager = None
+
+def obter_loop_bot():
+    """Retorna o event loop persistente do bot, criando a thread na primeira chamada"""
+    global _bot_loop
+    with _bot_loop_lock:
+        if _bot_loop is None:
+            _bot_loop = asyncio.new_event_loop()
+            threading.Thread(target=_bot_loop.run_forever, name='bot-loop', daemon=True).start()
+        return _bot_loop
+
+def executar_no_loop(coro, timeout=None):
+    """Executa corrotina no loop do bot e aguarda o resultado"""
+    return asyncio.run_coroutine_threadsafe(coro, obter_loop_bot()).result(timeout)
+
+def obter_db():
+    """DatabaseManager compartilhado (o schema é conferido uma vez por processo)"""
+    global db_manager
+    if db_manager is None:
+        from database import DatabaseManager
+        db_manager = DatabaseManager()
+    return db_manager
+
+def processar_update(update_data):
+    """Handler do dispatcher: processa um update no loop persistente"""
+    from telegram import Update
+    update = Update.de_json(update_data, telegram_app.bot)
+    executar_no_loop(telegram_app.process_update(update))
+
+def obter_dispatcher():
+    """Dispatcher de updates (fila por chat_id, descarte de update_id repetido)"""
+    global update_dispatcher
+    if update_dispatcher is None:
+        from update_dispatcher import UpdateDispatcher
+        update_dispatcher = UpdateDispatcher(processar_update)
+    return update_dispatcher
+
 def check_required_secrets():
     """Verifica se os secrets obrigatórios estão configurados"""
     required = ['BOT_TOKEN', 'ADMIN_CHAT_ID']
@@ -86,6 +129,7 @@ async def initialize_bot():
         
         # Criar application do Telegram
         telegram_app = Application.builder().token(bot_token).build()
+        await telegram_app.initialize()
         
         # Importar handlers do bot
         try:
@@ -112,8 +156,7 @@ async def initialize_bot():
                 await setup_fallback_handlers(telegram_app)
         
         # Inicializar banco de dados
-        from database import DatabaseManager
-        db = DatabaseManager()
+        obter_db()
         logger.info("Banco de dados inicializado")
         
         bot_initialized = True
@@ -162,11 +205,20 @@ def webhook():
         logger.error("Bot não inicializado")
         return jsonify({'error': 'Bot not initialized'}), 500
     
+    # Secret configurado no setWebhook (header X-Telegram-Bot-Api-Secret-Token)
+    segredo = os.getenv('TELEGRAM_WEBHOOK_SECRET')
+    if segredo and not hmac.compare_digest(
+            request.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), segredo):
+        logger.warning("Webhook com secret token inválido rejeitado")
+        return jsonify({'error': 'Unauthorized'}), 403
+    
     try:
+        from update_dispatcher import update_valido
+        
         # Obter dados do request
-        update_data = request.get_json()
+        update_data = request.get_json(silent=True)
         
-        if not update_data:
+        if not update_valido(update_data):
             return jsonify({'error': 'No data received'}), 400
         
         # Se telegram_app não está disponível (modo degradado), apenas log
@@ -175,20 +227,13 @@ def webhook():
             logger.info(f"Update data: {update_data}")
             return jsonify({'status': 'logged', 'mode': 'degraded'}), 200
         
-        # Processar update do Telegram
-        try:
-            from telegram import Update
-            update = Update.de_json(update_data, telegram_app.bot)
-            
-            # Processar update de forma assíncrona
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            loop.run_until_complete(telegram_app.process_update(update))
-            
-            return jsonify({'status': 'processed'}), 200
-        except ImportError:
-            logger.info("Webhook recebido em modo degradado - telegram module indisponível")
-            return jsonify({'status': 'logged', 'mode': 'degraded'}), 200
+        # Ack imediato: o update é processado pela fila por chat no loop persistente
+        # (update_id repetido é descartado; sem vaga, 503 faz o Telegram reenviar)
+        espera = float(os.getenv('WEBHOOK_ESPERA_FILA', '0.5'))
+        if not obter_dispatcher().submit(update_data, timeout=espera):
+            return jsonify({'error': 'Queue full'}), 503
+        
+        return jsonify({'status': 'queued'}), 200
         
     except Exception as e:
         logger.error(f"Erro ao processar webhook: {e}")
@@ -200,10 +245,10 @@ def status():
     try:
         # Verificar conexão com banco
         db_status = 'unknown'
+        schema_versao = None
         try:
-            from database import DatabaseManager
-            db = DatabaseManager()
-            # Teste simples de conexão
+            # Uma consulta: versão do schema também confirma a conexão
+            schema_versao = obter_db().versao_schema()
             db_status = 'connected'
         except Exception as e:
             db_status = f'error: {str(e)}'
@@ -211,6 +256,7 @@ def status():
         return jsonify({
             'bot_initialized': bot_initialized,
             'database': db_status,
+            'schema_version': schema_versao,
             'secrets_configured': check_required_secrets(),
             'timestamp': datetime.now(pytz.timezone('America/Sao_Paulo')).isoformat(),
             'environment': os.getenv('REPLIT_DEPLOYMENT_TYPE', 'development')
@@ -224,10 +270,8 @@ def initialize_app():
     """Inicialização da aplicação"""
     logger.info("Iniciando aplicação...")
     
-    # Inicializar bot de forma assíncrona
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(initialize_bot())
+    # Inicializar bot no loop persistente (o mesmo usado pelos updates)
+    executar_no_loop(initialize_bot())
 
 # Inicializar app na importação
 initialize_app()
@@ -245,9 +289,7 @@ if __name__ == '__main__':
         sys.exit(1)
     
     # Inicializar bot
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(initialize_bot())
+    executar_no_loop(initialize_bot())
     
     # Iniciar servidor Flask
     # Para produção, usar Gunicorn: gunicorn -w 1 -b 0.0.0.0:5000 wsgi:app
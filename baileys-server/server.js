@@ -107,6 +107,9 @@ const connectToWhatsApp = async (sessionId) => {
           return;
         }
 
+        // Sessão liberada para outro servidor: não reconectar aqui
+        if (session.released) return;
+
         // Tentar reconectar reaproveitando as credenciais locais
         setTimeout(() => connectToWhatsApp(sessionId), 5_000);
       }
@@ -253,6 +256,49 @@ app.post('/send-message', async (req, res) => {
   }
 });
 
+// Verificar em lote se números possuem WhatsApp - OBRIGATÓRIO session_id
+app.post('/check-numbers', async (req, res) => {
+  try {
+    const { numbers, session_id } = req.body;
+
+    if (!session_id) {
+      return res.status(400).json({ success: false, error: 'session_id é obrigatório' });
+    }
+    if (!Array.isArray(numbers) || numbers.length === 0) {
+      return res.status(400).json({ success: false, error: 'Lista de números é obrigatória' });
+    }
+
+    const session = sessions.get(session_id);
+    if (!session || !session.isConnected) {
+      return res.status(400).json({
+        success: false,
+        error: `WhatsApp não conectado para sessão ${session_id}`,
+        session_id,
+      });
+    }
+
+    const results = {};
+    for (const number of numbers) {
+      try {
+        const [info] = await session.sock.onWhatsApp(number);
+        results[number] = Boolean(info && info.exists);
+      } catch (err) {
+        console.error(`⚠️ Falha ao verificar número ${number}:`, err.message);
+        results[number] = null;
+      }
+    }
+
+    res.json({ success: true, results, session_id });
+  } catch (error) {
+    console.error('❌ Erro ao verificar números:', error);
+    res.status(500).json({
+      success: false,
+      error: error.message,
+      session_id: req.body.session_id || null,
+    });
+  }
+});
+
 // Reconectar sessão específica (NÃO apaga credenciais locais)
 app.post('/reconnect/:sessionId', async (req, res) => {
   try {
@@ -287,6 +333,31 @@ app.post('/reconnect/:sessionId', async (req, res) => {
   }
 });
 
+// Liberar sessão específica (migração entre servidores - NÃO apaga credenciais locais)
+app.post('/release-session/:sessionId', async (req, res) => {
+  try {
+    const sessionId = req.params.sessionId;
+    if (!sessionId) {
+      return res.status(400).json({ success: false, error: 'sessionId é obrigatório' });
+    }
+
+    console.log(`📤 Liberando sessão ${sessionId}...`);
+
+    if (sessions.has(sessionId)) {
+      const session = sessions.get(sessionId);
+      session.released = true; // evita reconexão automática no evento 'close'
+      if (session.sock) session.sock.end();
+      if (session.backupInterval) clearInterval(session.backupInterval);
+      sessions.delete(sessionId);
+    }
+
+    res.json({ success: true, message: `Sessão ${sessionId} liberada`, session_id: sessionId });
+  } catch (error) {
+    console.error('❌ Erro ao liberar sessão:', error);
+    res.status(500).json({ success: false, error: error.message, session_id: req.params.sessionId });
+  }
+});
+
 // Limpar sessão específica (APAGA credenciais locais!)
 app.post('/clear-session/:sessionId', async (req, res) => {
   try {
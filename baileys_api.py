@@ -14,13 +14,23 @@ import base64
 from io import BytesIO
 import qrcode
 from utils import agora_br, formatar_datetime_br
+from baileys_shards import BaileysShardRouter
 
 logger = logging.getLogger(__name__)
 
 class BaileysAPI:
-    def __init__(self):
+    def __init__(self, db_manager=None):
         """Inicializa a integração com Baileys API"""
         self.base_url = os.getenv('BAILEYS_API_URL', 'http://baileys-local-persist.railway.internal:3000')
+        
+        # Vários servidores Baileys: BAILEYS_API_URLS=http://a:3000,http://b:3000
+        backends = os.getenv('BAILEYS_API_URLS', '').split(',')
+        if not any(b.strip() for b in backends):
+            backends = [self.base_url]
+        self.router = BaileysShardRouter(backends, db_manager)
+        self.base_url = self.router.backends[0]
+        self.router.iniciar_monitoramento()
+        
         self.api_key = os.getenv('BAILEYS_API_KEY', '')
         # Remover sessão padrão fixa - será definida por usuário
         self.default_session = os.getenv('BAILEYS_SESSION', 'bot_clientes')  # Apenas fallback
@@ -45,18 +55,28 @@ class BaileysAPI:
         self._status_cache = {}
         self._cache_timeout = 300  # 5 minutos
         
-        logger.info(f"Baileys API inicializada: {self.base_url}")
+        logger.info(f"Baileys API inicializada: {', '.join(self.router.backends)}")
     
     def get_user_session(self, chat_id_usuario: int) -> str:
         """Gera nome de sessão específico para o usuário"""
         return f"user_{chat_id_usuario}"
     
-    def _make_request(self, endpoint: str, method: str = 'GET', data: Dict = None, retries: int = None) -> Dict:
+    def _sessao_usuario(self, chat_id_usuario: int = None) -> str:
+        """Sessão do usuário quando informado, senão a sessão padrão"""
+        return self.get_user_session(chat_id_usuario) if chat_id_usuario else self.default_session
+    
+    def get_user_backend(self, chat_id_usuario: int = None) -> str:
+        """Retorna o servidor Baileys que hospeda a sessão do usuário"""
+        return self.router.backend_para(chat_id_usuario)
+    
+    def _make_request(self, endpoint: str, method: str = 'GET', data: Dict = None, retries: int = None,
+                      chat_id_usuario: int = None) -> Dict:
         """Faz requisição HTTP para a API Baileys"""
         if retries is None:
             retries = self.max_retries
         
-        url = f"{self.base_url.rstrip('/')}/{endpoint.lstrip('/')}"
+        base_url = self.get_user_backend(chat_id_usuario)
+        url = f"{base_url.rstrip('/')}/{endpoint.lstrip('/')}"
         
         for attempt in range(retries + 1):
             try:
@@ -141,7 +161,7 @@ class BaileysAPI:
                 return self._status_cache[cache_key]
             
             # Buscar status atual
-            response = self._make_request(f'status/{session_name}')
+            response = self._make_request(f'status/{session_name}', chat_id_usuario=chat_id_usuario)
             
             if response.get('success'):
                 status_data = response.get('data', {})
@@ -226,7 +246,8 @@ class BaileysAPI:
             session_name = self.get_user_session(chat_id_usuario)
             
             # Usar endpoint específico por usuário - sistema multi-sessão
-            response = requests.get(f"{self.base_url}/qr/{session_name}", timeout=30)
+            base_url = self.get_user_backend(chat_id_usuario)
+            response = requests.get(f"{base_url}/qr/{session_name}", timeout=30)
             
             if response.status_code == 200:
                 data = response.json()
@@ -274,7 +295,8 @@ class BaileysAPI:
                 data.update(options)
             
             # Enviar mensagem via endpoint multi-sessão
-            response = requests.post(f"{self.base_url}/send-message", 
+            base_url = self.get_user_backend(chat_id_usuario)
+            response = requests.post(f"{base_url}/send-message", 
                                    json=data, timeout=30)
             
             if response.status_code == 200:
@@ -322,7 +344,7 @@ class BaileysAPI:
             if caption:
                 data['caption'] = caption
             
-            response = self._make_request('send-image', 'POST', data)
+            response = self._make_request('send-image', 'POST', data, chat_id_usuario=chat_id_usuario)
             
             if response.get('success'):
                 if self.message_delay > 0:
@@ -334,8 +356,9 @@ class BaileysAPI:
             logger.error(f"Erro ao enviar imagem: {e}")
             return {'success': False, 'error': str(e)}
     
-    def send_document(self, phone: str, document_path: str, filename: str = None) -> Dict:
-        """Envia documento via WhatsApp"""
+    def send_document(self, phone: str, document_path: str, filename: str = None,
+                      chat_id_usuario: int = None) -> Dict:
+        """Envia documento via WhatsApp do usuário específico"""
         try:
             clean_phone = self._clean_phone_number(phone)
             if not clean_phone:
@@ -344,13 +367,13 @@ class BaileysAPI:
             data = {
                 'number': clean_phone,
                 'document': document_path,
-                'session': self.session_name
+                'session': self._sessao_usuario(chat_id_usuario)
             }
             
             if filename:
                 data['filename'] = filename
             
-            response = self._make_request('send-document', 'POST', data)
+            response = self._make_request('send-document', 'POST', data, chat_id_usuario=chat_id_usuario)
             
             if response.get('success'):
                 if self.message_delay > 0:
@@ -386,43 +409,76 @@ class BaileysAPI:
         
         return ""
     
-    def get_chat_info(self, phone: str) -> Dict:
+    def get_chat_info(self, phone: str, chat_id_usuario: int = None) -> Dict:
         """Obtém informações do chat"""
         try:
             clean_phone = self._clean_phone_number(phone)
             if not clean_phone:
                 return {'success': False, 'error': 'Número de telefone inválido'}
             
-            response = self._make_request(f'chat-info/{self.session_name}/{clean_phone}')
+            response = self._make_request(f'chat-info/{self._sessao_usuario(chat_id_usuario)}/{clean_phone}',
+                                          chat_id_usuario=chat_id_usuario)
             return response
             
         except Exception as e:
             logger.error(f"Erro ao obter info do chat: {e}")
             return {'success': False, 'error': str(e)}
     
-    def is_number_registered(self, phone: str) -> Dict:
+    def is_number_registered(self, phone: str, chat_id_usuario: int) -> Dict:
         """Verifica se número está registrado no WhatsApp"""
         try:
             clean_phone = self._clean_phone_number(phone)
             if not clean_phone:
                 return {'success': False, 'error': 'Número de telefone inválido'}
-            
+
+            response = self.check_numbers([phone], chat_id_usuario)
+            if not response.get('success'):
+                return response
+
+            registered = response['results'].get(clean_phone)
+            if registered is None:
+                return {'success': False, 'error': 'Não foi possível verificar o número'}
+
+            return {'success': True, 'number': clean_phone, 'registered': registered}
+
+        except Exception as e:
+            logger.error(f"Erro ao verificar número: {e}")
+            return {'success': False, 'error': str(e)}
+
+    def check_numbers(self, phones: List[str], chat_id_usuario: int) -> Dict:
+        """Verifica em lote quais números possuem WhatsApp usando a sessão do usuário"""
+        try:
+            numeros = []
+            for phone in phones:
+                clean_phone = self._clean_phone_number(phone)
+                if clean_phone and clean_phone not in numeros:
+                    numeros.append(clean_phone)
+
+            if not numeros:
+                return {'success': True, 'results': {}}
+
             data = {
-                'number': clean_phone,
-                'session': self.session_name
+                'numbers': numeros,
+                'session_id': self.get_user_session(chat_id_usuario)
             }
-            
-            response = self._make_request('check-number', 'POST', data)
-            return response
-            
+
+            response = self._make_request('check-numbers', 'POST', data, retries=1,
+                                          chat_id_usuario=chat_id_usuario)
+            if not response.get('success'):
+                return response
+
+            # Resultado por número limpo: True/False, ou None quando a verificação falhou
+            return {'success': True, 'results': response.get('results', {})}
+
         except Exception as e:
-            logger.error(f"Erro ao verificar número: {e}")
+            logger.error(f"Erro ao verificar números em lote: {e}")
             return {'success': False, 'error': str(e)}
     
-    def reconnect(self) -> Dict:
+    def reconnect(self, chat_id_usuario: int = None) -> Dict:
         """Reconecta a sessão WhatsApp"""
         try:
-            response = self._make_request(f'restart/{self.session_name}', 'POST')
+            response = self._make_request(f'restart/{self._sessao_usuario(chat_id_usuario)}', 'POST',
+                                          chat_id_usuario=chat_id_usuario)
             
             # Limpar cache de status
             self._status_cache = {}
@@ -433,10 +489,11 @@ class BaileysAPI:
             logger.error(f"Erro ao reconectar: {e}")
             return {'success': False, 'error': str(e)}
     
-    def logout(self) -> Dict:
+    def logout(self, chat_id_usuario: int = None) -> Dict:
         """Faz logout da sessão WhatsApp"""
         try:
-            response = self._make_request(f'logout/{self.session_name}', 'POST')
+            response = self._make_request(f'logout/{self._sessao_usuario(chat_id_usuario)}', 'POST',
+                                          chat_id_usuario=chat_id_usuario)
             
             # Limpar cache
             self._status_cache = {}
@@ -451,7 +508,7 @@ class BaileysAPI:
         """Obtém configurações atuais"""
         return {
             'base_url': self.base_url,
-            'session': self.session_name,
+            'session': self.default_session,
             'timeout': self.timeout,
             'max_retries': self.max_retries,
             'message_delay': self.message_delay,
@@ -480,7 +537,7 @@ class BaileysAPI:
             logger.error(f"Erro ao atualizar configurações: {e}")
             return False
     
-    def get_message_history(self, phone: str, limit: int = 50) -> Dict:
+    def get_message_history(self, phone: str, limit: int = 50, chat_id_usuario: int = None) -> Dict:
         """Obtém histórico de mensagens"""
         try:
             clean_phone = self._clean_phone_number(phone)
@@ -491,7 +548,8 @@ class BaileysAPI:
                 'limit': limit
             }
             
-            response = self._make_request(f'messages/{self.session_name}/{clean_phone}', 'GET', params)
+            response = self._make_request(f'messages/{self._sessao_usuario(chat_id_usuario)}/{clean_phone}', 'GET', params,
+                                          chat_id_usuario=chat_id_usuario)
             return response
             
         except Exception as e:
@@ -554,6 +612,13 @@ class BaileysAPI:
     def health_check(self) -> Dict:
         """Verifica se a API está funcionando"""
         try:
+            if len(self.router.backends) > 1:
+                saude = self.router.verificar_saude()
+                return {
+                    'success': any(b['saudavel'] for b in saude.values()),
+                    'backends': saude
+                }
+            
             response = self._make_request('health', 'GET')
             return response
             
@@ -562,10 +627,31 @@ class BaileysAPI:
             return {'success': False, 'error': str(e)}
     
     def get_sessions(self) -> Dict:
-        """Lista todas as sessões ativas"""
+        """Lista todas as sessões ativas em todos os servidores Baileys"""
         try:
-            response = self._make_request('sessions', 'GET')
-            return response
+            if len(self.router.backends) == 1:
+                return self._make_request('sessions', 'GET')
+            
+            sessions = []
+            erros = {}
+            for backend in self.router.backends_saudaveis():
+                # Um servidor fora do ar não derruba a listagem dos demais
+                try:
+                    response = requests.get(f"{backend}/sessions", headers=self.headers, timeout=self.timeout)
+                    if response.status_code != 200:
+                        erros[backend] = f"Erro HTTP {response.status_code}"
+                        continue
+                    for session in response.json().get('sessions', []):
+                        session['backend'] = backend
+                        sessions.append(session)
+                except Exception as e:
+                    logger.warning(f"Erro ao obter sessões de {backend}: {e}")
+                    erros[backend] = str(e)
+            
+            resultado = {'success': True, 'total_sessions': len(sessions), 'sessions': sessions}
+            if erros:
+                resultado['erros_backends'] = erros
+            return resultado
             
         except Exception as e:
             logger.error(f"Erro ao obter sessões: {e}")
@@ -0,0 +1,248 @@
+"""
+Distribuição de sessões WhatsApp entre vários servidores Baileys
+Hash consistente de chat_id_usuario para backend, atribuição persistida
+no PostgreSQL, migração/rebalanceamento e saúde por backend
+"""
+
+import os
+import time
+import bisect
+import hashlib
+import logging
+import threading
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class BaileysShardRouter:
+    def __init__(self, backends, db_manager=None):
+        """Inicializa o roteador com a lista de backends Baileys"""
+        self.backends = [b.rstrip('/') for b in backends if b and b.strip()]
+        if not self.backends:
+            raise ValueError("Nenhum backend Baileys configurado")
+
+        self.db = db_manager
+        self.vnodes = int(os.getenv('BAILEYS_SHARD_VNODES', '100'))
+        self.health_timeout = int(os.getenv('BAILEYS_HEALTH_TIMEOUT', '5'))
+        self.health_interval = int(os.getenv('BAILEYS_HEALTH_INTERVAL', '30'))
+
+        # chat_id_usuario -> backend (espelho da tabela de atribuições)
+        self._atribuicoes = {}
+        # backend -> {'saudavel', 'latencia_ms', 'sessoes', 'erro', 'verificado_em'}
+        self._saude = {b: {'saudavel': True, 'latencia_ms': None, 'sessoes': 0,
+                           'erro': None, 'verificado_em': None} for b in self.backends}
+        self._lock = threading.Lock()
+        self._monitorando = False
+
+        self._anel = []
+        self._montar_anel()
+
+    # ===================== Hash consistente =====================
+    @staticmethod
+    def _hash(chave):
+        return int(hashlib.md5(str(chave).encode('utf-8')).hexdigest()[:16], 16)
+
+    def _montar_anel(self):
+        """Monta o anel com nós virtuais para cada backend"""
+        anel = []
+        for backend in self.backends:
+            for i in range(self.vnodes):
+                anel.append((self._hash(f"{backend}#{i}"), backend))
+        anel.sort()
+        self._anel = anel
+
+    def _backend_no_anel(self, chat_id_usuario, apenas_saudaveis=True):
+        """Escolhe o backend pelo anel, pulando backends fora do ar"""
+        permitidos = set(self.backends_saudaveis()) if apenas_saudaveis else set(self.backends)
+        if not permitidos:
+            permitidos = set(self.backends)
+
+        chaves = [h for h, _ in self._anel]
+        inicio = bisect.bisect(chaves, self._hash(chat_id_usuario))
+        for deslocamento in range(len(self._anel)):
+            _, backend = self._anel[(inicio + deslocamento) % len(self._anel)]
+            if backend in permitidos:
+                return backend
+        return self.backends[0]
+
+    # ===================== Atribuição =====================
+    def backend_para(self, chat_id_usuario):
+        """Retorna o backend responsável pela sessão do usuário"""
+        if len(self.backends) == 1 or chat_id_usuario is None:
+            return self.backends[0]
+
+        backend = self._atribuicoes.get(chat_id_usuario)
+        if backend:
+            return backend
+
+        backend = self._ler_atribuicao(chat_id_usuario)
+        if not backend:
+            backend = self._atribuir(chat_id_usuario, self._backend_no_anel(chat_id_usuario))
+
+        with self._lock:
+            self._atribuicoes[chat_id_usuario] = backend
+        return backend
+
+    def _ler_atribuicao(self, chat_id_usuario):
+        """Lê atribuição persistida (sessão já pareada em um backend)"""
+        if not self.db:
+            return None
+        try:
+            with self.db.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(
+                        "SELECT backend_url FROM baileys_sessoes_backend WHERE chat_id_usuario = %s",
+                        (chat_id_usuario,)
+                    )
+                    row = cursor.fetchone()
+            # Backend removido da configuração: trata como sem atribuição
+            if row and row[0] in self.backends:
+                return row[0]
+        except Exception as e:
+            logger.error(f"Erro ao ler atribuição de sessão {chat_id_usuario}: {e}")
+        return None
+
+    def _atribuir(self, chat_id_usuario, backend, substituir=False):
+        """Persiste atribuição; em corrida entre processos prevalece a primeira gravada"""
+        if not self.db:
+            return backend
+        try:
+            with self.db.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    if substituir:
+                        cursor.execute("""
+                            INSERT INTO baileys_sessoes_backend (chat_id_usuario, backend_url)
+                            VALUES (%s, %s)
+                            ON CONFLICT (chat_id_usuario) DO UPDATE SET
+                                backend_url = EXCLUDED.backend_url,
+                                atribuido_em = CURRENT_TIMESTAMP
+                            RETURNING backend_url
+                        """, (chat_id_usuario, backend))
+                    else:
+                        cursor.execute("""
+                            INSERT INTO baileys_sessoes_backend (chat_id_usuario, backend_url)
+                            VALUES (%s, %s)
+                            ON CONFLICT (chat_id_usuario) DO UPDATE SET
+                                backend_url = baileys_sessoes_backend.backend_url
+                            RETURNING backend_url
+                        """, (chat_id_usuario, backend))
+                    backend = cursor.fetchone()[0]
+                    conn.commit()
+        except Exception as e:
+            logger.error(f"Erro ao salvar atribuição de sessão {chat_id_usuario}: {e}")
+        return backend
+
+    # ===================== Migração / Rebalanceamento =====================
+    def migrar_sessao(self, chat_id_usuario, destino):
+        """Move a sessão do usuário para outro backend.
+
+        As credenciais são lidas de AUTH_BASE_DIR pelo backend destino; sem volume
+        compartilhado entre backends o usuário precisará escanear o QR novamente.
+        """
+        destino = destino.rstrip('/')
+        if destino not in self.backends:
+            return {'success': False, 'error': f'Backend desconhecido: {destino}'}
+
+        origem = self.backend_para(chat_id_usuario)
+        if origem == destino:
+            return {'success': True, 'backend': destino, 'migrada': False}
+
+        session_id = f"user_{chat_id_usuario}"
+        try:
+            # Encerra o socket na origem sem apagar credenciais
+            requests.post(f"{origem}/release-session/{session_id}", timeout=self.health_timeout)
+        except Exception as e:
+            logger.warning(f"Origem {origem} não liberou sessão {session_id}: {e}")
+
+        self._atribuir(chat_id_usuario, destino, substituir=True)
+        with self._lock:
+            self._atribuicoes[chat_id_usuario] = destino
+
+        try:
+            requests.post(f"{destino}/reconnect/{session_id}", timeout=self.health_timeout)
+        except Exception as e:
+            logger.warning(f"Destino {destino} não iniciou sessão {session_id}: {e}")
+
+        logger.info(f"🔀 Sessão {session_id} migrada: {origem} -> {destino}")
+        return {'success': True, 'backend': destino, 'origem': origem, 'migrada': True}
+
+    def rebalancear(self, limite=None):
+        """Migra sessões cujo backend atual difere do indicado pelo anel (ex.: após adicionar backend)"""
+        if len(self.backends) == 1 or not self.db:
+            return 0
+        try:
+            with self.db.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT chat_id_usuario, backend_url FROM baileys_sessoes_backend")
+                    atribuicoes = cursor.fetchall()
+
+            migradas = 0
+            for chat_id_usuario, atual in atribuicoes:
+                if limite is not None and migradas >= limite:
+                    break
+                # Posição nominal no anel: uma queda momentânea não deve espalhar sessões;
+                # se o destino estiver fora do ar a migração fica para a próxima rodada
+                alvo = self._backend_no_anel(chat_id_usuario, apenas_saudaveis=False)
+                if alvo != atual and self._saude[alvo]['saudavel']:
+                    if self.migrar_sessao(chat_id_usuario, alvo).get('migrada'):
+                        migradas += 1
+
+            logger.info(f"⚖️ Rebalanceamento concluído: {migradas} sessão(ões) migrada(s)")
+            return migradas
+        except Exception as e:
+            logger.error(f"Erro no rebalanceamento de sessões: {e}")
+            return 0
+
+    # ===================== Saúde =====================
+    def backends_saudaveis(self):
+        return [b for b in self.backends if self._saude[b]['saudavel']]
+
+    def verificar_saude(self):
+        """Consulta /sessions em cada backend e atualiza latência/sessões/estado"""
+        for backend in self.backends:
+            inicio = time.time()
+            estado = {'saudavel': False, 'latencia_ms': None, 'sessoes': 0,
+                      'erro': None, 'verificado_em': time.time()}
+            try:
+                response = requests.get(f"{backend}/sessions", timeout=self.health_timeout)
+                estado['latencia_ms'] = round((time.time() - inicio) * 1000, 1)
+                if response.status_code == 200:
+                    estado['saudavel'] = True
+                    estado['sessoes'] = response.json().get('total_sessions', 0)
+                else:
+                    estado['erro'] = f"HTTP {response.status_code}"
+            except Exception as e:
+                estado['erro'] = str(e)
+
+            if self._saude[backend]['saudavel'] and not estado['saudavel']:
+                logger.warning(f"🔴 Backend Baileys fora do ar: {backend} ({estado['erro']})")
+            elif not self._saude[backend]['saudavel'] and estado['saudavel']:
+                logger.info(f"🟢 Backend Baileys recuperado: {backend}")
+            self._saude[backend] = estado
+
+        return self.obter_saude()
+
+    def obter_saude(self):
+        """Retorna o último estado conhecido de cada backend"""
+        return {b: dict(estado) for b, estado in self._saude.items()}
+
+    def iniciar_monitoramento(self):
+        """Inicia thread de verificação periódica de saúde dos backends"""
+        if self._monitorando or len(self.backends) == 1:
+            return
+        self._monitorando = True
+
+        def loop():
+            while self._monitorando:
+                try:
+                    self.verificar_saude()
+                except Exception as e:
+                    logger.error(f"Erro no monitoramento de backends Baileys: {e}")
+                time.sleep(self.health_interval)
+
+        threading.Thread(target=loop, daemon=True).start()
+        logger.info(f"🩺 Monitoramento de {len(self.backends)} backends Baileys iniciado")
+
+    def parar_monitoramento(self):
+        self._monitorando = False
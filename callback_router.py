@@ -0,0 +1,134 @@
+"""
+Roteador compilado de callbacks do Telegram
+Rotas exatas em dicionário e rotas por prefixo em trie (prefixo mais longo
+vence), parâmetros tipados extraídos do callback_data e métricas por rota
+"""
+
+import time
+import logging
+import threading
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+CallbackContext = namedtuple('CallbackContext', 'chat_id message_id callback_query_id data callback_query')
+
+_TIPOS = {'int': int, 'str': str, 'float': float, 'bool': lambda v: v == 'True'}
+
+
+class Rota:
+    def __init__(self, nome, handler, params=(), erro=None):
+        self.nome = nome
+        self.handler = handler
+        # ('cliente_id:int', 'tipo') -> [('cliente_id', int), ('tipo', str)]
+        self.params = []
+        for spec in params:
+            nome_param, _, tipo = spec.partition(':')
+            self.params.append((nome_param, _TIPOS[tipo or 'str']))
+        self.erro = erro
+
+    def extrair(self, resto):
+        """Converte o sufixo do callback_data em parâmetros; o último absorve '_' restantes"""
+        if not self.params:
+            return {}
+        partes = resto.split('_', len(self.params) - 1)
+        return {nome: conv(partes[i]) for i, (nome, conv) in enumerate(self.params)}
+
+
+class CallbackRouter:
+    def __init__(self):
+        """Inicializa tabelas de rotas e métricas"""
+        self._exatas = {}
+        self._trie = {}
+        self._metricas = {}
+        self._lock = threading.Lock()
+
+    def exata(self, callback_data, handler, erro=None):
+        """Registra rota para callback_data idêntico (primeiro registro prevalece)"""
+        self._exatas.setdefault(callback_data, Rota(callback_data, handler, erro=erro))
+
+    def prefixo(self, prefixo, handler, params=(), erro=None):
+        """Registra rota por prefixo com parâmetros tipados no restante do callback_data"""
+        no = self._trie
+        for caractere in prefixo:
+            no = no.setdefault(caractere, {})
+        no.setdefault(None, Rota(prefixo + '*', handler, params, erro))
+
+    def resolver(self, callback_data):
+        """Retorna (rota, resto) pela rota exata ou pelo prefixo mais longo registrado"""
+        rota = self._exatas.get(callback_data)
+        if rota:
+            return rota, ''
+
+        encontrada, fim = None, 0
+        no = self._trie
+        for i, caractere in enumerate(callback_data):
+            no = no.get(caractere)
+            if no is None:
+                break
+            if None in no:
+                encontrada, fim = no[None], i + 1
+        if encontrada:
+            return encontrada, callback_data[fim:]
+        return None, None
+
+    def despachar(self, ctx, ao_falhar=None):
+        """Executa a rota do callback; retorna False se nenhuma rota corresponder"""
+        rota, resto = self.resolver(ctx.data)
+        if rota is None:
+            self._registrar('<desconhecida>', 0.0, False)
+            logger.warning(f"Callback sem rota: {ctx.data}")
+            return False
+
+        inicio = time.perf_counter()
+        sucesso = True
+        try:
+            try:
+                params = rota.extrair(resto)
+            except (IndexError, ValueError) as e:
+                sucesso = False
+                logger.error(f"Parâmetros inválidos no callback {ctx.data}: {e}")
+                if ao_falhar:
+                    ao_falhar(ctx, rota.erro)
+                return True
+
+            try:
+                rota.handler(ctx, **params)
+            except Exception as e:
+                sucesso = False
+                if rota.erro and ao_falhar:
+                    logger.error(f"Erro na rota {rota.nome}: {e}")
+                    ao_falhar(ctx, rota.erro)
+                else:
+                    raise
+            return True
+        finally:
+            self._registrar(rota.nome, time.perf_counter() - inicio, sucesso)
+
+    def _registrar(self, nome, duracao, sucesso):
+        with self._lock:
+            m = self._metricas.setdefault(nome, {'chamadas': 0, 'erros': 0, 'tempo_total': 0.0, 'tempo_max': 0.0})
+            m['chamadas'] += 1
+            m['erros'] += 0 if sucesso else 1
+            m['tempo_total'] += duracao
+            m['tempo_max'] = max(m['tempo_max'], duracao)
+
+    def obter_metricas(self):
+        """Métricas por rota (latência em milissegundos), mais chamadas primeiro"""
+        with self._lock:
+            itens = sorted(self._metricas.items(), key=lambda kv: kv[1]['chamadas'], reverse=True)
+            return {
+                nome: {
+                    'chamadas': m['chamadas'],
+                    'erros': m['erros'],
+                    'tempo_medio_ms': round(m['tempo_total'] / m['chamadas'] * 1000, 1),
+                    'tempo_max_ms': round(m['tempo_max'] * 1000, 1),
+                }
+                for nome, m in itens
+            }
+
+    def total_rotas(self):
+        return len(self._exatas) + self._contar_prefixos(self._trie)
+
+    def _contar_prefixos(self, no):
+        return sum(1 if k is None else self._contar_prefixos(v) for k, v in no.items())
@@ -0,0 +1,364 @@
+"""
+Armazenamento de estados de conversa do bot
+Mapas compatíveis com dict (conversation_states, user_states, ...) com cache
+local quente, serialização compacta, expiração por TTL e persistência em
+PostgreSQL (produção) ou SQLite (desenvolvimento)
+"""
+
+import os
+import json
+import time
+import zlib
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from datetime import datetime, date
+from decimal import Decimal
+
+logger = logging.getLogger(__name__)
+
+
+# ===================== Serialização =====================
+def _codificar(obj):
+    """Converte tipos não-JSON usados nos estados (datas, Decimal, set)"""
+    if isinstance(obj, datetime):
+        return {'__dt': obj.isoformat()}
+    if isinstance(obj, date):
+        return {'__d': obj.isoformat()}
+    if isinstance(obj, Decimal):
+        return {'__dec': str(obj)}
+    if isinstance(obj, (set, frozenset)):
+        return {'__s': list(obj)}
+    raise TypeError(f"Tipo não serializável no estado: {type(obj).__name__}")
+
+
+def _decodificar(obj):
+    if len(obj) == 1:
+        if '__dt' in obj:
+            return datetime.fromisoformat(obj['__dt'])
+        if '__d' in obj:
+            return date.fromisoformat(obj['__d'])
+        if '__dec' in obj:
+            return Decimal(obj['__dec'])
+        if '__s' in obj:
+            return set(obj['__s'])
+    return obj
+
+
+def serializar(valor):
+    """JSON compacto; comprime com zlib quando compensa (prefixo de 1 byte)"""
+    bruto = json.dumps(valor, separators=(',', ':'), ensure_ascii=False, default=_codificar).encode('utf-8')
+    if len(bruto) > 256:
+        comprimido = zlib.compress(bruto, 6)
+        if len(comprimido) < len(bruto):
+            return b'z' + comprimido
+    return b'j' + bruto
+
+
+def desserializar(blob):
+    blob = bytes(blob)
+    corpo = zlib.decompress(blob[1:]) if blob[:1] == b'z' else blob[1:]
+    return json.loads(corpo.decode('utf-8'), object_hook=_decodificar)
+
+
+# ===================== Backends =====================
+class MemoryStateBackend:
+    """Backend apenas em memória (comportamento original, sem persistência)"""
+
+    compartilhado = False
+
+    def __init__(self):
+        self._dados = {}
+
+    def obter(self, namespace, chave):
+        item = self._dados.get((namespace, chave))
+        if item and item[1] > time.time():
+            return item[0]
+        return None
+
+    def salvar(self, namespace, chave, blob, ttl):
+        self._dados[(namespace, chave)] = (blob, time.time() + ttl)
+
+    def remover(self, namespace, chave):
+        self._dados.pop((namespace, chave), None)
+
+    def limpar_expirados(self):
+        agora = time.time()
+        for k in [k for k, (_, exp) in self._dados.items() if exp <= agora]:
+            self._dados.pop(k, None)
+
+
+class SQLiteStateBackend:
+    """Backend SQLite para desenvolvimento local"""
+
+    compartilhado = True
+
+    def __init__(self, caminho):
+        self._conn = sqlite3.connect(caminho, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS estados_conversa (
+                    namespace TEXT NOT NULL,
+                    chave TEXT NOT NULL,
+                    valor BLOB NOT NULL,
+                    expira_em REAL NOT NULL,
+                    PRIMARY KEY (namespace, chave)
+                )
+            """)
+            self._conn.commit()
+
+    def obter(self, namespace, chave):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT valor FROM estados_conversa WHERE namespace = ? AND chave = ? AND expira_em > ?",
+                (namespace, chave, time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    def salvar(self, namespace, chave, blob, ttl):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO estados_conversa (namespace, chave, valor, expira_em) VALUES (?, ?, ?, ?)",
+                (namespace, chave, sqlite3.Binary(blob), time.time() + ttl)
+            )
+            self._conn.commit()
+
+    def remover(self, namespace, chave):
+        with self._lock:
+            self._conn.execute("DELETE FROM estados_conversa WHERE namespace = ? AND chave = ?", (namespace, chave))
+            self._conn.commit()
+
+    def limpar_expirados(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM estados_conversa WHERE expira_em <= ?", (time.time(),))
+            self._conn.commit()
+
+
+class PostgresStateBackend:
+    """Backend PostgreSQL compartilhado entre processos do bot"""
+
+    compartilhado = True
+
+    def __init__(self, db_manager):
+        self.db = db_manager
+
+    def obter(self, namespace, chave):
+        with self.db.get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT valor FROM estados_conversa
+                    WHERE namespace = %s AND chave = %s AND expira_em > CURRENT_TIMESTAMP
+                """, (namespace, chave))
+                row = cursor.fetchone()
+        return bytes(row[0]) if row else None
+
+    def salvar(self, namespace, chave, blob, ttl):
+        with self.db.get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO estados_conversa (namespace, chave, valor, expira_em)
+                    VALUES (%s, %s, %s, CURRENT_TIMESTAMP + %s * INTERVAL '1 second')
+                    ON CONFLICT (namespace, chave) DO UPDATE SET
+                        valor = EXCLUDED.valor,
+                        expira_em = EXCLUDED.expira_em
+                """, (namespace, chave, blob, ttl))
+                conn.commit()
+
+    def remover(self, namespace, chave):
+        with self.db.get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "DELETE FROM estados_conversa WHERE namespace = %s AND chave = %s", (namespace, chave)
+                )
+                conn.commit()
+
+    def limpar_expirados(self):
+        with self.db.get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("DELETE FROM estados_conversa WHERE expira_em <= CURRENT_TIMESTAMP")
+                conn.commit()
+
+
+# ===================== Mapas =====================
+_AUSENTE = object()
+
+
+class ConversationStateMap(MutableMapping):
+    """Mapa compatível com dict; o cache local guarda os objetos vivos.
+
+    Mutações feitas dentro do valor (ex.: estado['dados']['nome'] = ...) são
+    gravadas no backend por persistir(chave), chamado ao fim de cada update.
+    """
+
+    def __init__(self, store, namespace):
+        self.store = store
+        self.namespace = namespace
+        # chave -> [valor, carregado_em, blob_persistido]; valor _AUSENTE = sabidamente sem estado
+        self._local = OrderedDict()
+        self._tocadas = set()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _chave_backend(chave):
+        return json.dumps(chave)
+
+    def _local_valido(self, entrada):
+        idade = time.time() - entrada[1]
+        if idade > self.store.ttl:
+            return False
+        # Com vários processos, o cache local vale apenas por alguns segundos
+        return not self.store.multiprocesso or idade <= self.store.ttl_local
+
+    def _carregar(self, chave):
+        with self._lock:
+            entrada = self._local.get(chave)
+            if entrada is not None and self._local_valido(entrada):
+                self._local.move_to_end(chave)
+                return entrada[0]
+
+        blob = None
+        try:
+            blob = self.store.backend.obter(self.namespace, self._chave_backend(chave))
+        except Exception as e:
+            logger.error(f"Erro ao carregar estado {self.namespace}/{chave}: {e}")
+
+        valor = desserializar(blob) if blob else _AUSENTE
+        self._guardar_local(chave, valor, blob)
+        return valor
+
+    def _guardar_local(self, chave, valor, blob):
+        with self._lock:
+            self._local[chave] = [valor, time.time(), blob]
+            self._local.move_to_end(chave)
+            while len(self._local) > self.store.max_local:
+                antiga, entrada = next(iter(self._local.items()))
+                if antiga in self._tocadas:
+                    self.persistir(antiga)
+                self._local.pop(antiga, None)
+
+    def __getitem__(self, chave):
+        valor = self._carregar(chave)
+        if valor is _AUSENTE:
+            raise KeyError(chave)
+        self._tocadas.add(chave)
+        return valor
+
+    def __setitem__(self, chave, valor):
+        blob = serializar(valor)
+        self._guardar_local(chave, valor, blob)
+        self._tocadas.discard(chave)
+        try:
+            self.store.backend.salvar(self.namespace, self._chave_backend(chave), blob, self.store.ttl)
+        except Exception as e:
+            logger.error(f"Erro ao salvar estado {self.namespace}/{chave}: {e}")
+
+    def __delitem__(self, chave):
+        if self._carregar(chave) is _AUSENTE:
+            raise KeyError(chave)
+        self._guardar_local(chave, _AUSENTE, None)
+        self._tocadas.discard(chave)
+        try:
+            self.store.backend.remover(self.namespace, self._chave_backend(chave))
+        except Exception as e:
+            logger.error(f"Erro ao remover estado {self.namespace}/{chave}: {e}")
+
+    def __contains__(self, chave):
+        return self._carregar(chave) is not _AUSENTE
+
+    def __iter__(self):
+        # Apenas chaves presentes no cache local deste processo
+        with self._lock:
+            chaves = [k for k, e in self._local.items() if e[0] is not _AUSENTE and self._local_valido(e)]
+        return iter(chaves)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def persistir(self, chave):
+        """Grava no backend alterações feitas dentro do valor desde a última leitura"""
+        if chave not in self._tocadas:
+            return
+        self._tocadas.discard(chave)
+        with self._lock:
+            entrada = self._local.get(chave)
+        if entrada is None or entrada[0] is _AUSENTE:
+            return
+        try:
+            blob = serializar(entrada[0])
+            if blob != entrada[2]:
+                self.store.backend.salvar(self.namespace, self._chave_backend(chave), blob, self.store.ttl)
+                entrada[2] = blob
+            entrada[1] = time.time()
+        except Exception as e:
+            logger.error(f"Erro ao persistir estado {self.namespace}/{chave}: {e}")
+
+    def migrar_para(self, backend):
+        """Copia entradas locais para um novo backend"""
+        with self._lock:
+            itens = [(k, e[0]) for k, e in self._local.items() if e[0] is not _AUSENTE]
+        for chave, valor in itens:
+            backend.salvar(self.namespace, self._chave_backend(chave), serializar(valor), self.store.ttl)
+
+
+class ConversationStateStore:
+    def __init__(self, backend=None):
+        """Inicializa o armazenamento (memória até conectar um backend persistente)"""
+        self.backend = backend or MemoryStateBackend()
+        self.ttl = int(os.getenv('CONVERSA_TTL', str(24 * 3600)))
+        self.ttl_local = int(os.getenv('CONVERSA_CACHE_LOCAL_TTL', '5'))
+        self.max_local = int(os.getenv('CONVERSA_CACHE_MAX', '5000'))
+        self.multiprocesso = os.getenv('CONVERSA_MULTIPROCESSO', 'false').lower() == 'true'
+        self._mapas = {}
+        self._limpeza_ativa = False
+
+    def mapa(self, namespace):
+        """Retorna (criando se preciso) o mapa de um namespace"""
+        if namespace not in self._mapas:
+            self._mapas[namespace] = ConversationStateMap(self, namespace)
+        return self._mapas[namespace]
+
+    def conectar(self, db_manager=None):
+        """Troca o backend conforme CONVERSA_STORE (postgres | sqlite | memoria)"""
+        tipo = os.getenv('CONVERSA_STORE', 'postgres' if db_manager else 'memoria').lower()
+        try:
+            if tipo == 'postgres' and db_manager:
+                backend = PostgresStateBackend(db_manager)
+            elif tipo == 'sqlite':
+                backend = SQLiteStateBackend(os.getenv('CONVERSA_SQLITE_PATH', 'estados_conversa.db'))
+            else:
+                return False
+
+            for mapa in self._mapas.values():
+                mapa.migrar_para(backend)
+            self.backend = backend
+            self._iniciar_limpeza()
+            logger.info(f"✅ Estados de conversa persistidos em {tipo}")
+            return True
+        except Exception as e:
+            logger.error(f"Erro ao conectar armazenamento de estados ({tipo}): {e}")
+            return False
+
+    def persistir(self, chave):
+        """Grava alterações pendentes de uma chave (chat_id) em todos os mapas"""
+        if chave is None:
+            return
+        for mapa in self._mapas.values():
+            mapa.persistir(chave)
+
+    def _iniciar_limpeza(self):
+        if self._limpeza_ativa:
+            return
+        self._limpeza_ativa = True
+
+        def loop():
+            while True:
+                time.sleep(3600)
+                try:
+                    self.backend.limpar_expirados()
+                except Exception as e:
+                    logger.error(f"Erro ao limpar estados de conversa expirados: {e}")
+
+        threading.Thread(target=loop, daemon=True).start()
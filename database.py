@@ -4,16 +4,120 @@ Sistema completo para gestão de clientes, templates e logs
 """
 
 import os
+import zlib
+import atexit
+import signal
+import weakref
+import hashlib
+import threading
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import logging
+from collections import Counter
 from datetime import datetime, timedelta
 from utils import agora_br, formatar_data_br
 from models import Cliente, Template, LogEnvio, FilaMensagem
 
 logger = logging.getLogger(__name__)
 
+def postgres_disponivel(timeout=3):
+    """Sonda rápida do PostgreSQL para a inicialização (não cria tabelas nem loga falhas)"""
+    config = {'connect_timeout': timeout, 'application_name': 'bot_gestao_clientes'}
+    database_url = os.getenv('DATABASE_URL')
+    if database_url:
+        if 'sslmode=' not in database_url:
+            config['sslmode'] = 'require'
+        conn = psycopg2.connect(database_url, **config)
+    else:
+        conn = psycopg2.connect(
+            host=os.getenv('PGHOST', 'localhost'),
+            database=os.getenv('PGDATABASE', 'bot_clientes'),
+            user=os.getenv('PGUSER', 'postgres'),
+            password=os.getenv('PGPASSWORD', ''),
+            port=os.getenv('PGPORT', '5432'),
+            sslmode='require',
+            **config
+        )
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+            return cursor.fetchone() is not None
+    finally:
+        conn.close()
+
+def compactar_mensagem(texto):
+    """Corpo de mensagem endereçado por conteúdo: (hash sha256, bytes, compactado)"""
+    bruto = texto.encode('utf-8')
+    compactado = zlib.compress(bruto, 6)
+    if len(compactado) < len(bruto):
+        return hashlib.sha256(bruto).digest(), compactado, True
+    return hashlib.sha256(bruto).digest(), bruto, False
+
+def descompactar_mensagem(conteudo, compactado):
+    """Texto original a partir do corpo armazenado"""
+    conteudo = bytes(conteudo)
+    return (zlib.decompress(conteudo) if compactado else conteudo).decode('utf-8')
+
+# Instâncias com contadores de uso de templates a gravar no encerramento
+_gerenciadores_uso_templates = weakref.WeakSet()
+_sigterm_anterior = None
+
+def _gravar_uso_templates_pendentes():
+    """Grava os contadores em memória de todas as instâncias (atexit/SIGTERM)"""
+    for gerenciador in list(_gerenciadores_uso_templates):
+        gerenciador.gravar_uso_templates()
+
+atexit.register(_gravar_uso_templates_pendentes)
+
+def _encerrar_por_sigterm(signum, frame):
+    """SIGTERM não executa atexit: grava os contadores antes de encerrar"""
+    logger.info("🛑 SIGTERM recebido - gravando uso de templates pendente")
+    # Em thread própria para não travar caso o sinal chegue com o lock do contador tomado
+    gravacao = threading.Thread(target=_gravar_uso_templates_pendentes, name='uso-templates-sigterm')
+    gravacao.start()
+    gravacao.join(timeout=10)
+    if callable(_sigterm_anterior):
+        # O handler anterior decide como encerrar
+        _sigterm_anterior(signum, frame)
+        return
+    raise SystemExit(0)
+
+def instalar_encerramento_sigterm():
+    """Grava o uso de templates ao receber SIGTERM
+    
+    Chamar apenas dos pontos de entrada do processo (thread principal); servidores
+    como o gunicorn instalam o próprio handler e não devem tê-lo substituído no import.
+    """
+    global _sigterm_anterior
+    if threading.current_thread() is not threading.main_thread():
+        logger.warning("Handler de SIGTERM só pode ser instalado na thread principal")
+        return
+    try:
+        anterior = signal.getsignal(signal.SIGTERM)
+        if anterior is signal.SIG_IGN or anterior is _encerrar_por_sigterm:
+            return
+        _sigterm_anterior = anterior
+        signal.signal(signal.SIGTERM, _encerrar_por_sigterm)
+    except (ValueError, OSError) as e:
+        logger.warning(f"Handler de SIGTERM não instalado: {e}")
+
 class DatabaseManager:
+    # Migrações versionadas: (versão, descrição, método). Uma migração publicada não
+    # muda mais; alterações de schema entram como nova versão no fim da lista.
+    MIGRACOES = (
+        (1, 'estrutura base (tabelas, índices, templates e configurações padrão)', '_migracao_estrutura_base'),
+        (2, 'remove índices duplicados', '_migracao_remove_indices_duplicados'),
+        (3, 'fila com renderização no envio', '_migracao_fila_renderizacao_no_envio'),
+        (4, 'corpos de logs_envio deduplicados e compactados', '_migracao_logs_mensagem_deduplicada'),
+        (5, 'métricas diárias por usuário', '_migracao_metricas_diarias'),
+        (6, 'índice de logs_envio por hash do corpo', '_migracao_indice_logs_mensagem_hash'),
+        (7, 'tabelas de números WhatsApp, sessões Baileys e estados de conversa', '_migracao_tabelas_auxiliares'),
+    )
+    # Chave do pg_advisory_lock que serializa migrações entre processos
+    SCHEMA_LOCK_ID = 740_2025
+    # Schema já conferido neste processo: novas instâncias não consultam o banco
+    _schema_atualizado = False
+    
     def __init__(self):
         """Inicializa conexão com PostgreSQL"""
         # Primeiro tentar DATABASE_URL (padrão Railway)
@@ -40,6 +144,22 @@ class DatabaseManager:
         self._cache = {}
         self._cache_ttl = {}
         self._cache_timeout = 300  # 5 minutos
+        self._cache_lock = threading.Lock()
+        self._estatisticas_ttl = int(os.getenv('ESTATISTICAS_CACHE_TTL', '30'))
+        
+        # Contadores de uso de templates acumulados em memória (gravados em lote)
+        self._uso_templates = Counter()
+        self._uso_templates_lock = threading.Lock()
+        self._uso_templates_intervalo = float(os.getenv('TEMPLATE_USO_FLUSH_INTERVALO', '30'))
+        self._uso_templates_thread = None
+        _gerenciadores_uso_templates.add(self)
+        
+        # Usuários com métricas do dia desatualizadas (None = todos); consolidadas pelo agendador
+        self._metricas_pendentes = set()
+        self._metricas_lock = threading.Lock()
+        
+        # Logs de envio guardam só o hash do corpo (corpos deduplicados e compactados)
+        self.logs_mensagem_deduplicada = os.getenv('LOGS_MENSAGEM_DEDUPLICADA', 'true').lower() == 'true'
         
         self.init_database()
     
@@ -88,20 +208,23 @@ class DatabaseManager:
     def _get_cache(self, key):
         """Recupera valor do cache se ainda válido"""
         import time
-        if key in self._cache and key in self._cache_ttl:
-            if time.time() < self._cache_ttl[key]:
-                return self._cache[key]
-            else:
-                # Cache expirado, remover
-                del self._cache[key]
-                del self._cache_ttl[key]
+        with self._cache_lock:
+            expira_em = self._cache_ttl.get(key)
+            if expira_em is None:
+                return None
+            if time.time() < expira_em:
+                return self._cache.get(key)
+            # Cache expirado, remover
+            self._cache.pop(key, None)
+            self._cache_ttl.pop(key, None)
         return None
     
-    def _set_cache(self, key, value):
-        """Define valor no cache com TTL"""
+    def _set_cache(self, key, value, ttl=None):
+        """Define valor no cache com TTL (padrão: _cache_timeout)"""
         import time
-        self._cache[key] = value
-        self._cache_ttl[key] = time.time() + self._cache_timeout
+        with self._cache_lock:
+            self._cache[key] = value
+            self._cache_ttl[key] = time.time() + (self._cache_timeout if ttl is None else ttl)
     
     def execute_query(self, query, params=None):
         """Executa uma query de modificação (INSERT, UPDATE, DELETE)"""
@@ -140,32 +263,25 @@ class DatabaseManager:
             raise
     
     def init_database(self):
-        """Inicializa as tabelas do banco de dados com retry para Railway"""
+        """Garante o schema na última versão (uma consulta quando já está atualizado)"""
+        if DatabaseManager._schema_atualizado:
+            return True
+        
         max_attempts = 5
         retry_delay = 2
+        ultima_versao = self.MIGRACOES[-1][0]
         
         for attempt in range(max_attempts):
             conn = None
             try:
-                # Testar conectividade básica primeiro
-                logger.info(f"Tentativa {attempt + 1} de conectar ao banco...")
                 conn = self.get_connection()
-                
-                # Com autocommit ativo, não precisa de rollback
-                logger.info("Conexão configurada com autocommit")
-                
                 with conn.cursor() as cursor:
-                    # Testar uma query simples primeiro
-                    cursor.execute("SELECT 1")
-                    cursor.fetchone()
-                    logger.info("Conectividade básica confirmada")
-                        
-                    # Criar estrutura do banco (autocommit já ativo)
-                    self.create_tables(cursor)
-                    self.create_indexes(cursor)
-                    self.insert_default_templates(cursor)
-                    self.insert_default_configs(cursor)
-                logger.info("Banco de dados inicializado com sucesso!")
+                    versao = self._versao_schema(cursor)
+                    if versao < ultima_versao:
+                        self._aplicar_migracoes(cursor)
+                    else:
+                        logger.info(f"✅ Schema do banco atualizado (versão {versao})")
+                DatabaseManager._schema_atualizado = True
                 return True
                     
             except psycopg2.OperationalError as e:
@@ -180,28 +296,160 @@ class DatabaseManager:
                     
             except Exception as e:
                 logger.error(f"Erro ao inicializar banco de dados: {e}")
-                
-                # Fechar conexão problemática se existir
+                logger.error(f"Detalhes da conexão: {self.connection_params}")
+                raise
+            
+            finally:
                 if conn:
                     try:
                         conn.close()
                     except Exception:
                         pass
-                
-                # Se for erro de transação abortada, tentar com nova conexão
-                if "current transaction is aborted" in str(e) and attempt < max_attempts - 1:
-                    logger.info("Detectado erro de transação abortada, tentando nova conexão...")
-                    import time
-                    time.sleep(retry_delay)
-                    retry_delay *= 2
-                    continue
-                
-                logger.error(f"Detalhes da conexão: {self.connection_params}")
-                if attempt >= max_attempts - 1:
-                    raise
         
         return False
     
+    def _versao_schema(self, cursor):
+        """Última migração aplicada (0 se a tabela schema_version ainda não existe)"""
+        try:
+            cursor.execute("SELECT COALESCE(MAX(versao), 0) FROM schema_version")
+            return cursor.fetchone()[0]
+        except psycopg2.ProgrammingError:
+            return 0
+    
+    def versao_schema(self):
+        """Versão atual do schema - consulta única, serve também como teste de conexão"""
+        with self.get_connection() as conn:
+            with conn.cursor() as cursor:
+                return self._versao_schema(cursor)
+    
+    def _aplicar_migracoes(self, cursor):
+        """Aplica migrações pendentes em ordem sob advisory lock (uma instância por vez)"""
+        import time
+        logger.info("🔒 Aguardando lock de migração do schema...")
+        cursor.execute("SELECT pg_advisory_lock(%s)", (self.SCHEMA_LOCK_ID,))
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    versao INTEGER PRIMARY KEY,
+                    descricao VARCHAR(255),
+                    aplicada_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    duracao_ms INTEGER
+                )
+            """)
+            # Outra instância pode ter migrado enquanto aguardávamos o lock
+            versao = self._versao_schema(cursor)
+            
+            for numero, descricao, metodo in self.MIGRACOES:
+                if numero <= versao:
+                    continue
+                inicio = time.time()
+                logger.info(f"🔄 Aplicando migração {numero}: {descricao}")
+                getattr(self, metodo)(cursor)
+                duracao_ms = int((time.time() - inicio) * 1000)
+                cursor.execute("""
+                    INSERT INTO schema_version (versao, descricao, duracao_ms)
+                    VALUES (%s, %s, %s)
+                """, (numero, descricao, duracao_ms))
+                logger.info(f"✅ Migração {numero} aplicada em {duracao_ms} ms")
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (self.SCHEMA_LOCK_ID,))
+    
+    # === MIGRAÇÕES ===
+    
+    def _migracao_estrutura_base(self, cursor):
+        """Estrutura completa anterior ao versionamento (idempotente para bancos existentes)"""
+        self.create_tables(cursor)
+        self.create_indexes(cursor)
+        self.insert_default_templates(cursor)
+        self.insert_default_configs(cursor)
+    
+    def _migracao_remove_indices_duplicados(self, cursor):
+        """Remove índices cobertos por outros (mesmas colunas iniciais ou constraint UNIQUE)"""
+        redundantes = [
+            'idx_config_chave_usuario',         # uq_configuracoes_chave_usuario
+            'idx_configuracoes_chave_usuario',  # uq_configuracoes_chave_usuario
+            'idx_configuracoes_usuario',        # idx_config_usuario
+            'idx_templates_nome_usuario',       # uq_templates_nome_usuario
+            'idx_clientes_usuario',             # idx_clientes_usuario_vencimento
+            'idx_clientes_telefone',            # idx_clientes_telefone_usuario
+            'idx_logs_usuario',                 # idx_logs_usuario_data
+            'idx_logs_cliente_id',              # idx_logs_cliente_usuario
+        ]
+        for indice in redundantes:
+            cursor.execute(f"DROP INDEX IF EXISTS {indice}")
+    
+    def _migracao_fila_renderizacao_no_envio(self, cursor):
+        """Mensagem da fila pode ficar vazia e ser renderizada no envio (template + cliente)"""
+        cursor.execute("ALTER TABLE fila_mensagens ALTER COLUMN mensagem DROP NOT NULL")
+        cursor.execute("ALTER TABLE fila_mensagens ADD COLUMN IF NOT EXISTS contexto_versao SMALLINT")
+    
+    def _migracao_logs_mensagem_deduplicada(self, cursor):
+        """Corpos de mensagem em tabela própria (um por conteúdo, compactado); logs guardam o hash"""
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS mensagens_envio (
+                hash BYTEA PRIMARY KEY,
+                conteudo BYTEA NOT NULL,
+                compactado BOOLEAN NOT NULL DEFAULT TRUE,
+                data_criacao TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cursor.execute("ALTER TABLE logs_envio ALTER COLUMN mensagem DROP NOT NULL")
+        cursor.execute("ALTER TABLE logs_envio ADD COLUMN IF NOT EXISTS mensagem_hash BYTEA")
+    
+    def _migracao_metricas_diarias(self, cursor):
+        """Consolidado por usuário e dia, preenchido com os últimos 90 dias"""
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS metricas_diarias (
+                chat_id_usuario BIGINT NOT NULL,
+                dia DATE NOT NULL,
+                clientes_ativos INTEGER NOT NULL DEFAULT 0,
+                novos_clientes INTEGER NOT NULL DEFAULT 0,
+                receita DECIMAL(12,2) NOT NULL DEFAULT 0,
+                vencidos INTEGER NOT NULL DEFAULT 0,
+                vencem_7_dias INTEGER NOT NULL DEFAULT 0,
+                mensagens_enviadas INTEGER NOT NULL DEFAULT 0,
+                mensagens_falhas INTEGER NOT NULL DEFAULT 0,
+                data_atualizacao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (chat_id_usuario, dia)
+            )
+        """)
+        hoje = agora_br().date()
+        self._consolidar_metricas(cursor, hoje - timedelta(days=90), hoje)
+    
+    def _migracao_indice_logs_mensagem_hash(self, cursor):
+        """Índice usado pela limpeza de corpos órfãos (anti-join por hash)"""
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_envio_mensagem_hash ON logs_envio(mensagem_hash)")
+    
+    def _migracao_tabelas_auxiliares(self, cursor):
+        """Tabelas antes criadas por WhatsAppNumberCache, BaileysShardRouter e PostgresStateBackend"""
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS whatsapp_numeros (
+                telefone VARCHAR(20) PRIMARY KEY,
+                valido BOOLEAN NOT NULL,
+                chat_id_usuario BIGINT,
+                verificado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                expira_em TIMESTAMP NOT NULL
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_whatsapp_numeros_expira ON whatsapp_numeros(expira_em)")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS baileys_sessoes_backend (
+                chat_id_usuario BIGINT PRIMARY KEY,
+                backend_url VARCHAR(255) NOT NULL,
+                atribuido_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS estados_conversa (
+                namespace VARCHAR(50) NOT NULL,
+                chave VARCHAR(100) NOT NULL,
+                valor BYTEA NOT NULL,
+                expira_em TIMESTAMP NOT NULL,
+                PRIMARY KEY (namespace, chave)
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_estados_conversa_expira ON estados_conversa(expira_em)")
+    
     def create_tables(self, cursor):
         """Cria todas as tabelas necessárias"""
         
@@ -338,6 +586,12 @@ class DatabaseManager:
             ADD COLUMN IF NOT EXISTS chat_id_usuario BIGINT;
         """)
         
+        # Prioridade na fila (0 = envio manual/imediato, 5 = agendamento automático)
+        cursor.execute("""
+            ALTER TABLE fila_mensagens 
+            ADD COLUMN IF NOT EXISTS prioridade SMALLINT DEFAULT 5;
+        """)
+        
         # Foreign keys com verificação manual (PostgreSQL não suporta IF NOT EXISTS)
         try:
             cursor.execute("""
@@ -435,11 +689,11 @@ class DatabaseManager:
             "CREATE INDEX IF NOT EXISTS idx_clientes_usuario_vencimento ON clientes(chat_id_usuario, vencimento);",
             "CREATE INDEX IF NOT EXISTS idx_clientes_telefone_usuario ON clientes(telefone, chat_id_usuario);",
             "CREATE INDEX IF NOT EXISTS idx_clientes_status_usuario ON clientes(chat_id_usuario, ativo, vencimento);",
+            "CREATE INDEX IF NOT EXISTS idx_clientes_usuario_keyset ON clientes(chat_id_usuario, vencimento, nome, id) WHERE ativo = TRUE;",
             
             # Templates - isolamento por usuário
             "CREATE INDEX IF NOT EXISTS idx_templates_usuario_ativo ON templates(chat_id_usuario, ativo) WHERE ativo = TRUE;",
             "CREATE INDEX IF NOT EXISTS idx_templates_tipo_usuario ON templates(tipo, chat_id_usuario, ativo);",
-            "CREATE INDEX IF NOT EXISTS idx_templates_nome_usuario ON templates(nome, chat_id_usuario);",
             
             # Logs de envio - isolamento por usuário
             "CREATE INDEX IF NOT EXISTS idx_logs_usuario_data ON logs_envio(chat_id_usuario, data_envio DESC);",
@@ -451,8 +705,7 @@ class DatabaseManager:
             "CREATE INDEX IF NOT EXISTS idx_fila_agendado_usuario ON fila_mensagens(agendado_para, chat_id_usuario) WHERE processado = FALSE;",
             "CREATE INDEX IF NOT EXISTS idx_fila_cliente_usuario ON fila_mensagens(cliente_id, chat_id_usuario);",
             
-            # Configurações - isolamento por usuário
-            "CREATE INDEX IF NOT EXISTS idx_config_chave_usuario ON configuracoes(chave, chat_id_usuario);",
+            # Configurações - isolamento por usuário (chave + usuário coberto por uq_configuracoes_chave_usuario)
             "CREATE INDEX IF NOT EXISTS idx_config_usuario ON configuracoes(chat_id_usuario);",
             
             # === ÍNDICES LEGADOS MANTIDOS ===
@@ -464,29 +717,19 @@ class DatabaseManager:
             "CREATE INDEX IF NOT EXISTS idx_pagamentos_status ON pagamentos(status)",
             
             # Índices críticos para isolamento multi-tenant
-            "CREATE INDEX IF NOT EXISTS idx_clientes_usuario ON clientes(chat_id_usuario)",
-            "CREATE INDEX IF NOT EXISTS idx_clientes_telefone ON clientes(telefone)",
             "CREATE INDEX IF NOT EXISTS idx_clientes_vencimento ON clientes(vencimento)",
             "CREATE INDEX IF NOT EXISTS idx_clientes_ativo ON clientes(ativo)",
-            "CREATE INDEX IF NOT EXISTS idx_clientes_usuario_ativo ON clientes(chat_id_usuario, ativo)",
-            "CREATE INDEX IF NOT EXISTS idx_clientes_usuario_vencimento ON clientes(chat_id_usuario, vencimento)",
             
             # Índices para templates multi-tenant
             "CREATE INDEX IF NOT EXISTS idx_templates_usuario ON templates(chat_id_usuario)",
             "CREATE INDEX IF NOT EXISTS idx_templates_tipo ON templates(tipo)",
             "CREATE INDEX IF NOT EXISTS idx_templates_ativo ON templates(ativo)",
-            "CREATE INDEX IF NOT EXISTS idx_templates_usuario_ativo ON templates(chat_id_usuario, ativo)",
             
             # Índices para configurações multi-tenant
             "CREATE INDEX IF NOT EXISTS idx_configuracoes_chave ON configuracoes(chave)",
-            "CREATE INDEX IF NOT EXISTS idx_configuracoes_usuario ON configuracoes(chat_id_usuario)",
-            "CREATE INDEX IF NOT EXISTS idx_configuracoes_chave_usuario ON configuracoes(chave, chat_id_usuario)",
             
             # Índices para logs e performance
-            "CREATE INDEX IF NOT EXISTS idx_logs_usuario ON logs_envio(chat_id_usuario)",
-            "CREATE INDEX IF NOT EXISTS idx_logs_cliente_id ON logs_envio(cliente_id)",
             "CREATE INDEX IF NOT EXISTS idx_logs_data_envio ON logs_envio(data_envio)",
-            "CREATE INDEX IF NOT EXISTS idx_logs_usuario_data ON logs_envio(chat_id_usuario, data_envio)",
             
             # Índices para fila de mensagens
             "CREATE INDEX IF NOT EXISTS idx_fila_agendado ON fila_mensagens(agendado_para)",
@@ -768,6 +1011,7 @@ _Obrigado por escolher nossos serviços!_ ✨""",
                             VALUES (%(nome)s, %(descricao)s, %(tipo)s, %(conteudo)s, %(chat_id_usuario)s)
                         """, template)
                     conn.commit()
+            self.invalidar_templates(chat_id_usuario)
                     
             logger.info(f"Templates personalizados criados para usuário {chat_id_usuario}")
             
@@ -801,7 +1045,8 @@ _Obrigado por escolher nossos serviços!_ ✨""",
                             VALUES (%s, %s, %s, %s)
                         """, (chave, valor, descricao, chat_id_usuario))
                     conn.commit()
-                    
+            
+            self.invalidar_configuracoes(chat_id_usuario)
             logger.info(f"Configurações personalizadas criadas para usuário {chat_id_usuario}")
             
         except Exception as e:
@@ -834,6 +1079,7 @@ _Obrigado por escolher nossos serviços!_ ✨""",
                     
                     # Invalidar cache de clientes
                     self.invalidate_cache("clientes")
+                    self.marcar_metricas_pendentes(chat_id_usuario)
                     
                     logger.info(f"Cliente cadastrado: ID {cliente_id}, Nome: {nome}")
                     return cliente_id
@@ -902,18 +1148,117 @@ _Obrigado por escolher nossos serviços!_ ✨""",
             logger.error(f"Erro ao listar clientes: {e}")
             raise
     
+    # Filtros de situação de vencimento (mesmas faixas usadas nas listagens do bot)
+    FILTROS_VENCIMENTO = {
+        'vencidos': "vencimento < CURRENT_DATE",
+        'vencendo': "vencimento BETWEEN CURRENT_DATE AND CURRENT_DATE + 3",
+        'emdia': "vencimento > CURRENT_DATE + 3",
+    }
+    
+    def listar_clientes_pagina(self, chat_id_usuario, filtro=None, apos_id=None, antes_id=None, limite=15):
+        """Página de clientes ativos por keyset (vencimento, nome, id)
+        
+        apos_id/antes_id: id do último/primeiro cliente da página atual; a posição
+        (vencimento, nome, id) é resolvida no banco, sem OFFSET. Se o cliente de
+        referência não existir mais, retorna a primeira página.
+        Retorna {'clientes', 'tem_anterior', 'tem_proxima'}.
+        """
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                    where_conditions = ["ativo = TRUE", "chat_id_usuario = %s"]
+                    params = [chat_id_usuario]
+                    
+                    if filtro in self.FILTROS_VENCIMENTO:
+                        where_conditions.append(self.FILTROS_VENCIMENTO[filtro])
+                    
+                    voltando = antes_id is not None
+                    referencia = antes_id if voltando else apos_id
+                    posicao = None
+                    if referencia is not None:
+                        cursor.execute("""
+                            SELECT vencimento, nome, id FROM clientes
+                            WHERE id = %s AND chat_id_usuario = %s
+                        """, (referencia, chat_id_usuario))
+                        posicao = cursor.fetchone()
+                        if posicao is None:
+                            # Cliente excluído depois que a página foi exibida: recomeçar do início
+                            logger.debug(f"Cliente de referência {referencia} não encontrado, voltando à primeira página")
+                            voltando = False
+                            apos_id = None
+                    if posicao is not None:
+                        operador = '<' if voltando else '>'
+                        where_conditions.append(f"(vencimento, nome, id) {operador} (%s, %s, %s)")
+                        params.extend([posicao['vencimento'], posicao['nome'], posicao['id']])
+                    
+                    ordem = "DESC" if voltando else "ASC"
+                    params.append(limite + 1)
+                    
+                    cursor.execute(f"""
+                        SELECT 
+                            id, nome, telefone, pacote, valor, servidor, vencimento,
+                            (vencimento - CURRENT_DATE) as dias_vencimento
+                        FROM clientes 
+                        WHERE {" AND ".join(where_conditions)}
+                        ORDER BY vencimento {ordem}, nome {ordem}, id {ordem}
+                        LIMIT %s
+                    """, params)
+                    
+                    clientes = [dict(cliente) for cliente in cursor.fetchall()]
+                    ha_mais = len(clientes) > limite
+                    clientes = clientes[:limite]
+                    
+                    if voltando:
+                        clientes.reverse()
+                        return {'clientes': clientes, 'tem_anterior': ha_mais, 'tem_proxima': True}
+                    return {'clientes': clientes, 'tem_anterior': apos_id is not None, 'tem_proxima': ha_mais}
+                    
+        except Exception as e:
+            logger.error(f"Erro ao listar página de clientes: {e}")
+            raise
+    
+    def resumo_clientes(self, chat_id_usuario):
+        """Contadores e totais por situação de vencimento em uma única consulta"""
+        cache_key = f"resumo_clientes_{chat_id_usuario}"
+        cached = self._get_cache(cache_key)
+        if cached is not None:
+            return cached
+        
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                    cursor.execute(f"""
+                        SELECT 
+                            COUNT(*) as total,
+                            COUNT(*) FILTER (WHERE {self.FILTROS_VENCIMENTO['emdia']}) as em_dia,
+                            COUNT(*) FILTER (WHERE {self.FILTROS_VENCIMENTO['vencendo']}) as vencendo,
+                            COUNT(*) FILTER (WHERE {self.FILTROS_VENCIMENTO['vencidos']}) as vencidos,
+                            COALESCE(SUM(valor), 0) as total_previsto,
+                            COALESCE(SUM(valor) FILTER (WHERE {self.FILTROS_VENCIMENTO['emdia']}), 0) as total_em_dia,
+                            COALESCE(SUM(valor) FILTER (WHERE {self.FILTROS_VENCIMENTO['vencidos']}), 0) as total_vencidos
+                        FROM clientes
+                        WHERE ativo = TRUE AND chat_id_usuario = %s
+                    """, (chat_id_usuario,))
+                    
+                    resumo = dict(cursor.fetchone())
+                    self._set_cache(cache_key, resumo)
+                    return resumo
+                    
+        except Exception as e:
+            logger.error(f"Erro ao obter resumo de clientes: {e}")
+            raise
+    
     def invalidate_cache(self, pattern=None):
         """Invalida cache específico ou todos"""
-        if pattern:
-            keys_to_remove = [k for k in self._cache.keys() if pattern in k]
-            for key in keys_to_remove:
-                if key in self._cache:
-                    del self._cache[key]
-                if key in self._cache_ttl:
-                    del self._cache_ttl[key]
-        else:
-            self._cache.clear()
-            self._cache_ttl.clear()
+        with self._cache_lock:
+            if pattern:
+                keys_to_remove = [k for k in list(self._cache_ttl) if pattern in k]
+                for key in keys_to_remove:
+                    self._cache.pop(key, None)
+                    self._cache_ttl.pop(key, None)
+            else:
+                self._cache.clear()
+                self._cache_ttl.clear()
     
     def buscar_cliente_por_id(self, cliente_id, chat_id_usuario=None):
         """Busca cliente por ID - ISOLADO POR USUÁRIO"""
@@ -1012,15 +1357,18 @@ _Obrigado por escolher nossos serviços!_ ✨""",
                         UPDATE clientes 
                         SET vencimento = %s, data_atualizacao = CURRENT_TIMESTAMP
                         WHERE id = %s AND ativo = TRUE
+                        RETURNING chat_id_usuario
                     """, (novo_vencimento, cliente_id))
                     
-                    if cursor.rowcount == 0:
+                    atualizado = cursor.fetchone()
+                    if atualizado is None:
                         raise ValueError("Cliente não encontrado ou inativo")
                     
                     conn.commit()
                     
                     # CRÍTICO: Invalidar cache da lista de clientes para atualização imediata
                     self.invalidate_cache('clientes_')
+                    self.marcar_metricas_pendentes(atualizado[0])
                     logger.info(f"Cache de clientes invalidado após renovação")
                     logger.info(f"Vencimento atualizado para cliente ID {cliente_id}: {novo_vencimento}")
                     
@@ -1080,6 +1428,7 @@ _Obrigado por escolher nossos serviços!_ ✨""",
                     
                     # Invalidar cache relacionado ao usuário
                     self.invalidate_cache(f"clientes_{chat_id_usuario}")
+                    self.marcar_metricas_pendentes(chat_id_usuario)
                     
                     logger.info(f"Cliente ID {cliente_id} excluído definitivamente pelo usuário {chat_id_usuario}")
                     
@@ -1188,15 +1537,19 @@ _Obrigado por escolher nossos serviços!_ ✨""",
                         UPDATE clientes 
                         SET {', '.join(campos)}
                         WHERE id = %s
+                        RETURNING chat_id_usuario
                     """
                     
                     cursor.execute(query, valores)
+                    atualizado = cursor.fetchone()
                     conn.commit()
                     
                     # Invalidar cache para garantir que listas sejam atualizadas
                     self.invalidate_cache("clientes")
+                    if atualizado is not None:
+                        self.marcar_metricas_pendentes(atualizado[0])
                     
-                    return cursor.rowcount > 0
+                    return atualizado is not None
                     
         except Exception as e:
             logger.error(f"Erro ao atualizar cliente: {e}")
@@ -1386,8 +1739,12 @@ _Obrigado por escolher nossos serviços!_ ✨""",
                         ORDER BY nome ASC
                     """, params)
                     
-                    templates = cursor.fetchall()
-                    return [dict(template) for template in templates]
+                    templates = [dict(template) for template in cursor.fetchall()]
+                    pendentes = self.uso_templates_pendente()
+                    if pendentes:
+                        for template in templates:
+                            template['uso_count'] = (template.get('uso_count') or 0) + pendentes.get(template['id'], 0)
+                    return templates
                     
         except Exception as e:
             logger.error(f"Erro ao listar templates: {e}")
@@ -1409,7 +1766,7 @@ _Obrigado por escolher nossos serviços!_ ✨""",
                     where_clause = " AND ".join(where_conditions)
                     
                     cursor.execute(f"""
-                        SELECT id, nome, descricao, conteudo, tipo, ativo, uso_count, chat_id_usuario
+                        SELECT id, nome, descricao, conteudo, tipo, ativo, uso_count, chat_id_usuario, data_atualizacao
                         FROM templates 
                         WHERE {where_clause}
                     """, params)
@@ -1423,29 +1780,50 @@ _Obrigado por escolher nossos serviços!_ ✨""",
     
     def obter_template_por_tipo(self, tipo, chat_id_usuario=None):
         """Obtém template por tipo com isolamento por usuário - CRÍTICO: Nunca retornar templates de sistema (chat_id_usuario = NULL)"""
+        # PROTEÇÃO CRÍTICA: Se não especificar usuário, NÃO retornar templates do sistema
+        if chat_id_usuario is None:
+            logger.warning(f"Tentativa de obter template '{tipo}' sem especificar usuário - operação negada para proteção")
+            return None
+        
+        template = self.templates_ativos_por_tipo(chat_id_usuario).get(tipo)
+        return dict(template) if template else None
+    
+    def templates_ativos_por_tipo(self, chat_id_usuario):
+        """Mapa tipo -> template ativo mais recente do usuário (uma consulta, em cache)
+        
+        Invalidado por criar/atualizar/excluir template.
+        """
+        cache_key = f"templates_tipo_{chat_id_usuario}"
+        cached_result = self._get_cache(cache_key)
+        if cached_result is not None:
+            return cached_result
+        
         try:
-            # PROTEÇÃO CRÍTICA: Se não especificar usuário, NÃO retornar templates do sistema
-            if chat_id_usuario is None:
-                logger.warning(f"Tentativa de obter template '{tipo}' sem especificar usuário - operação negada para proteção")
-                return None
-                
             with self.get_connection() as conn:
                 with conn.cursor(cursor_factory=RealDictCursor) as cursor:
                     cursor.execute("""
-                        SELECT id, nome, descricao, conteudo, tipo, ativo, uso_count, chat_id_usuario
+                        SELECT DISTINCT ON (tipo)
+                               id, nome, descricao, conteudo, tipo, ativo, uso_count, chat_id_usuario, data_atualizacao
                         FROM templates 
-                        WHERE tipo = %s AND ativo = TRUE AND chat_id_usuario = %s
-                        ORDER BY data_criacao DESC
-                        LIMIT 1
-                    """, (tipo, chat_id_usuario))
+                        WHERE ativo = TRUE AND chat_id_usuario = %s
+                        ORDER BY tipo, data_criacao DESC
+                    """, (chat_id_usuario,))
                     
-                    template = cursor.fetchone()
-                    return dict(template) if template else None
+                    por_tipo = {template['tipo']: dict(template) for template in cursor.fetchall()}
+                    self._set_cache(cache_key, por_tipo)
+                    return por_tipo
                     
         except Exception as e:
             logger.error(f"Erro ao obter template por tipo: {e}")
             raise
     
+    def invalidar_templates(self, chat_id_usuario=None):
+        """Descarta cache de templates por tipo (sem usuário, de todos)"""
+        if chat_id_usuario is None:
+            self.invalidate_cache("templates_tipo_")
+        else:
+            self.invalidate_cache(f"templates_tipo_{chat_id_usuario}")
+    
     def buscar_template_por_id(self, template_id, chat_id_usuario=None):
         """Busca template por ID (alias para compatibilidade)"""
         return self.obter_template(template_id, chat_id_usuario)
@@ -1491,6 +1869,7 @@ _Obrigado por escolher nossos serviços!_ ✨""",
                         raise ValueError("Template não pôde ser excluído")
                     
                     conn.commit()
+                    self.invalidar_templates(chat_id_usuario)
                     logger.info(f"Template ID {template_id} excluído definitivamente por usuário {chat_id_usuario}")
                     
         except Exception as e:
@@ -1510,6 +1889,7 @@ _Obrigado por escolher nossos serviços!_ ✨""",
                     
                     template_id = cursor.fetchone()[0]
                     conn.commit()
+                    self.invalidar_templates(chat_id_usuario)
                     
                     logger.info(f"Template criado: ID {template_id}, Nome: {nome}, Usuário: {chat_id_usuario}")
                     return template_id
@@ -1562,6 +1942,7 @@ _Obrigado por escolher nossos serviços!_ ✨""",
                     
                     cursor.execute(query, valores)
                     conn.commit()
+                    self.invalidar_templates(chat_id_usuario)
                     
                     return cursor.rowcount > 0
                     
@@ -1596,6 +1977,7 @@ _Obrigado por escolher nossos serviços!_ ✨""",
                     
                     cursor.execute(query, params)
                     conn.commit()
+                    self.invalidar_templates(chat_id_usuario)
                     
                     if cursor.rowcount == 0:
                         logger.warning(f"Template ID {template_id} não encontrado para atualização ou não pertence ao usuário {chat_id_usuario}")
@@ -1609,19 +1991,60 @@ _Obrigado por escolher nossos serviços!_ ✨""",
             raise
     
     def incrementar_uso_template(self, template_id):
-        """Incrementa contador de uso do template"""
+        """Incrementa contador de uso do template
+        
+        Só acumula em memória; os deltas são gravados em lote periodicamente e
+        no encerramento, sem disputar o lock da linha do template a cada envio.
+        """
+        if not template_id:
+            return
+        with self._uso_templates_lock:
+            self._uso_templates[template_id] += 1
+            if self._uso_templates_thread is None:
+                self._uso_templates_thread = threading.Thread(
+                    target=self._loop_uso_templates, name='uso-templates', daemon=True
+                )
+                self._uso_templates_thread.start()
+    
+    def _loop_uso_templates(self):
+        """Grava os contadores acumulados a cada TEMPLATE_USO_FLUSH_INTERVALO segundos"""
+        import time
+        while True:
+            time.sleep(self._uso_templates_intervalo)
+            self.gravar_uso_templates()
+    
+    def gravar_uso_templates(self):
+        """Aplica os deltas de uso pendentes em um único UPDATE; retorna templates atualizados"""
+        with self._uso_templates_lock:
+            pendentes, self._uso_templates = self._uso_templates, Counter()
+        if not pendentes:
+            return 0
+        
         try:
             with self.get_connection() as conn:
                 with conn.cursor() as cursor:
-                    cursor.execute("""
-                        UPDATE templates 
-                        SET uso_count = uso_count + 1
-                        WHERE id = %s
-                    """, (template_id,))
+                    valores = ", ".join(["(%s, %s)"] * len(pendentes))
+                    params = [item for par in sorted(pendentes.items()) for item in par]
+                    cursor.execute(f"""
+                        UPDATE templates t
+                        SET uso_count = COALESCE(t.uso_count, 0) + d.delta
+                        FROM (VALUES {valores}) AS d(id, delta)
+                        WHERE t.id = d.id
+                    """, params)
                     conn.commit()
+            return len(pendentes)
                     
         except Exception as e:
-            logger.error(f"Erro ao incrementar uso do template: {e}")
+            # Devolver os deltas para a próxima tentativa
+            with self._uso_templates_lock:
+                self._uso_templates.update(pendentes)
+            logger.error(f"Erro ao gravar uso dos templates: {e}")
+            return 0
+    
+    def uso_templates_pendente(self):
+        """Deltas de uso ainda não gravados (template_id -> quantidade)"""
+        with self._uso_templates_lock:
+            return dict(self._uso_templates)
     
     # === MÉTODOS DE LOGS ===
     
@@ -1633,13 +2056,28 @@ _Obrigado por escolher nossos serviços!_ ✨""",
             
         try:
             with self.get_connection() as conn:
+                # Corpo e log na mesma transação: a limpeza de órfãos nunca vê um sem o outro
+                conn.autocommit = False
                 with conn.cursor() as cursor:
+                    mensagem_hash = None
+                    if self.logs_mensagem_deduplicada and mensagem:
+                        mensagem_hash, conteudo, compactado = compactar_mensagem(mensagem)
+                        # Renovar data_criacao tira o corpo reaproveitado da janela da limpeza
+                        cursor.execute("""
+                            INSERT INTO mensagens_envio (hash, conteudo, compactado)
+                            VALUES (%s, %s, %s)
+                            ON CONFLICT (hash) DO UPDATE SET data_criacao = CURRENT_TIMESTAMP
+                        """, (mensagem_hash, conteudo, compactado))
+                        mensagem = None
+                    
                     cursor.execute("""
                         INSERT INTO logs_envio 
-                        (chat_id_usuario, cliente_id, template_id, telefone, mensagem, tipo_envio, sucesso, erro, message_id)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                        (chat_id_usuario, cliente_id, template_id, telefone, mensagem, mensagem_hash,
+                         tipo_envio, sucesso, erro, message_id)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
                         RETURNING id
-                    """, (chat_id_usuario, cliente_id, template_id, telefone, mensagem, tipo_envio, sucesso, erro, message_id))
+                    """, (chat_id_usuario, cliente_id, template_id, telefone, mensagem, mensagem_hash,
+                          tipo_envio, sucesso, erro, message_id))
                     
                     log_id = cursor.fetchone()[0]
                     conn.commit()
@@ -1647,6 +2085,7 @@ _Obrigado por escolher nossos serviços!_ ✨""",
                     # Incrementar contador do template se enviado com sucesso
                     if sucesso and template_id:
                         self.incrementar_uso_template(template_id)
+                    self.marcar_metricas_pendentes(chat_id_usuario)
                     
                     return log_id
                     
@@ -1694,26 +2133,65 @@ _Obrigado por escolher nossos serviços!_ ✨""",
                             l.id, l.chat_id_usuario, l.cliente_id, l.template_id, l.telefone, l.mensagem,
                             l.tipo_envio, l.sucesso, l.erro, l.message_id, l.data_envio,
                             c.nome as cliente_nome,
-                            t.nome as template_nome
+                            t.nome as template_nome,
+                            m.conteudo as mensagem_conteudo, m.compactado as mensagem_compactada
                         FROM logs_envio l
                         LEFT JOIN clientes c ON l.cliente_id = c.id
                         LEFT JOIN templates t ON l.template_id = t.id
+                        LEFT JOIN mensagens_envio m ON m.hash = l.mensagem_hash
                         {where_clause}
                         ORDER BY l.data_envio DESC
                         {'LIMIT %s' if limit else ''}
                     """, params)
                     
-                    logs = cursor.fetchall()
-                    return [dict(log) for log in logs]
+                    return [self._restaurar_mensagem_log(dict(log)) for log in cursor.fetchall()]
                     
         except Exception as e:
             logger.error(f"Erro ao obter logs: {e}")
             raise
     
+    def _restaurar_mensagem_log(self, log):
+        """Reconstrói o texto do log a partir do corpo deduplicado (logs antigos já têm o texto)"""
+        conteudo = log.pop('mensagem_conteudo', None)
+        compactado = log.pop('mensagem_compactada', None)
+        if log.get('mensagem') is None and conteudo is not None:
+            try:
+                log['mensagem'] = descompactar_mensagem(conteudo, compactado)
+            except Exception as e:
+                logger.error(f"Erro ao descompactar mensagem do log {log.get('id')}: {e}")
+        return log
+    
+    def limpar_mensagens_orfas(self, horas=24):
+        """Remove corpos de mensagem que nenhum log referencia mais"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        DELETE FROM mensagens_envio m
+                        WHERE m.data_criacao < CURRENT_TIMESTAMP - (%s * INTERVAL '1 hour')
+                        AND NOT EXISTS (SELECT 1 FROM logs_envio l WHERE l.mensagem_hash = m.hash)
+                    """, (horas,))
+                    
+                    removidas = cursor.rowcount
+                    conn.commit()
+                    
+                    if removidas:
+                        logger.info(f"🧹 Removidos {removidas} corpos de mensagem sem log")
+                    return removidas
+                    
+        except Exception as e:
+            logger.error(f"Erro ao limpar corpos de mensagem: {e}")
+            return 0
+    
     # === MÉTODOS DE FILA DE MENSAGENS ===
     
-    def adicionar_fila_mensagem(self, cliente_id, template_id, telefone, mensagem, tipo_mensagem, agendado_para, chat_id_usuario):
-        """Adiciona mensagem na fila de envio com isolamento por usuário"""
+    def adicionar_fila_mensagem(self, cliente_id, template_id, telefone, mensagem, tipo_mensagem, agendado_para, chat_id_usuario,
+                                contexto_versao=None):
+        """Adiciona mensagem na fila de envio com isolamento por usuário
+        
+        Com mensagem None, o texto é renderizado no envio a partir de template_id e
+        cliente_id; contexto_versao registra a versão do contexto de render usada.
+        """
         # SEGURANÇA: chat_id_usuario é obrigatório para isolamento
         if chat_id_usuario is None:
             raise ValueError("chat_id_usuario é obrigatório para isolamento de fila")
@@ -1723,10 +2201,12 @@ _Obrigado por escolher nossos serviços!_ ✨""",
                 with conn.cursor() as cursor:
                     cursor.execute("""
                         INSERT INTO fila_mensagens 
-                        (chat_id_usuario, cliente_id, template_id, telefone, mensagem, tipo_mensagem, agendado_para)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s)
+                        (chat_id_usuario, cliente_id, template_id, telefone, mensagem, tipo_mensagem, agendado_para,
+                         contexto_versao)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
                         RETURNING id
-                    """, (chat_id_usuario, cliente_id, template_id, telefone, mensagem, tipo_mensagem, agendado_para))
+                    """, (chat_id_usuario, cliente_id, template_id, telefone, mensagem, tipo_mensagem, agendado_para,
+                          contexto_versao))
                     
                     fila_id = cursor.fetchone()[0]
                     conn.commit()
@@ -1738,6 +2218,75 @@ _Obrigado por escolher nossos serviços!_ ✨""",
             logger.error(f"Erro ao adicionar mensagem na fila: {e}")
             raise
     
+    def adicionar_envio_prioritario(self, cliente_id, template_id, telefone, mensagem, tipo_mensagem,
+                                    chat_id_usuario, reserva_minutos=10):
+        """Registra envio imediato na fila com prioridade máxima
+        
+        agendado_para fica reservado por alguns minutos: o envio é feito pelo worker
+        imediato e o dispatcher só o assume se o worker não concluir (ex.: reinício).
+        """
+        if chat_id_usuario is None:
+            raise ValueError("chat_id_usuario é obrigatório para isolamento de fila")
+        
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        INSERT INTO fila_mensagens 
+                        (chat_id_usuario, cliente_id, template_id, telefone, mensagem, tipo_mensagem,
+                         agendado_para, prioridade)
+                        VALUES (%s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP + %s * INTERVAL '1 minute', 0)
+                        RETURNING id
+                    """, (chat_id_usuario, cliente_id, template_id, telefone, mensagem, tipo_mensagem, reserva_minutos))
+                    
+                    fila_id = cursor.fetchone()[0]
+                    conn.commit()
+                    return fila_id
+                    
+        except Exception as e:
+            logger.error(f"Erro ao adicionar envio prioritário: {e}")
+            raise
+    
+    def priorizar_mensagens_fila(self, fila_ids=None, cliente_id=None, chat_id_usuario=None, reserva_minutos=10):
+        """Reserva mensagens pendentes para envio imediato e retorna seus dados
+        
+        Seleciona por ids ou por cliente; só mensagens ainda não processadas.
+        """
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                    where_conditions = ["processado = FALSE"]
+                    params = [reserva_minutos]
+                    
+                    if fila_ids is not None:
+                        where_conditions.append("id = ANY(%s)")
+                        params.append(list(fila_ids))
+                    if cliente_id is not None:
+                        where_conditions.append("cliente_id = %s")
+                        params.append(cliente_id)
+                    
+                    # CRÍTICO: Filtrar por usuário para isolamento
+                    if chat_id_usuario is not None:
+                        where_conditions.append("chat_id_usuario = %s")
+                        params.append(chat_id_usuario)
+                    
+                    cursor.execute(f"""
+                        UPDATE fila_mensagens
+                        SET prioridade = 0,
+                            agendado_para = CURRENT_TIMESTAMP + %s * INTERVAL '1 minute'
+                        WHERE {" AND ".join(where_conditions)}
+                        RETURNING id, chat_id_usuario, cliente_id, template_id, telefone, mensagem,
+                                  contexto_versao, tipo_mensagem, tentativas, max_tentativas
+                    """, params)
+                    
+                    mensagens = [dict(msg) for msg in cursor.fetchall()]
+                    conn.commit()
+                    return mensagens
+                    
+        except Exception as e:
+            logger.error(f"Erro ao priorizar mensagens da fila: {e}")
+            raise
+    
     def obter_mensagens_pendentes(self, limit=100, chat_id_usuario=None):
         """Obtém mensagens pendentes para envio com isolamento por usuário"""
         try:
@@ -1760,12 +2309,12 @@ _Obrigado por escolher nossos serviços!_ ✨""",
                     cursor.execute(f"""
                         SELECT 
                             f.id, f.chat_id_usuario, f.cliente_id, f.template_id, f.telefone, f.mensagem,
-                            f.tipo_mensagem, f.agendado_para, f.tentativas, f.max_tentativas,
+                            f.contexto_versao, f.tipo_mensagem, f.agendado_para, f.tentativas, f.max_tentativas,
                             c.nome as cliente_nome
                         FROM fila_mensagens f
                         LEFT JOIN clientes c ON f.cliente_id = c.id
                         WHERE {where_clause}
-                        ORDER BY f.agendado_para ASC
+                        ORDER BY f.prioridade ASC, f.agendado_para ASC
                         LIMIT %s
                     """, params)
                     
@@ -1855,93 +2404,331 @@ _Obrigado por escolher nossos serviços!_ ✨""",
     
     # === MÉTODOS DE ESTATÍSTICAS ===
     
-    def obter_estatisticas(self):
-        """Obtém estatísticas gerais do sistema"""
+    def obter_estatisticas(self, chat_id_usuario=None):
+        """Obtém estatísticas gerais (ou de um usuário) em uma única consulta
+        
+        Resultado em cache por ESTATISTICAS_CACHE_TTL segundos (padrão 30).
+        """
+        cache_key = f"estatisticas_{chat_id_usuario}"
+        cached = self._get_cache(cache_key)
+        if cached is not None:
+            return cached
+        
+        filtro_usuario = "AND chat_id_usuario = %(chat_id_usuario)s" if chat_id_usuario is not None else ""
+        
         try:
             with self.get_connection() as conn:
-                with conn.cursor() as cursor:
-                    stats = {}
-                    
-                    # Total de clientes ativos
-                    cursor.execute("SELECT COUNT(*) FROM clientes WHERE ativo = TRUE")
-                    stats['total_clientes'] = cursor.fetchone()[0]
-                    
-                    # Novos clientes este mês
-                    cursor.execute("""
-                        SELECT COUNT(*) FROM clientes 
-                        WHERE ativo = TRUE 
-                        AND data_cadastro >= date_trunc('month', CURRENT_DATE)
-                    """)
-                    stats['novos_mes'] = cursor.fetchone()[0]
-                    
-                    # Receita mensal
-                    cursor.execute("""
-                        SELECT COALESCE(SUM(valor), 0) FROM clientes 
-                        WHERE ativo = TRUE
-                    """)
-                    stats['receita_mensal'] = float(cursor.fetchone()[0])
+                with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                    cursor.execute(f"""
+                        SELECT c.*, l.mensagens_hoje, f.fila_mensagens, t.total_templates,
+                               (SELECT nome FROM templates
+                                WHERE ativo = TRUE {filtro_usuario}
+                                ORDER BY uso_count DESC
+                                LIMIT 1) AS template_mais_usado
+                        FROM (
+                            SELECT COUNT(*) AS total_clientes,
+                                   COUNT(*) FILTER (WHERE data_cadastro >= date_trunc('month', CURRENT_DATE)) AS novos_mes,
+                                   COALESCE(SUM(valor), 0) AS receita_mensal,
+                                   COUNT(*) FILTER (WHERE vencimento < CURRENT_DATE) AS vencidos,
+                                   COUNT(*) FILTER (WHERE vencimento = CURRENT_DATE) AS vencem_hoje,
+                                   COUNT(*) FILTER (WHERE vencimento BETWEEN CURRENT_DATE + 1
+                                                    AND CURRENT_DATE + 3) AS vencem_3dias,
+                                   COUNT(*) FILTER (WHERE vencimento BETWEEN CURRENT_DATE
+                                                    AND CURRENT_DATE + 7) AS vencem_semana
+                            FROM clientes
+                            WHERE ativo = TRUE {filtro_usuario}
+                        ) c,
+                        (
+                            SELECT COUNT(*) AS mensagens_hoje FROM logs_envio
+                            WHERE data_envio >= CURRENT_DATE AND data_envio < CURRENT_DATE + 1 {filtro_usuario}
+                        ) l,
+                        (
+                            SELECT COUNT(*) AS fila_mensagens FROM fila_mensagens
+                            WHERE processado = FALSE {filtro_usuario}
+                        ) f,
+                        (
+                            SELECT COUNT(*) AS total_templates FROM templates
+                            WHERE ativo = TRUE {filtro_usuario}
+                        ) t
+                    """, {'chat_id_usuario': chat_id_usuario})
+                    
+                    stats = dict(cursor.fetchone())
+                    stats['receita_mensal'] = float(stats['receita_mensal'])
                     stats['receita_anual'] = stats['receita_mensal'] * 12
+                    stats['template_mais_usado'] = stats['template_mais_usado'] or 'Nenhum'
+                    self._set_cache(cache_key, stats, ttl=self._estatisticas_ttl)
+                    return stats
                     
-                    # Vencimentos
-                    cursor.execute("""
-                        SELECT COUNT(*) FROM clientes 
-                        WHERE ativo = TRUE AND vencimento < CURRENT_DATE
-                    """)
-                    stats['vencidos'] = cursor.fetchone()[0]
-                    
-                    cursor.execute("""
-                        SELECT COUNT(*) FROM clientes 
-                        WHERE ativo = TRUE AND vencimento = CURRENT_DATE
-                    """)
-                    stats['vencem_hoje'] = cursor.fetchone()[0]
+        except Exception as e:
+            logger.error(f"Erro ao obter estatísticas: {e}")
+            raise
+    
+    def obter_estatisticas_usuario(self, chat_id_usuario):
+        """Estatísticas apenas dos dados do usuário"""
+        if chat_id_usuario is None:
+            raise ValueError("chat_id_usuario é obrigatório para isolamento de estatísticas")
+        return self.obter_estatisticas(chat_id_usuario=chat_id_usuario)
+    
+    # === MÉTODOS DE RELATÓRIOS ===
+    
+    def resumo_clientes_relatorio(self, chat_id_usuario=None, novos_desde=None, novos_ate=None, hoje=None):
+        """Agregados de clientes para os relatórios em uma única consulta
+        
+        Novos = cadastrados em [novos_desde, novos_ate) (sem novos_ate, até agora).
+        Sem chat_id_usuario, considera todos os usuários (admin).
+        """
+        hoje = hoje or agora_br().date()
+        condicoes_novos = ["FALSE"]
+        params = {'hoje': hoje, 'desde': novos_desde, 'ate': novos_ate, 'chat_id_usuario': chat_id_usuario}
+        if novos_desde is not None:
+            condicoes_novos = ["data_cadastro >= %(desde)s"]
+            if novos_ate is not None:
+                condicoes_novos.append("data_cadastro < %(ate)s")
+        novos = " AND ".join(condicoes_novos)
+        where_clause = "WHERE chat_id_usuario = %(chat_id_usuario)s" if chat_id_usuario is not None else ""
+        
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                    cursor.execute(f"""
+                        SELECT
+                            COUNT(*) FILTER (WHERE ativo) AS ativos,
+                            COALESCE(SUM(valor) FILTER (WHERE ativo), 0) AS receita_ativos,
+                            COUNT(*) FILTER (WHERE ativo AND vencimento >= %(hoje)s) AS em_dia,
+                            COALESCE(SUM(valor) FILTER (WHERE ativo AND vencimento >= %(hoje)s), 0) AS receita_em_dia,
+                            COUNT(*) FILTER (WHERE ativo AND vencimento BETWEEN %(hoje)s
+                                             AND %(hoje)s + INTERVAL '30 days') AS vencem_30_dias,
+                            COUNT(*) FILTER (WHERE ativo AND valor <= 30) AS faixa_economica,
+                            COUNT(*) FILTER (WHERE ativo AND valor > 30 AND valor <= 60) AS faixa_padrao,
+                            COUNT(*) FILTER (WHERE ativo AND valor > 60) AS faixa_premium,
+                            COUNT(*) FILTER (WHERE {novos}) AS novos,
+                            COALESCE(SUM(valor) FILTER (WHERE ativo AND {novos}), 0) AS receita_novos
+                        FROM clientes
+                        {where_clause}
+                    """, params)
                     
-                    cursor.execute("""
-                        SELECT COUNT(*) FROM clientes 
-                        WHERE ativo = TRUE 
-                        AND vencimento BETWEEN CURRENT_DATE + INTERVAL '1 day' 
-                        AND CURRENT_DATE + INTERVAL '3 days'
-                    """)
-                    stats['vencem_3dias'] = cursor.fetchone()[0]
+                    resumo = dict(cursor.fetchone())
+                    for chave in ('receita_ativos', 'receita_em_dia', 'receita_novos'):
+                        resumo[chave] = float(resumo[chave])
+                    return resumo
                     
-                    cursor.execute("""
-                        SELECT COUNT(*) FROM clientes 
-                        WHERE ativo = TRUE 
-                        AND vencimento BETWEEN CURRENT_DATE 
-                        AND CURRENT_DATE + INTERVAL '7 days'
-                    """)
-                    stats['vencem_semana'] = cursor.fetchone()[0]
+        except Exception as e:
+            logger.error(f"Erro ao obter resumo de clientes para relatório: {e}")
+            raise
+    
+    def novos_clientes_por_intervalo(self, inicio, dias_por_intervalo, intervalos, chat_id_usuario=None):
+        """Cadastros por intervalo de N dias a partir de inicio (lista com um total por intervalo)
+        
+        Lê metricas_diarias: custo proporcional ao número de dias, não de clientes.
+        """
+        where_conditions = ["dia >= %(inicio)s", "dia < %(inicio)s::date + %(dias_total)s"]
+        if chat_id_usuario is not None:
+            where_conditions.append("chat_id_usuario = %(chat_id_usuario)s")
+        params = {
+            'inicio': inicio,
+            'dias': dias_por_intervalo,
+            'dias_total': dias_por_intervalo * intervalos,
+            'chat_id_usuario': chat_id_usuario,
+        }
+        
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(f"""
+                        SELECT (dia - %(inicio)s::date) / %(dias)s AS intervalo, SUM(novos_clientes)
+                        FROM metricas_diarias
+                        WHERE {" AND ".join(where_conditions)}
+                        GROUP BY 1
+                    """, params)
                     
-                    # Mensagens hoje
-                    cursor.execute("""
-                        SELECT COUNT(*) FROM logs_envio 
-                        WHERE DATE(data_envio) = CURRENT_DATE
-                    """)
-                    stats['mensagens_hoje'] = cursor.fetchone()[0]
+                    totais = [0] * intervalos
+                    for intervalo, total in cursor.fetchall():
+                        totais[intervalo] = int(total)
+                    return totais
                     
-                    # Fila de mensagens
-                    cursor.execute("""
-                        SELECT COUNT(*) FROM fila_mensagens 
-                        WHERE processado = FALSE
-                    """)
-                    stats['fila_mensagens'] = cursor.fetchone()[0]
+        except Exception as e:
+            logger.error(f"Erro ao obter novos clientes por intervalo: {e}")
+            raise
+    
+    # === MÉTODOS DE MÉTRICAS DIÁRIAS ===
+    
+    def _consolidar_metricas(self, cursor, desde, ate, chat_ids=None):
+        """Recalcula metricas_diarias de [desde, ate] a partir de clientes e logs_envio
+        
+        Colunas de situação (ativos, receita, vencidos) refletem os clientes no momento
+        do cálculo; novos clientes e mensagens são contados pelo dia do evento.
+        """
+        filtro_clientes = filtro_logs = ""
+        if chat_ids is not None:
+            filtro_clientes = "AND c.chat_id_usuario = ANY(%(chat_ids)s)"
+            filtro_logs = "AND l.chat_id_usuario = ANY(%(chat_ids)s)"
+        
+        cursor.execute(f"""
+            WITH dias AS (
+                SELECT generate_series(%(desde)s::date, %(ate)s::date, INTERVAL '1 day')::date AS dia
+            ),
+            clientes_dia AS (
+                SELECT c.chat_id_usuario, d.dia,
+                       COUNT(*) FILTER (WHERE c.ativo AND c.data_cadastro < d.dia + 1) AS clientes_ativos,
+                       COUNT(*) FILTER (WHERE c.data_cadastro >= d.dia AND c.data_cadastro < d.dia + 1) AS novos_clientes,
+                       COALESCE(SUM(c.valor) FILTER (WHERE c.ativo AND c.data_cadastro < d.dia + 1), 0) AS receita,
+                       COUNT(*) FILTER (WHERE c.ativo AND c.data_cadastro < d.dia + 1
+                                        AND c.vencimento < d.dia) AS vencidos,
+                       COUNT(*) FILTER (WHERE c.ativo AND c.data_cadastro < d.dia + 1
+                                        AND c.vencimento BETWEEN d.dia AND d.dia + 7) AS vencem_7_dias
+                FROM dias d
+                CROSS JOIN clientes c
+                WHERE c.chat_id_usuario IS NOT NULL {filtro_clientes}
+                GROUP BY c.chat_id_usuario, d.dia
+            ),
+            envios_dia AS (
+                SELECT l.chat_id_usuario, l.data_envio::date AS dia,
+                       COUNT(*) FILTER (WHERE l.sucesso) AS mensagens_enviadas,
+                       COUNT(*) FILTER (WHERE NOT l.sucesso) AS mensagens_falhas
+                FROM logs_envio l
+                WHERE l.data_envio >= %(desde)s::date AND l.data_envio < %(ate)s::date + 1
+                AND l.chat_id_usuario IS NOT NULL {filtro_logs}
+                GROUP BY l.chat_id_usuario, l.data_envio::date
+            )
+            INSERT INTO metricas_diarias
+                (chat_id_usuario, dia, clientes_ativos, novos_clientes, receita, vencidos, vencem_7_dias,
+                 mensagens_enviadas, mensagens_falhas, data_atualizacao)
+            SELECT COALESCE(c.chat_id_usuario, e.chat_id_usuario), COALESCE(c.dia, e.dia),
+                   COALESCE(c.clientes_ativos, 0), COALESCE(c.novos_clientes, 0), COALESCE(c.receita, 0),
+                   COALESCE(c.vencidos, 0), COALESCE(c.vencem_7_dias, 0),
+                   COALESCE(e.mensagens_enviadas, 0), COALESCE(e.mensagens_falhas, 0), CURRENT_TIMESTAMP
+            FROM clientes_dia c
+            FULL OUTER JOIN envios_dia e ON e.chat_id_usuario = c.chat_id_usuario AND e.dia = c.dia
+            ON CONFLICT (chat_id_usuario, dia) DO UPDATE SET
+                clientes_ativos = EXCLUDED.clientes_ativos,
+                novos_clientes = EXCLUDED.novos_clientes,
+                receita = EXCLUDED.receita,
+                vencidos = EXCLUDED.vencidos,
+                vencem_7_dias = EXCLUDED.vencem_7_dias,
+                mensagens_enviadas = EXCLUDED.mensagens_enviadas,
+                mensagens_falhas = EXCLUDED.mensagens_falhas,
+                data_atualizacao = EXCLUDED.data_atualizacao
+        """, {'desde': desde, 'ate': ate, 'chat_ids': list(chat_ids) if chat_ids is not None else None})
+        return cursor.rowcount
+    
+    def atualizar_metricas_diarias(self, desde=None, ate=None, chat_ids=None):
+        """Consolida as métricas do período (padrão: hoje) para os usuários informados ou todos"""
+        ate = ate or agora_br().date()
+        desde = desde or ate
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    linhas = self._consolidar_metricas(cursor, desde, ate, chat_ids)
+                    conn.commit()
+            self.invalidate_cache("metricas_")
+            return linhas
                     
-                    # Templates
-                    cursor.execute("SELECT COUNT(*) FROM templates WHERE ativo = TRUE")
-                    stats['total_templates'] = cursor.fetchone()[0]
+        except Exception as e:
+            logger.error(f"Erro ao consolidar métricas diárias: {e}")
+            raise
+    
+    def atualizar_metricas_desde_ultima(self, dias_maximo=90):
+        """Consolida do último dia já consolidado (inclusive) até hoje, para todos os usuários
+        
+        Recupera dias perdidos com o processo parado; sem histórico, volta dias_maximo dias.
+        """
+        hoje = agora_br().date()
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT MAX(dia) FROM metricas_diarias WHERE dia <= %s", (hoje,))
+                    ultimo = cursor.fetchone()[0]
+        except Exception as e:
+            logger.error(f"Erro ao obter último dia de métricas: {e}")
+            raise
+        
+        limite = hoje - timedelta(days=dias_maximo)
+        desde = max(ultimo, limite) if ultimo else limite
+        return self.atualizar_metricas_diarias(desde=desde, ate=hoje)
+    
+    def marcar_metricas_pendentes(self, chat_id_usuario=None):
+        """Registra que as métricas de hoje do usuário (None = todos) mudaram"""
+        with self._metricas_lock:
+            self._metricas_pendentes.add(chat_id_usuario)
+    
+    def atualizar_metricas_pendentes(self):
+        """Consolida hoje apenas para os usuários com escritas desde a última rodada"""
+        with self._metricas_lock:
+            pendentes, self._metricas_pendentes = self._metricas_pendentes, set()
+        if not pendentes:
+            return 0
+        
+        try:
+            return self.atualizar_metricas_diarias(chat_ids=None if None in pendentes else pendentes)
+        except Exception:
+            # Mantém pendentes para a próxima rodada
+            with self._metricas_lock:
+                self._metricas_pendentes |= pendentes
+            return 0
+    
+    def metricas_periodo(self, desde, ate, chat_id_usuario=None):
+        """Totais de eventos do período (novos clientes, mensagens enviadas e falhas)"""
+        where_conditions = ["dia BETWEEN %s AND %s"]
+        params = [desde, ate]
+        if chat_id_usuario is not None:
+            where_conditions.append("chat_id_usuario = %s")
+            params.append(chat_id_usuario)
+        
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                    cursor.execute(f"""
+                        SELECT COALESCE(SUM(novos_clientes), 0) AS novos_clientes,
+                               COALESCE(SUM(mensagens_enviadas), 0) AS mensagens_enviadas,
+                               COALESCE(SUM(mensagens_falhas), 0) AS mensagens_falhas
+                        FROM metricas_diarias
+                        WHERE {" AND ".join(where_conditions)}
+                    """, params)
+                    return {chave: int(valor) for chave, valor in cursor.fetchone().items()}
                     
-                    cursor.execute("""
-                        SELECT nome FROM templates 
-                        WHERE ativo = TRUE 
-                        ORDER BY uso_count DESC 
-                        LIMIT 1
-                    """)
-                    resultado = cursor.fetchone()
-                    stats['template_mais_usado'] = resultado[0] if resultado else 'Nenhum'
+        except Exception as e:
+            logger.error(f"Erro ao obter métricas do período: {e}")
+            raise
+    
+    def metricas_do_dia(self, dia=None, chat_id_usuario=None):
+        """Situação consolidada do dia (soma dos usuários sem chat_id_usuario); None se não consolidado"""
+        dia = dia or agora_br().date()
+        cache_key = f"metricas_dia_{dia}_{chat_id_usuario}"
+        cached = self._get_cache(cache_key)
+        if cached is not None:
+            return cached
+        
+        where_conditions = ["dia = %s"]
+        params = [dia]
+        if chat_id_usuario is not None:
+            where_conditions.append("chat_id_usuario = %s")
+            params.append(chat_id_usuario)
+        
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                    cursor.execute(f"""
+                        SELECT COUNT(*) AS usuarios,
+                               COALESCE(SUM(clientes_ativos), 0) AS clientes_ativos,
+                               COALESCE(SUM(novos_clientes), 0) AS novos_clientes,
+                               COALESCE(SUM(receita), 0) AS receita,
+                               COALESCE(SUM(vencidos), 0) AS vencidos,
+                               COALESCE(SUM(vencem_7_dias), 0) AS vencem_7_dias,
+                               COALESCE(SUM(mensagens_enviadas), 0) AS mensagens_enviadas,
+                               COALESCE(SUM(mensagens_falhas), 0) AS mensagens_falhas
+                        FROM metricas_diarias
+                        WHERE {" AND ".join(where_conditions)}
+                    """, params)
                     
-                    return stats
+                    metricas = dict(cursor.fetchone())
+                    if not metricas.pop('usuarios'):
+                        return None
+                    metricas['receita'] = float(metricas['receita'])
+                    self._set_cache(cache_key, metricas)
+                    return metricas
                     
         except Exception as e:
-            logger.error(f"Erro ao obter estatísticas: {e}")
+            logger.error(f"Erro ao obter métricas do dia: {e}")
             raise
     
     # === MÉTODOS DE CONFIGURAÇÃO ===
@@ -1973,6 +2760,47 @@ _Obrigado por escolher nossos serviços!_ ✨""",
             logger.error(f"Erro ao obter configuração: {e}")
             return valor_padrao
     
+    def obter_configuracoes_usuario(self, chat_id_usuario=None):
+        """Snapshot das configurações do usuário com fallback global (uma consulta, em cache)
+        
+        Mesma precedência de obter_configuracao: linha do usuário vence a global.
+        """
+        cache_key = f"configuracoes_usuario_{chat_id_usuario}"
+        cached_result = self._get_cache(cache_key)
+        if cached_result is not None:
+            return cached_result
+        
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    if chat_id_usuario is not None:
+                        cursor.execute("""
+                            SELECT DISTINCT ON (chave) chave, valor
+                            FROM configuracoes
+                            WHERE chat_id_usuario = %s OR chat_id_usuario IS NULL
+                            ORDER BY chave, (chat_id_usuario IS NULL)
+                        """, (chat_id_usuario,))
+                    else:
+                        cursor.execute("""
+                            SELECT chave, valor FROM configuracoes
+                            WHERE chat_id_usuario IS NULL
+                        """)
+                    
+                    configuracoes = dict(cursor.fetchall())
+                    self._set_cache(cache_key, configuracoes)
+                    return configuracoes
+                    
+        except Exception as e:
+            logger.error(f"Erro ao obter configurações do usuário {chat_id_usuario}: {e}")
+            return {}
+    
+    def invalidar_configuracoes(self, chat_id_usuario=None):
+        """Descarta snapshot de configurações (global afeta todos os usuários)"""
+        if chat_id_usuario is None:
+            self.invalidate_cache("configuracoes_usuario_")
+        else:
+            self.invalidate_cache(f"configuracoes_usuario_{chat_id_usuario}")
+    
     def salvar_configuracao(self, chave, valor, descricao=None, chat_id_usuario=None):
         """Salva configuração com isolamento por usuário"""
         try:
@@ -1987,6 +2815,8 @@ _Obrigado por escolher nossos serviços!_ ✨""",
                             descricao = COALESCE(EXCLUDED.descricao, configuracoes.descricao),
                             data_atualizacao = CURRENT_TIMESTAMP
                     """, (chave, valor, descricao, chat_id_usuario))
+            
+            self.invalidar_configuracoes(chat_id_usuario)
                     
         except Exception as e:
             logger.error(f"Erro ao salvar configuração: {e}")
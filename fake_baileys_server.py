@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+Servidor Baileys falso para testes de vazão offline
+Imita a API HTTP do baileys-server (envio, status, QR, sessões) com latência
+configurável, injeção de erros/429, desconexões por sessão e log de envios
+
+Uso:
+    python fake_baileys_server.py --port 3000 --latency lognormal:3.5:0.4 --error-rate 0.01 --rate-limit 0.02
+    BAILEYS_API_URL=http://localhost:3000 python3 bot_complete.py
+
+Distribuições de latência (milissegundos):
+    fixed:50 | uniform:10:120 | normal:80:20 | lognormal:mu:sigma | none
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import logging
+import argparse
+import threading
+from collections import deque
+from datetime import datetime
+from flask import Flask, request, jsonify
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+class FakeBaileysState:
+    """Estado compartilhado do servidor falso (sessões, falhas e envios registrados)"""
+
+    def __init__(self, latency='none', error_rate=0.0, rate_limit=0.0, disconnect_rate=0.0,
+                 invalid_rate=0.0, auto_connect=True, log_size=100000, log_file=None, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.disconnect_rate = disconnect_rate
+        self.invalid_rate = invalid_rate
+        self.auto_connect = auto_connect
+        self.log_file = log_file
+        self.random = random.Random(seed)
+
+        # session_id -> {'connected': bool, 'status': str, 'phone': str}
+        self.sessions = {}
+        self.sent = deque(maxlen=log_size)
+        self.counters = {'sent': 0, 'errors': 0, 'rate_limited': 0, 'disconnected': 0}
+        self._lock = threading.Lock()
+        self._sampler = self._parse_latency(latency)
+
+    def _parse_latency(self, spec):
+        """Converte especificação de latência em função que retorna segundos"""
+        partes = (spec or 'none').split(':')
+        tipo, args = partes[0], [float(p) for p in partes[1:]]
+        rnd = self.random
+
+        if tipo == 'none':
+            return lambda: 0.0
+        if tipo == 'fixed':
+            return lambda: args[0] / 1000
+        if tipo == 'uniform':
+            return lambda: rnd.uniform(args[0], args[1]) / 1000
+        if tipo == 'normal':
+            return lambda: max(0.0, rnd.gauss(args[0], args[1])) / 1000
+        if tipo == 'lognormal':
+            return lambda: rnd.lognormvariate(args[0], args[1]) / 1000
+        raise ValueError(f"Distribuição de latência desconhecida: {spec}")
+
+    def configure(self, **kwargs):
+        """Altera parâmetros em tempo de execução"""
+        with self._lock:
+            for chave in ('error_rate', 'rate_limit', 'disconnect_rate', 'invalid_rate', 'auto_connect'):
+                if chave in kwargs:
+                    setattr(self, chave, kwargs[chave])
+            if 'latency' in kwargs:
+                self._sampler = self._parse_latency(kwargs['latency'])
+                self.latency = kwargs['latency']
+
+    def sleep(self):
+        atraso = self._sampler()
+        if atraso > 0:
+            time.sleep(atraso)
+
+    def session(self, session_id, create=True):
+        with self._lock:
+            sessao = self.sessions.get(session_id)
+            if sessao is None and create:
+                sessao = {
+                    'connected': self.auto_connect,
+                    'status': 'connected' if self.auto_connect else 'qr_ready',
+                    'phone': f"5511{self.random.randint(10000000, 99999999)}",
+                }
+                self.sessions[session_id] = sessao
+            return sessao
+
+    def set_connected(self, session_id, connected):
+        sessao = self.session(session_id)
+        with self._lock:
+            sessao['connected'] = connected
+            sessao['status'] = 'connected' if connected else 'disconnected'
+
+    def record(self, session_id, number, message, success, error=None):
+        registro = {
+            'session_id': session_id,
+            'number': number,
+            'message': message,
+            'success': success,
+            'error': error,
+            'message_id': f"FAKE{self.random.getrandbits(48):012X}" if success else None,
+            'timestamp': time.time(),
+        }
+        with self._lock:
+            self.sent.append(registro)
+            if success:
+                self.counters['sent'] += 1
+        if self.log_file:
+            with open(self.log_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(registro, ensure_ascii=False) + '\n')
+        return registro
+
+    def count(self, chave):
+        with self._lock:
+            self.counters[chave] += 1
+
+    def reset(self):
+        with self._lock:
+            self.sessions.clear()
+            self.sent.clear()
+            for chave in self.counters:
+                self.counters[chave] = 0
+
+
+def create_app(state):
+    """Cria app Flask com os mesmos endpoints do baileys-server"""
+    app = Flask(__name__)
+
+    def agora_iso():
+        return datetime.now().isoformat()
+
+    @app.route('/status/<session_id>', methods=['GET'])
+    def status(session_id):
+        state.sleep()
+        sessao = state.session(session_id, create=False)
+        if not sessao:
+            return jsonify({'connected': False, 'status': 'not_initialized', 'session': None,
+                            'qr_available': False, 'timestamp': agora_iso(), 'session_id': session_id})
+        return jsonify({
+            'connected': sessao['connected'],
+            'status': sessao['status'],
+            'session': f"{sessao['phone']}@s.whatsapp.net" if sessao['connected'] else None,
+            'qr_available': not sessao['connected'],
+            'timestamp': agora_iso(),
+            'session_id': session_id,
+        })
+
+    @app.route('/qr/<session_id>', methods=['GET'])
+    def qr(session_id):
+        state.sleep()
+        sessao = state.session(session_id)
+        if sessao['connected']:
+            return jsonify({'success': False, 'error': f'Sessão {session_id} já conectada',
+                            'session_id': session_id}), 404
+        return jsonify({
+            'success': True,
+            'qr': f'fake-qr-{session_id}',
+            'qr_image': 'data:image/png;base64,',
+            'instructions': 'Servidor falso: use POST /_fake/connect/<session_id> para simular a leitura',
+            'session_id': session_id,
+        })
+
+    @app.route('/send-message', methods=['POST'])
+    def send_message():
+        data = request.get_json(silent=True) or {}
+        number, message, session_id = data.get('number'), data.get('message'), data.get('session_id')
+
+        if not session_id:
+            return jsonify({'success': False, 'error': 'session_id é obrigatório'}), 400
+        if not number or not message:
+            return jsonify({'success': False, 'error': 'Número e mensagem são obrigatórios'}), 400
+
+        state.sleep()
+        rnd = state.random.random()
+
+        if rnd < state.rate_limit:
+            state.count('rate_limited')
+            return jsonify({'success': False, 'error': 'rate-overlimit', 'session_id': session_id}), 429
+
+        if state.disconnect_rate and state.random.random() < state.disconnect_rate:
+            state.set_connected(session_id, False)
+            state.count('disconnected')
+
+        sessao = state.session(session_id)
+        if not sessao['connected']:
+            state.record(session_id, number, message, False, 'disconnected')
+            return jsonify({'success': False, 'error': f'WhatsApp não conectado para sessão {session_id}',
+                            'session_id': session_id}), 400
+
+        if rnd < state.rate_limit + state.error_rate:
+            state.count('errors')
+            state.record(session_id, number, message, False, 'injected_error')
+            return jsonify({'success': False, 'error': 'Erro injetado', 'session_id': session_id}), 500
+
+        registro = state.record(session_id, number, message, True)
+        return jsonify({'success': True, 'messageId': registro['message_id'],
+                        'timestamp': agora_iso(), 'session_id': session_id})
+
+    @app.route('/check-numbers', methods=['POST'])
+    def check_numbers():
+        data = request.get_json(silent=True) or {}
+        numbers, session_id = data.get('numbers'), data.get('session_id')
+        if not session_id:
+            return jsonify({'success': False, 'error': 'session_id é obrigatório'}), 400
+        if not isinstance(numbers, list) or not numbers:
+            return jsonify({'success': False, 'error': 'Lista de números é obrigatória'}), 400
+
+        state.sleep()
+        # Determinístico por número: o mesmo número sempre tem o mesmo resultado
+        results = {n: (zlib.crc32(str(n).encode()) % 10000) / 10000 >= state.invalid_rate for n in numbers}
+        return jsonify({'success': True, 'results': results, 'session_id': session_id})
+
+    @app.route('/reconnect/<session_id>', methods=['POST'])
+    def reconnect(session_id):
+        state.set_connected(session_id, True)
+        return jsonify({'success': True, 'message': f'Reconexão iniciada para sessão {session_id}',
+                        'session_id': session_id})
+
+    @app.route('/release-session/<session_id>', methods=['POST'])
+    @app.route('/clear-session/<session_id>', methods=['POST'])
+    def clear_session(session_id):
+        with state._lock:
+            state.sessions.pop(session_id, None)
+        return jsonify({'success': True, 'message': f'Sessão {session_id} liberada', 'session_id': session_id})
+
+    @app.route('/sessions', methods=['GET'])
+    def sessions():
+        with state._lock:
+            dados = [{
+                'session_id': sid,
+                'connected': s['connected'],
+                'status': s['status'],
+                'qr_available': not s['connected'],
+                'phone_number': s['phone'] if s['connected'] else None,
+                'last_seen': agora_iso(),
+            } for sid, s in state.sessions.items()]
+        return jsonify({'success': True, 'total_sessions': len(dados), 'sessions': dados,
+                        'timestamp': agora_iso()})
+
+    @app.route('/health', methods=['GET'])
+    def health():
+        return jsonify({'success': True, 'status': 'ok', 'fake': True})
+
+    # ===================== Controle do servidor falso =====================
+    @app.route('/_fake/sent', methods=['GET'])
+    def fake_sent():
+        session_id = request.args.get('session_id')
+        limite = int(request.args.get('limit', 1000))
+        with state._lock:
+            enviados = [r for r in state.sent if not session_id or r['session_id'] == session_id]
+        return jsonify({'success': True, 'total': len(enviados), 'sent': enviados[-limite:]})
+
+    @app.route('/_fake/stats', methods=['GET'])
+    def fake_stats():
+        with state._lock:
+            return jsonify({'success': True, 'counters': dict(state.counters),
+                            'sessions': len(state.sessions), 'latency': state.latency,
+                            'error_rate': state.error_rate, 'rate_limit': state.rate_limit,
+                            'disconnect_rate': state.disconnect_rate})
+
+    @app.route('/_fake/config', methods=['POST'])
+    def fake_config():
+        try:
+            state.configure(**(request.get_json(silent=True) or {}))
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        return fake_stats()
+
+    @app.route('/_fake/connect/<session_id>', methods=['POST'])
+    def fake_connect(session_id):
+        state.set_connected(session_id, True)
+        return jsonify({'success': True, 'session_id': session_id, 'connected': True})
+
+    @app.route('/_fake/disconnect/<session_id>', methods=['POST'])
+    def fake_disconnect(session_id):
+        state.set_connected(session_id, False)
+        state.count('disconnected')
+        return jsonify({'success': True, 'session_id': session_id, 'connected': False})
+
+    @app.route('/_fake/reset', methods=['POST'])
+    def fake_reset():
+        state.reset()
+        return jsonify({'success': True})
+
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Servidor Baileys falso para testes offline')
+    parser.add_argument('--host', default=os.getenv('FAKE_BAILEYS_HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('FAKE_BAILEYS_PORT', '3000')))
+    parser.add_argument('--latency', default=os.getenv('FAKE_BAILEYS_LATENCY', 'none'),
+                        help='fixed:MS | uniform:MIN:MAX | normal:MEDIA:DESVIO | lognormal:MU:SIGMA | none')
+    parser.add_argument('--error-rate', type=float, default=float(os.getenv('FAKE_BAILEYS_ERROR_RATE', '0')))
+    parser.add_argument('--rate-limit', type=float, default=float(os.getenv('FAKE_BAILEYS_RATE_LIMIT', '0')),
+                        help='Fração de envios respondidos com HTTP 429')
+    parser.add_argument('--disconnect-rate', type=float,
+                        default=float(os.getenv('FAKE_BAILEYS_DISCONNECT_RATE', '0')),
+                        help='Probabilidade de um envio derrubar a sessão')
+    parser.add_argument('--invalid-rate', type=float, default=float(os.getenv('FAKE_BAILEYS_INVALID_RATE', '0')),
+                        help='Fração de números sem WhatsApp em /check-numbers')
+    parser.add_argument('--no-auto-connect', action='store_true',
+                        help='Sessões novas começam aguardando QR')
+    parser.add_argument('--log-file', default=os.getenv('FAKE_BAILEYS_LOG_FILE'),
+                        help='Arquivo JSONL com todos os envios')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    state = FakeBaileysState(
+        latency=args.latency,
+        error_rate=args.error_rate,
+        rate_limit=args.rate_limit,
+        disconnect_rate=args.disconnect_rate,
+        invalid_rate=args.invalid_rate,
+        auto_connect=not args.no_auto_connect,
+        log_file=args.log_file,
+        seed=args.seed,
+    )
+    app = create_app(state)
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    logger.info(f"🧪 Baileys falso em http://{args.host}:{args.port} (latência={args.latency}, "
+                f"erros={args.error_rate}, 429={args.rate_limit}, desconexão={args.disconnect_rate})")
+    app.run(host=args.host, port=args.port, threaded=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
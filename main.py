@@ -6,6 +6,7 @@ Versão funcional com todas as funcionalidades do main.py usando API
 import os
 import logging
 import json
+import hmac
 import requests
 from flask import Flask, request, jsonify
 import asyncio
@@ -13,15 +14,23 @@ import threading
 import time
 from datetime import datetime, timedelta
 import pytz
-from database import DatabaseManager
+from database import DatabaseManager, postgres_disponivel, instalar_encerramento_sigterm
 from templates import TemplateManager
 from baileys_api import BaileysAPI
+from whatsapp_number_cache import WhatsAppNumberCache
+from whatsapp_send_queue import WhatsAppSendQueue
 from scheduler_v2_simple import SimpleScheduler
 # from baileys_clear import BaileysCleaner  # Removido - não utilizado
 from schedule_config import ScheduleConfig
 from whatsapp_session_api import session_api, init_session_manager
 from user_management import UserManager
 from mercadopago_integration import MercadoPagoIntegration
+from update_dispatcher import UpdateDispatcher, chat_id_do_update, update_valido
+from conversation_store import ConversationStateStore
+from callback_router import CallbackRouter, CallbackContext
+from single_flight import SingleFlight
+from telegram_outbox import obter_outbox
+from startup_orchestrator import StartupOrchestrator, aguardar, porta_aberta, http_disponivel
 
 # Configuração de logging otimizada para performance
 logging.basicConfig(
@@ -45,6 +54,13 @@ app = Flask(__name__)
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_CHAT_ID = os.getenv('ADMIN_CHAT_ID')
 TIMEZONE_BR = pytz.timezone('America/Sao_Paulo')
+CLIENTES_POR_PAGINA = int(os.getenv('CLIENTES_POR_PAGINA', '15'))
+WEBHOOK_ESPERA_FILA = float(os.getenv('WEBHOOK_ESPERA_FILA', '0.5'))
+# Modo webhook: updates chegam por /webhook e o polling (getUpdates) não é iniciado
+MODO_WEBHOOK = bool(os.getenv('WEBHOOK_URL') or os.getenv('TELEGRAM_WEBHOOK_SECRET'))
+
+# Botões de texto cujo resultado pode ser reaproveitado (não invalidam o single-flight)
+ACOES_TEXTO_COALESCIDAS = {'📊 Relatórios', '📊 Meus Relatórios', '👥 Gestão de Clientes'}
 
 # Estados da conversação
 ESTADOS = {
@@ -62,22 +78,36 @@ class TelegramBot:
         self.token = token
         self.base_url = f"https://api.telegram.org/bot{token}"
         
+        # Saída para a Bot API com limites por chat/global e reenvio após 429
+        self.outbox = obter_outbox(token)
+        
         # Instâncias dos serviços
         self.db = None
         self.template_manager = None
         self.baileys_api = None
+        self.numeros_whatsapp = None
+        self.envios_whatsapp = None
+        self.inicializacao = None
         self.scheduler = None
         self.user_manager = None
         self.mercado_pago = None
         self.baileys_cleaner = None
         self.schedule_config = None
         
-        # Estado das conversações
-        self.conversation_states = {}
-        self.user_data = {}
-        self.user_states = {}  # Para gerenciar estados de criação de templates
-        self._last_payment_request = {}  # Rate limiting para pagamentos
+        # Estado das conversações (memória até o banco conectar, depois persistido)
+        self.estados = ConversationStateStore()
+        self.conversation_states = self.estados.mapa('conversation_states')
+        self.user_data = self.estados.mapa('user_data')
+        self.user_states = self.estados.mapa('user_states')  # Para gerenciar estados de criação de templates
+        self._last_payment_request = self.estados.mapa('last_payment_request')  # Rate limiting para pagamentos
         self._payment_requested = set()  # Track payment requests
+        self._isolamento_garantido = set()  # Usuários com configurações padrão já verificadas
+        
+        # Ações caras repetidas (Atualizar, Relatórios, Já Paguei) executam uma vez
+        self.single_flight = SingleFlight()
+        
+        # Tabela de rotas dos botões inline
+        self.callback_router = self._montar_rotas_callback()
     
     def send_message(self, chat_id, text, parse_mode=None, reply_markup=None):
         """Envia mensagem via API HTTP"""
@@ -96,7 +126,7 @@ class TelegramBot:
             logger.debug(f"Data: {data}")
             
             # Usar form data ao invés de JSON para compatibilidade com Telegram API
-            response = requests.post(url, data=data, timeout=10)
+            response = self.outbox.enviar('sendMessage', data, chat_id=chat_id)
             
             # Log da resposta para debug
             logger.debug(f"Response status: {response.status_code}")
@@ -114,123 +144,122 @@ class TelegramBot:
             return None
     
     def initialize_services(self):
-        """Inicializa os serviços do bot"""
-        services_failed = []
+        """Inicializa os serviços do bot em paralelo, respeitando dependências"""
+        inicializacao = StartupOrchestrator('serviços do bot')
+        inicializacao.fase('banco_dados', self._iniciar_banco_dados)
+        inicializacao.fase('mercado_pago', self._iniciar_mercado_pago, obrigatoria=False)
+        inicializacao.fase('session_manager', self._iniciar_session_manager, depende=('banco_dados',), obrigatoria=False)
+        inicializacao.fase('template_manager', self._iniciar_template_manager, depende=('banco_dados',))
+        inicializacao.fase('baileys_api', self._iniciar_baileys_api, apos=('banco_dados',), obrigatoria=False)
+        inicializacao.fase('numeros_whatsapp', self._iniciar_numeros_whatsapp,
+                           depende=('banco_dados', 'baileys_api'), obrigatoria=False)
+        inicializacao.fase('envios_whatsapp', self._iniciar_envios_whatsapp,
+                           depende=('banco_dados', 'baileys_api'), apos=('numeros_whatsapp', 'template_manager'),
+                           obrigatoria=False)
+        inicializacao.fase('agendador', self._iniciar_agendador,
+                           depende=('banco_dados', 'baileys_api', 'template_manager'), apos=('envios_whatsapp',))
+        inicializacao.fase('schedule_config', self._iniciar_schedule_config, depende=('banco_dados',), obrigatoria=False)
+        self.inicializacao = inicializacao
+        
+        inicializacao.executar()
+        
+        services_failed = inicializacao.falhas(obrigatorias=False)
+        if services_failed:
+            logger.warning(f"⚠️ Alguns serviços falharam na inicialização: {', '.join(services_failed)}")
+        else:
+            logger.info("✅ Todos os serviços inicializados")
         
-        # Inicializar banco de dados com retry
-        logger.info("🔄 Inicializando banco de dados...")
+        return len(services_failed) == 0
+    
+    def _iniciar_banco_dados(self):
+        """Banco de dados, gerenciamento de usuários e estados persistidos"""
         try:
             self.db = DatabaseManager()
             
-            # Verificar se a inicialização do banco foi bem-sucedida
-            if self.db is None:
-                raise Exception("Falha na inicialização do banco de dados")
-            
-            # Teste de conectividade mais robusto
-            try:
-                # Testar conectividade com uma query simples
-                if hasattr(self.db, 'connection') and self.db.connection:
-                    pass  # Conexão OK
-                else:
-                    logger.warning("Conexão do banco não disponível, mas prosseguindo...")
-            except Exception as conn_error:
-                logger.warning(f"Teste de conectividade falhou: {conn_error}, mas prosseguindo...")
-            
             # Testar conectividade
-            try:
-                with self.db.get_connection() as conn:
-                    with conn.cursor() as cursor:
-                        cursor.execute("SELECT 1")
-                        cursor.fetchone()
-                logger.info("✅ Banco de dados conectado e funcional")
-            except Exception as e:
-                logger.error(f"Falha no teste de conectividade: {e}")
-                raise Exception("Banco de dados não responsivo")
-            
+            with self.db.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                    cursor.fetchone()
             logger.info("✅ Banco de dados inicializado")
             
-            # Inicializar gerenciamento de usuários
             self.user_manager = UserManager(self.db)
             logger.info("✅ User Manager inicializado")
             
-        except Exception as e:
-            logger.error(f"Erro ao inicializar banco de dados: {e}")
-            services_failed.append("banco_dados")
-            # Continuar sem banco de dados por enquanto
+            # Persistir estados de conversa (sobrevivem a restart e são compartilháveis)
+            self.estados.conectar(self.db)
+        except Exception:
+            # Continuar sem banco de dados
             self.db = None
             self.user_manager = None
-            
-        # Inicializar outros serviços mesmo se banco falhou
+            raise
+    
+    def _iniciar_mercado_pago(self):
         try:
-            # Inicializar integração Mercado Pago
             self.mercado_pago = MercadoPagoIntegration()
             logger.info("✅ Mercado Pago inicializado")
-        except Exception as e:
-            logger.error(f"Erro Mercado Pago: {e}")
-            services_failed.append("mercado_pago")
+        except Exception:
             self.mercado_pago = None
-        
-        try:
-            # Inicializar gerenciador de sessões WhatsApp (apenas se banco disponível)
-            if self.db:
-                init_session_manager(self.db)
-                logger.info("✅ WhatsApp Session Manager inicializado")
-        except Exception as e:
-            logger.error(f"Erro Session Manager: {e}")
-            services_failed.append("session_manager")
-        
+            raise
+    
+    def _iniciar_session_manager(self):
+        init_session_manager(self.db)
+    
+    def _iniciar_template_manager(self):
         try:
-            # Inicializar template manager (apenas se banco disponível)
-            if self.db:
-                self.template_manager = TemplateManager(self.db)
-                logger.info("✅ Template manager inicializado")
-        except Exception as e:
-            logger.error(f"Erro Template Manager: {e}")
-            services_failed.append("template_manager")
+            self.template_manager = TemplateManager(self.db)
+            logger.info("✅ Template manager inicializado")
+        except Exception:
             self.template_manager = None
-        
+            raise
+    
+    def _iniciar_baileys_api(self):
         try:
-            # Inicializar Baileys API
-            self.baileys_api = BaileysAPI()
+            self.baileys_api = BaileysAPI(self.db)
             logger.info("✅ Baileys API inicializada")
-        except Exception as e:
-            logger.error(f"Erro Baileys API: {e}")
-            services_failed.append("baileys_api")
+        except Exception:
             self.baileys_api = None
-        
-        try:
-            # Inicializar agendador (apenas se dependências disponíveis)
-            if self.db and self.baileys_api and self.template_manager:
-                self.scheduler = SimpleScheduler(self.db, self.baileys_api, self.template_manager)
-                # Definir instância do bot no scheduler para alertas automáticos
-                self.scheduler.set_bot_instance(self)
-                self.scheduler_instance = self.scheduler
-                self.scheduler.start()
-                logger.info("✅ Agendador inicializado")
-        except Exception as e:
-            logger.error(f"Erro Agendador: {e}")
-            services_failed.append("agendador")
+            raise
+    
+    def _iniciar_numeros_whatsapp(self):
+        """Cache de validade de números WhatsApp"""
+        try:
+            self.numeros_whatsapp = WhatsAppNumberCache(self.db, self.baileys_api)
+            logger.info("✅ Cache de números WhatsApp inicializado")
+        except Exception:
+            self.numeros_whatsapp = None
+            raise
+    
+    def _iniciar_envios_whatsapp(self):
+        """Fila de envios imediatos (WhatsApp fora das threads do Telegram)"""
+        try:
+            self.envios_whatsapp = WhatsAppSendQueue(self.db, self.baileys_api, self.numeros_whatsapp,
+                                                     template_manager=self.template_manager)
+            logger.info("✅ Fila de envios imediatos inicializada")
+        except Exception:
+            self.envios_whatsapp = None
+            raise
+    
+    def _iniciar_agendador(self):
+        try:
+            self.scheduler = SimpleScheduler(self.db, self.baileys_api, self.template_manager,
+                                             numeros_whatsapp=self.numeros_whatsapp)
+            # Definir instância do bot no scheduler para alertas automáticos
+            self.scheduler.set_bot_instance(self)
+            self.scheduler_instance = self.scheduler
+            self.scheduler.start()
+            logger.info("✅ Agendador inicializado")
+        except Exception:
             self.scheduler = None
-        
+            raise
+    
+    def _iniciar_schedule_config(self):
         try:
-            # Inicializar configurador de horários
-            if self.db:
-                self.schedule_config = ScheduleConfig(self)
-                logger.info("✅ Schedule config inicializado")
-        except Exception as e:
-            logger.error(f"Erro Schedule Config: {e}")
-            services_failed.append("schedule_config")
+            self.schedule_config = ScheduleConfig(self)
+            logger.info("✅ Schedule config inicializado")
+        except Exception:
             self.schedule_config = None
-        
-        # Remover referência ao BaileysCleaner que não existe mais
-        # self.baileys_cleaner = None
-        
-        if services_failed:
-            logger.warning(f"⚠️ Alguns serviços falharam na inicialização: {', '.join(services_failed)}")
-        else:
-            logger.info("✅ Todos os serviços inicializados")
-        
-        return len(services_failed) == 0
+            raise
     
     def is_admin(self, chat_id):
         """Verifica se é o admin"""
@@ -241,6 +270,10 @@ class TelegramBot:
         try:
             if self.is_admin(chat_id):
                 return True
+            
+            # Já verificado neste processo: nenhuma consulta ao banco
+            if chat_id in self._isolamento_garantido:
+                return True
                 
             # Verificar se usuário existe e tem configurações
             conn = self.db.get_connection()
@@ -273,6 +306,8 @@ class TelegramBot:
             
             conn.commit()
             conn.close()
+            self.db.invalidar_configuracoes(chat_id)
+            self._isolamento_garantido.add(chat_id)
             return True
             
         except Exception as e:
@@ -403,6 +438,14 @@ class TelegramBot:
     
     def process_message(self, update):
         """Processa mensagem recebida"""
+        try:
+            self._processar_update(update)
+        finally:
+            # Gravar alterações feitas dentro dos estados durante o update
+            self.estados.persistir(chat_id_do_update(update))
+    
+    def _processar_update(self, update):
+        """Processa update (mensagem ou callback)"""
         try:
             message = update.get('message', {})
             callback_query = update.get('callback_query', {})
@@ -419,6 +462,10 @@ class TelegramBot:
             text = message.get('text', '')
             user = message.get('from', {})
             
+            # Qualquer outra ação pode alterar dados: descartar resultados reaproveitáveis
+            if text not in ACOES_TEXTO_COALESCIDAS:
+                self.single_flight.invalidar((chat_id,))
+            
             logger.info(f"Mensagem de {user.get('username', 'unknown')}: {text}")
             
             # Verificar estado da conversação PRIMEIRO
@@ -746,7 +793,7 @@ Após 7 dias, continue usando por apenas R$ 20,00/mês."""
             self.listar_vencimentos(chat_id)
         
         elif text == '📊 Relatórios':
-            self.mostrar_relatorios(chat_id)
+            self._coalescer(chat_id, 'mostrar_relatorios', self.mostrar_relatorios)
         
         elif text == '📱 WhatsApp/Baileys':
             self.baileys_menu(chat_id)
@@ -836,12 +883,12 @@ Após 7 dias, continue usando por apenas R$ 20,00/mês."""
         
         elif text == '👥 Gestão de Clientes':
             if not self.is_admin(chat_id):
-                self.listar_clientes_usuario(chat_id)
+                self._coalescer(chat_id, 'listar_clientes_usuario', self.listar_clientes_usuario)
             else:
                 self.gestao_clientes_menu(chat_id)
         
         elif text == '📊 Meus Relatórios':
-            self.relatorios_usuario(chat_id)
+            self._coalescer(chat_id, 'relatorios_usuario', self.relatorios_usuario)
         
         elif text == '💳 Minha Conta':
             self.minha_conta_menu(chat_id)
@@ -1055,10 +1102,14 @@ Após 7 dias, continue usando por apenas R$ 20,00/mês."""
         """Menu principal para administrador"""
         try:
             # Buscar estatísticas
-            # Admin vê todos os clientes (sem filtro de usuário)
-            total_clientes = len(self.db.listar_clientes(apenas_ativos=True, chat_id_usuario=None)) if self.db else 0
-            # Admin vê todos os clientes (sem filtro de usuário)
-            clientes_vencendo = len(self.db.listar_clientes_vencendo(dias=7, chat_id_usuario=None)) if self.db else 0
+            # Admin vê todos os clientes (sem filtro de usuário), pelas métricas consolidadas do dia
+            metricas = self.db.metricas_do_dia() if self.db else None
+            if metricas:
+                total_clientes = metricas['clientes_ativos']
+                clientes_vencendo = metricas['vencidos'] + metricas['vencem_7_dias']
+            else:
+                total_clientes = len(self.db.listar_clientes(apenas_ativos=True, chat_id_usuario=None)) if self.db else 0
+                clientes_vencendo = len(self.db.listar_clientes_vencendo(dias=7, chat_id_usuario=None)) if self.db else 0
             
             # Estatísticas de usuários
             total_usuarios = 0
@@ -1574,6 +1625,10 @@ Após o período de teste, continue usando por apenas R$ 20,00/mês!"""
                     dados.get('info_adicional')
                 )
                 
+                # Verificar em segundo plano se o número possui WhatsApp
+                if self.numeros_whatsapp:
+                    self.numeros_whatsapp.verificar_em_segundo_plano([dados['telefone']], chat_id)
+                
                 # Criar teclado para próxima ação
                 teclado_pos_cadastro = {
                     'inline_keyboard': [
@@ -1628,8 +1683,89 @@ Após o período de teste, continue usando por apenas R$ 20,00/mês!"""
     
 
     
-    def listar_clientes(self, chat_id):
-        """Lista clientes com informações completas organizadas"""
+    # Rótulos dos filtros de situação nas listagens de clientes
+    FILTROS_CLIENTES = {
+        'todos': '📋 Todos',
+        'vencidos': '🔴 Vencidos',
+        'vencendo': '🟡 Vencendo',
+        'emdia': '🟢 Em dia',
+    }
+    
+    def _pagina_clientes(self, chat_id, visao, filtro='todos', direcao='i', cliente_id=0):
+        """Busca resumo e página de clientes e monta os botões de filtro/navegação
+        
+        visao: 'a' (listar_clientes) ou 'u' (listar_clientes_usuario)
+        direcao: 'i' início, 'p' próxima (após cliente_id), 'a' anterior (antes de cliente_id)
+        """
+        filtro = filtro if filtro in self.FILTROS_CLIENTES else 'todos'
+        resumo = self.db.resumo_clientes(chat_id)
+        pagina = self.db.listar_clientes_pagina(
+            chat_id, filtro=filtro,
+            apos_id=cliente_id if direcao == 'p' else None,
+            antes_id=cliente_id if direcao == 'a' else None,
+            limite=CLIENTES_POR_PAGINA)
+        
+        # Cliente de referência removido/alterado: recomeçar do início
+        if not pagina['clientes'] and direcao != 'i':
+            pagina = self.db.listar_clientes_pagina(chat_id, filtro=filtro, limite=CLIENTES_POR_PAGINA)
+        
+        inline_keyboard = []
+        for cliente in pagina['clientes']:
+            dias_vencer = cliente['dias_vencimento']
+            if dias_vencer < 0:
+                emoji_status = "🔴"
+            elif dias_vencer <= 3:
+                emoji_status = "🟡"
+            else:
+                emoji_status = "🟢"
+            
+            data_vencimento = cliente['vencimento'].strftime('%d/%m/%Y')
+            inline_keyboard.append([{
+                'text': f"{emoji_status} {cliente['nome']} ({data_vencimento})",
+                'callback_data': f"cliente_detalhes_{cliente['id']}"
+            }])
+        
+        # Navegação entre páginas (keyset pelo primeiro/último cliente exibido)
+        nav_buttons = []
+        if pagina['clientes'] and pagina['tem_anterior']:
+            nav_buttons.append({'text': '⬅️ Anterior',
+                                'callback_data': f"clientes_pagina_{visao}_{filtro}_a_{pagina['clientes'][0]['id']}"})
+        if pagina['clientes'] and pagina['tem_proxima']:
+            nav_buttons.append({'text': 'Próxima ➡️',
+                                'callback_data': f"clientes_pagina_{visao}_{filtro}_p_{pagina['clientes'][-1]['id']}"})
+        if nav_buttons:
+            inline_keyboard.append(nav_buttons)
+        
+        # Filtros por situação
+        contagem = {'todos': resumo['total'], 'vencidos': resumo['vencidos'],
+                    'vencendo': resumo['vencendo'], 'emdia': resumo['em_dia']}
+        filtros = []
+        for chave, rotulo in self.FILTROS_CLIENTES.items():
+            marcador = '• ' if chave == filtro else ''
+            filtros.append({'text': f"{marcador}{rotulo} ({contagem[chave]})",
+                            'callback_data': f"clientes_pagina_{visao}_{chave}_i_0"})
+        inline_keyboard.append(filtros[:2])
+        inline_keyboard.append(filtros[2:])
+        
+        return resumo, pagina, filtro, inline_keyboard
+    
+    def navegar_clientes(self, chat_id, visao, filtro, direcao, cliente_id, message_id=None):
+        """Callback de paginação/filtro das listagens de clientes"""
+        if visao == 'u':
+            self.listar_clientes_usuario(chat_id, filtro, direcao, cliente_id, message_id)
+        else:
+            self.listar_clientes(chat_id, filtro, direcao, cliente_id, message_id)
+    
+    def _enviar_ou_editar(self, chat_id, message_id, mensagem, **kwargs):
+        """Edita a mensagem da listagem ao navegar; envia nova caso contrário"""
+        if message_id:
+            resultado = self.edit_message(chat_id, message_id, mensagem, **kwargs)
+            if resultado and resultado.get('ok'):
+                return resultado
+        return self.send_message(chat_id, mensagem, **kwargs)
+    
+    def listar_clientes(self, chat_id, filtro='todos', direcao='i', cliente_id=0, message_id=None):
+        """Lista clientes com informações completas organizadas (paginado)"""
         try:
             # Verificar se banco de dados está disponível
             if not self.db:
@@ -1639,101 +1775,63 @@ Após o período de teste, continue usando por apenas R$ 20,00/mês!"""
                 return
             
             # CORREÇÃO CRÍTICA: Filtrar clientes por usuário para isolamento completo
-            clientes = self.db.listar_clientes(apenas_ativos=True, chat_id_usuario=chat_id)
+            resumo, pagina, filtro, inline_keyboard = self._pagina_clientes(chat_id, 'a', filtro, direcao, cliente_id)
             
-            if not clientes:
+            if not resumo['total']:
                 self.send_message(chat_id, 
                     "📋 *Nenhum cliente cadastrado*\n\nUse o botão *Adicionar Cliente* para começar.",
                     parse_mode='Markdown',
                     reply_markup=self.criar_teclado_clientes())
                 return
             
-            total_clientes = len(clientes)
-            em_dia = len([c for c in clientes if (c['vencimento'] - datetime.now().date()).days > 3])
-            vencendo = len([c for c in clientes if 0 <= (c['vencimento'] - datetime.now().date()).days <= 3])
-            vencidos = len([c for c in clientes if (c['vencimento'] - datetime.now().date()).days < 0])
-            
-            # Cálculos financeiros
-            total_previsto_mensal = sum(cliente.get('valor', 0) for cliente in clientes)
-            total_vencidos = sum(cliente.get('valor', 0) for cliente in clientes if (cliente['vencimento'] - datetime.now().date()).days < 0)
+            total_clientes = resumo['total']
             
-            # Para total recebido mensal, vou usar uma simulação baseada em clientes em dia
+            # Para total recebido mensal, uso os clientes em dia
             # (em um sistema real, isso viria de uma tabela de pagamentos)
-            total_recebido_mensal = sum(cliente.get('valor', 0) for cliente in clientes if (cliente['vencimento'] - datetime.now().date()).days > 3)
-            
-            # Cabeçalho com estatísticas
             mensagem = f"""📋 **CLIENTES CADASTRADOS** ({total_clientes})
 
-📊 **Resumo:** 🟢 {em_dia} em dia | 🟡 {vencendo} vencendo | 🔴 {vencidos} vencidos
+📊 **Resumo:** 🟢 {resumo['em_dia']} em dia | 🟡 {resumo['vencendo']} vencendo | 🔴 {resumo['vencidos']} vencidos
 
 💰 **RESUMO FINANCEIRO:**
-📈 Total previsto mensal: **R$ {total_previsto_mensal:.2f}**
-✅ Total recebido mensal: **R$ {total_recebido_mensal:.2f}**
-⚠️ Total em atraso: **R$ {total_vencidos:.2f}**
+📈 Total previsto mensal: **R$ {resumo['total_previsto']:.2f}**
+✅ Total recebido mensal: **R$ {resumo['total_em_dia']:.2f}**
+⚠️ Total em atraso: **R$ {resumo['total_vencidos']:.2f}**
 
 """
             
-            # Criar botões inline para ações rápidas
-            inline_keyboard = []
-            
-            # Adicionar botões para todos os clientes
-            for cliente in clientes:
-                dias_vencer = (cliente['vencimento'] - datetime.now().date()).days
-                if dias_vencer < 0:
-                    emoji_status = "🔴"
-                elif dias_vencer <= 3:
-                    emoji_status = "🟡"
-                else:
-                    emoji_status = "🟢"
-                
-                data_vencimento = cliente['vencimento'].strftime('%d/%m/%Y')
-                cliente_texto = f"{emoji_status} {cliente['nome']} ({data_vencimento})"
-                inline_keyboard.append([{
-                    'text': cliente_texto,
-                    'callback_data': f"cliente_detalhes_{cliente['id']}"
-                }])
+            if not pagina['clientes']:
+                mensagem += f"🔍 Nenhum cliente em *{self.FILTROS_CLIENTES[filtro]}*.\n\n"
             
             # Botões de navegação
-            nav_buttons = []
-            
-            # Botão para atualizar lista
-            nav_buttons.append({
-                'text': "🔄 Atualizar Lista",
-                'callback_data': "listar_clientes"
-            })
-            
-            # Botão voltar
-            nav_buttons.append({
-                'text': "⬅️ Voltar",
-                'callback_data': "menu_clientes"
-            })
-            
-            inline_keyboard.append(nav_buttons)
+            inline_keyboard.append([
+                {'text': "🔄 Atualizar Lista", 'callback_data': f"clientes_pagina_a_{filtro}_i_0"},
+                {'text': "⬅️ Voltar", 'callback_data': "menu_clientes"}
+            ])
             
             # Rodapé explicativo
             mensagem += f"""━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
 💡 **Como usar:**
 • Clique em qualquer cliente abaixo para ver todas as informações detalhadas
-• Use 🔄 Atualizar para recarregar a lista
+• Use os filtros e ⬅️/➡️ para navegar entre as páginas
 
 📱 **Total de clientes ativos:** {total_clientes}"""
             
-            self.send_message(chat_id, mensagem, 
-                            parse_mode='Markdown',
-                            reply_markup={'inline_keyboard': inline_keyboard})
+            self._enviar_ou_editar(chat_id, message_id, mensagem,
+                                   parse_mode='Markdown',
+                                   reply_markup={'inline_keyboard': inline_keyboard})
             
         except Exception as e:
             logger.error(f"Erro ao listar clientes: {e}")
             self.send_message(chat_id, "❌ Erro ao listar clientes.",
                             reply_markup=self.criar_teclado_clientes())
     
-    def listar_clientes_usuario(self, chat_id):
-        """Lista clientes para usuários não-admin (versão simplificada)"""
+    def listar_clientes_usuario(self, chat_id, filtro='todos', direcao='i', cliente_id=0, message_id=None):
+        """Lista clientes para usuários não-admin (versão simplificada, paginada)"""
         try:
-            clientes = self.db.listar_clientes(apenas_ativos=True, chat_id_usuario=chat_id)
+            resumo, pagina, filtro, inline_keyboard = self._pagina_clientes(chat_id, 'u', filtro, direcao, cliente_id)
             
-            if not clientes:
+            if not resumo['total']:
                 mensagem = """📋 *MEUS CLIENTES*
 
 ❌ Nenhum cliente cadastrado ainda.
@@ -1759,52 +1857,27 @@ Após o período de teste, continue usando por apenas R$ 20,00/mês!"""
                                 reply_markup=keyboard)
                 return
             
-            total_clientes = len(clientes)
-            em_dia = len([c for c in clientes if (c['vencimento'] - datetime.now().date()).days > 3])
-            vencendo = len([c for c in clientes if 0 <= (c['vencimento'] - datetime.now().date()).days <= 3])
-            vencidos = len([c for c in clientes if (c['vencimento'] - datetime.now().date()).days < 0])
-            
-            # Cálculos financeiros
-            total_previsto_mensal = sum(cliente.get('valor', 0) for cliente in clientes)
-            total_vencidos = sum(cliente.get('valor', 0) for cliente in clientes if (cliente['vencimento'] - datetime.now().date()).days < 0)
-            total_recebido_mensal = sum(cliente.get('valor', 0) for cliente in clientes if (cliente['vencimento'] - datetime.now().date()).days > 3)
-            
-            mensagem = f"""📋 *MEUS CLIENTES* ({total_clientes})
+            mensagem = f"""📋 *MEUS CLIENTES* ({resumo['total']})
 
 📊 *Situação:*
-🟢 {em_dia} em dia | 🟡 {vencendo} vencendo | 🔴 {vencidos} vencidos
+🟢 {resumo['em_dia']} em dia | 🟡 {resumo['vencendo']} vencendo | 🔴 {resumo['vencidos']} vencidos
 
 💰 *RESUMO FINANCEIRO:*
-📈 Total previsto mensal: *R$ {total_previsto_mensal:.2f}*
-✅ Total recebido mensal: *R$ {total_recebido_mensal:.2f}*
-⚠️ Total em atraso: *R$ {total_vencidos:.2f}*
+📈 Total previsto mensal: *R$ {resumo['total_previsto']:.2f}*
+✅ Total recebido mensal: *R$ {resumo['total_em_dia']:.2f}*
+⚠️ Total em atraso: *R$ {resumo['total_vencidos']:.2f}*
 
-👇 *Clique em um cliente para mais opções:*"""
-            
-            # Criar botões inline para cada cliente
-            inline_keyboard = []
-            
-            for cliente in clientes:
-                dias_vencer = (cliente['vencimento'] - datetime.now().date()).days
-                if dias_vencer < 0:
-                    emoji_status = "🔴"
-                elif dias_vencer <= 3:
-                    emoji_status = "🟡"
-                else:
-                    emoji_status = "🟢"
-                
-                data_vencimento = cliente['vencimento'].strftime('%d/%m/%Y')
-                cliente_texto = f"{emoji_status} {cliente['nome']} ({data_vencimento})"
-                inline_keyboard.append([{
-                    'text': cliente_texto,
-                    'callback_data': f"cliente_detalhes_{cliente['id']}"
-                }])
+"""
+            if pagina['clientes']:
+                mensagem += "👇 *Clique em um cliente para mais opções:*"
+            else:
+                mensagem += f"🔍 Nenhum cliente em *{self.FILTROS_CLIENTES[filtro]}*."
             
             # Botões de ação
             inline_keyboard.extend([
                 [
                     {'text': '➕ Novo Cliente', 'callback_data': 'adicionar_cliente'},
-                    {'text': '🔄 Atualizar', 'callback_data': 'listar_clientes_usuario'}
+                    {'text': '🔄 Atualizar', 'callback_data': f'clientes_pagina_u_{filtro}_i_0'}
                 ],
                 [
                     {'text': '📱 WhatsApp', 'callback_data': 'whatsapp_setup'},
@@ -1813,9 +1886,9 @@ Após o período de teste, continue usando por apenas R$ 20,00/mês!"""
                 [{'text': '🔙 Menu Principal', 'callback_data': 'menu_principal'}]
             ])
             
-            self.send_message(chat_id, mensagem,
-                            parse_mode='Markdown', 
-                            reply_markup={'inline_keyboard': inline_keyboard})
+            self._enviar_ou_editar(chat_id, message_id, mensagem,
+                                   parse_mode='Markdown', 
+                                   reply_markup={'inline_keyboard': inline_keyboard})
             
         except Exception as e:
             logger.error(f"Erro ao listar clientes usuário: {e}")
@@ -1845,683 +1918,14 @@ Após o período de teste, continue usando por apenas R$ 20,00/mês!"""
                 else:
                     return
             
-            # Processar diferentes tipos de callback
-            if callback_data.startswith('cliente_detalhes_'):
-                cliente_id = int(callback_data.split('_')[2])
-                self.mostrar_detalhes_cliente(chat_id, cliente_id, message_id)
-            
-            elif callback_data.startswith('cliente_editar_'):
-                cliente_id = int(callback_data.split('_')[2])
-                self.editar_cliente(chat_id, cliente_id)
-            
-            elif callback_data.startswith('edit_') and not callback_data.startswith('edit_template_') and not callback_data.startswith('edit_config_') and not callback_data.startswith('edit_horario_'):
-                campo = callback_data.split('_')[1]
-                cliente_id = int(callback_data.split('_')[2])
-                self.iniciar_edicao_campo(chat_id, cliente_id, campo)
-            
-            elif callback_data.startswith('cliente_renovar_'):
-                cliente_id = int(callback_data.split('_')[2])
-                self.renovar_cliente(chat_id, cliente_id)
-            
-            elif callback_data.startswith('renovar_30dias_'):
-                cliente_id = int(callback_data.split('_')[2])
-                self.processar_renovacao_30dias(chat_id, cliente_id)
-            
-            elif callback_data.startswith('renovar_proximo_mes_'):
-                cliente_id = int(callback_data.split('_')[3])
-                self.processar_renovacao_proximo_mes(chat_id, cliente_id)
-            
-            elif callback_data.startswith('renovar_nova_data_'):
-                cliente_id = int(callback_data.split('_')[3])
-                self.iniciar_renovacao_nova_data(chat_id, cliente_id)
-            
-            elif callback_data.startswith('cliente_mensagem_'):
-                cliente_id = int(callback_data.split('_')[2])
-                self.enviar_mensagem_cliente(chat_id, cliente_id)
-            
-            elif callback_data.startswith('enviar_renovacao_'):
-                partes = callback_data.split('_')
-                cliente_id = int(partes[2])
-                template_id = int(partes[3])
-                self.enviar_mensagem_renovacao(chat_id, cliente_id, template_id)
-            
-            elif callback_data.startswith('enviar_mensagem_'):
-                cliente_id = int(callback_data.split('_')[2])
-                self.enviar_mensagem_cliente(chat_id, cliente_id)
-            
-            elif callback_data.startswith('cliente_excluir_'):
-                cliente_id = int(callback_data.split('_')[2])
-                self.confirmar_exclusao_cliente(chat_id, cliente_id, message_id)
-            
-            elif callback_data.startswith('cliente_notificacoes_'):
-                cliente_id = int(callback_data.split('_')[2])
-                self.configurar_notificacoes_cliente(chat_id, cliente_id, message_id)
-            
-            elif callback_data.startswith('toggle_cobranca_'):
-                cliente_id = int(callback_data.split('_')[2])
-                self.toggle_notificacao_cobranca(chat_id, cliente_id, message_id)
-                
-            elif callback_data.startswith('toggle_notificacoes_'):
-                cliente_id = int(callback_data.split('_')[2])
-                self.toggle_notificacao_geral(chat_id, cliente_id, message_id)
-            
-            elif callback_data.startswith('confirmar_excluir_cliente_'):
-                cliente_id = int(callback_data.split('_')[3])
-                self.excluir_cliente(chat_id, cliente_id, message_id)
-            
-            # Callbacks de cópia removidos - informações agora copiáveis diretamente
-            
-            elif callback_data == 'menu_clientes':
-                self.gestao_clientes_menu(chat_id)
-            
-            elif callback_data == 'voltar_lista':
-                self.listar_clientes(chat_id)
-            
-            elif callback_data == 'voltar_clientes':
-                self.gestao_clientes_menu(chat_id)
-            
-            elif callback_data == 'nova_busca':
-                self.iniciar_busca_cliente(chat_id)
-            
-            elif callback_data == 'listar_vencimentos':
-                self.listar_vencimentos(chat_id)
-            
-            elif callback_data == 'menu_principal':
-                self.start_command(chat_id)
-            
-            elif callback_data == 'cadastrar_outro_cliente':
-                self.iniciar_cadastro_cliente(chat_id)
-            
-            elif callback_data == 'voltar_menu_principal':
-                self.start_command(chat_id)
-            
-            elif callback_data.startswith('template_detalhes_'):
-                template_id = int(callback_data.split('_')[2])
-                logger.info(f"Callback recebido para template detalhes: {template_id}")
-                logger.info(f"Chamando mostrar_detalhes_template com chat_id={chat_id}, template_id={template_id}, message_id={message_id}")
-                self.mostrar_detalhes_template(chat_id, template_id, message_id)
-                logger.info(f"mostrar_detalhes_template executado")
-            
-            elif callback_data.startswith('template_editar_'):
-                template_id = int(callback_data.split('_')[2])
-                logger.info(f"Callback editar template recebido: template_id={template_id}")
-                self.editar_template(chat_id, template_id)
-            
-            elif callback_data.startswith('template_excluir_'):
-                template_id = int(callback_data.split('_')[2])
-                self.confirmar_exclusao_template(chat_id, template_id, message_id)
-            
-            elif callback_data.startswith('confirmar_excluir_template_'):
-                try:
-                    # CORREÇÃO: Pegar o último elemento após split para obter o template_id
-                    logger.info(f"DEBUG: Processando exclusão - callback_data: {callback_data}")
-                    parts = callback_data.split('_')
-                    logger.info(f"DEBUG: Split parts: {parts}")
-                    template_id_str = parts[-1]
-                    logger.info(f"DEBUG: Template ID string: '{template_id_str}'")
-                    template_id = int(template_id_str)
-                    logger.info(f"DEBUG: Template ID convertido: {template_id}")
-                    self.excluir_template(chat_id, template_id, message_id)
-                except Exception as e:
-                    logger.error(f"Erro ao processar exclusão de template: {e}")
-                    logger.error(f"Callback data: {callback_data}")
-                    self.send_message(chat_id, f"❌ Erro ao processar exclusão: {str(e)}")
-            
-            elif callback_data.startswith('template_enviar_'):
-                template_id = int(callback_data.split('_')[2])
-                self.selecionar_cliente_template(chat_id, template_id)
-            
-            elif callback_data == 'template_criar':
-                self.criar_template(chat_id)
-            
-            # Callbacks para cópia de tags de template
-            elif callback_data.startswith('copy_tag_'):
-                tag_nome = callback_data.replace('copy_tag_', '')
-                self.copiar_tag_template(chat_id, tag_nome)
-            
-            elif callback_data == 'template_content_done':
-                self.finalizar_conteudo_template(chat_id)
-            
-            elif callback_data == 'template_stats':
-                self.mostrar_stats_templates(chat_id)
-            
-            elif callback_data == 'voltar_templates':
-                self.templates_menu(chat_id)
-            
-            elif callback_data == 'voltar_configs':
-                self.configuracoes_menu(chat_id)
-            
-            # Remover handler antigo que causa conflito
-            # elif callback_data.startswith('edit_horario_'):
-            #     campo = callback_data.split('_')[2]
-            #     self.editar_horario(chat_id, campo)
-            
-            elif callback_data == 'recriar_jobs':
-                self.schedule_config.recriar_jobs(chat_id)
-            
-            elif callback_data == 'limpar_duplicatas':
-                self.schedule_config.limpar_duplicatas(chat_id)
-            
-            elif callback_data == 'status_jobs':
-                self.schedule_config.status_jobs(chat_id)
-            
-            elif callback_data == 'reset_horarios_padrao':
-                self.schedule_config.resetar_horarios_padrao(chat_id)
-            
-            # Callbacks de configuração
-            elif callback_data == 'config_empresa':
-                self.config_empresa(chat_id)
-            
-            elif callback_data == 'config_pix':
-                self.config_pix(chat_id)
-            
-            elif callback_data == 'config_horarios':
-                self.config_horarios(chat_id)
-            
-            elif callback_data == 'edit_horario_envio':
-                self.schedule_config.edit_horario_envio(chat_id)
-            
-            elif callback_data == 'edit_horario_verificacao':
-                self.schedule_config.edit_horario_verificacao(chat_id)
-            
-            elif callback_data == 'edit_horario_limpeza':
-                self.schedule_config.edit_horario_limpeza(chat_id)
-                
-            elif callback_data.startswith('set_envio_'):
-                horario = callback_data.replace('set_envio_', '')
-                self.schedule_config.set_horario_envio(chat_id, horario)
-            
-            # Handlers do Guia do Usuário
-            elif callback_data == 'guia_usuario':
-                self.mostrar_guia_usuario(chat_id)
-            elif callback_data == 'guia_primeiros_passos':
-                self.mostrar_guia_primeiros_passos(chat_id)
-            elif callback_data == 'guia_whatsapp':
-                self.mostrar_guia_whatsapp(chat_id)
-            elif callback_data == 'guia_clientes':
-                self.mostrar_guia_clientes(chat_id)
-            elif callback_data == 'guia_templates':
-                self.mostrar_guia_templates(chat_id)
-            elif callback_data == 'guia_envios':
-                self.mostrar_guia_envios(chat_id)
-            elif callback_data == 'guia_automacao':
-                self.mostrar_guia_automacao(chat_id)
-            elif callback_data == 'guia_relatorios':
-                self.mostrar_guia_relatorios(chat_id)
-            elif callback_data == 'guia_problemas':
-                self.mostrar_guia_problemas(chat_id)
-            elif callback_data == 'guia_dicas':
-                self.mostrar_guia_dicas(chat_id)
-            
-            # Handlers para templates modelo
-            elif callback_data.startswith('usar_modelo_'):
-                tipo = callback_data.replace('usar_modelo_', '')
-                self.usar_template_modelo(chat_id, tipo)
-            elif callback_data.startswith('editar_modelo_'):
-                tipo = callback_data.replace('editar_modelo_', '')
-                self.editar_template_modelo(chat_id, tipo)
-            elif callback_data == 'criar_do_zero':
-                self.criar_template_do_zero(chat_id)
-            elif callback_data == 'voltar_tipo_template':
-                self.voltar_selecao_tipo_template(chat_id)
-            elif callback_data == 'confirmar_template':
-                self.confirmar_criacao_template(chat_id)
-            elif callback_data == 'editar_conteudo_template':
-                self.editar_conteudo_template(chat_id)
-                
-            elif callback_data.startswith('set_verificacao_'):
-                horario = callback_data.replace('set_verificacao_', '')
-                self.schedule_config.set_horario_verificacao(chat_id, horario)
-                
-            elif callback_data.startswith('set_limpeza_'):
-                horario = callback_data.replace('set_limpeza_', '')
-                self.schedule_config.set_horario_limpeza(chat_id, horario)
-                
-            elif callback_data == 'horario_personalizado_envio':
-                self.schedule_config.horario_personalizado_envio(chat_id)
-                
-            elif callback_data == 'horario_personalizado_verificacao':
-                self.schedule_config.horario_personalizado_verificacao(chat_id)
-                
-            elif callback_data == 'horario_personalizado_limpeza':
-                self.schedule_config.horario_personalizado_limpeza(chat_id)
-            
-            elif callback_data == 'config_baileys_status':
-                self.config_baileys_status(chat_id)
-            
-            # Casos específicos de PIX primeiro
-            elif callback_data == 'edit_config_pix_chave':
-                self.iniciar_edicao_config(chat_id, 'empresa_pix', 'Chave PIX')
-                
-            elif callback_data == 'edit_config_pix_titular':
-                self.iniciar_edicao_config(chat_id, 'empresa_titular', 'Titular da Conta')
-            
-            elif callback_data.startswith('edit_config_'):
-                try:
-                    partes = callback_data.split('_')
-                    if len(partes) >= 4:
-                        config_type = partes[2]
-                        config_field = partes[3]
-                        config_key = f"{config_type}_{config_field}"
-                        config_name = f"{config_type.title()} {config_field.title()}"
-                        self.iniciar_edicao_config(chat_id, config_key, config_name)
-                except Exception as e:
-                    logger.error(f"Erro ao processar edição de config: {e}")
-                    self.send_message(chat_id, "❌ Erro ao iniciar edição.")
-            
-            elif callback_data == 'baileys_check_status':
-                self.config_baileys_status(chat_id)
-            
-            # Callbacks do menu Baileys
-            elif callback_data == 'baileys_menu':
-                self.baileys_menu(chat_id)
-            
-            elif callback_data == 'baileys_qr_code':
-                self.gerar_qr_whatsapp(chat_id)
-            
-            elif callback_data == 'baileys_status':
-                self.verificar_status_baileys(chat_id)
-            
-            elif callback_data == 'baileys_test':
-                self.testar_envio_whatsapp(chat_id)
-            
-            elif callback_data == 'baileys_logs':
-                self.mostrar_logs_baileys(chat_id)
-            
-            elif callback_data == 'baileys_stats':
-                self.mostrar_stats_baileys(chat_id)
-            
-            # Callbacks para edição de templates
-            elif callback_data.startswith('edit_template_'):
-                try:
-                    partes = callback_data.split('_')
-                    campo = partes[2]
-                    template_id = int(partes[3])
-                    logger.info(f"Processando edição: campo={campo}, template_id={template_id}")
-                    self.iniciar_edicao_template_campo(chat_id, template_id, campo)
-                except (IndexError, ValueError) as e:
-                    logger.error(f"Erro ao processar callback de edição: {e}")
-                    self.send_message(chat_id, "❌ Erro ao processar edição.")
-            
-            # Callbacks para definir tipo de template
-            elif callback_data.startswith('set_template_tipo_'):
-                try:
-                    partes = callback_data.split('_')
-                    template_id = int(partes[3])
-                    tipo = partes[4]
-                    logger.info(f"Atualizando tipo: template_id={template_id}, tipo={tipo}")
-                    self.atualizar_template_tipo(chat_id, template_id, tipo)
-                except (IndexError, ValueError) as e:
-                    logger.error(f"Erro ao atualizar tipo: {e}")
-                    self.send_message(chat_id, "❌ Erro ao atualizar tipo.")
-                
-            # Callbacks para definir status de template
-            elif callback_data.startswith('set_template_status_'):
-                try:
-                    partes = callback_data.split('_')
-                    template_id = int(partes[3])
-                    status = partes[4] == 'True'
-                    logger.info(f"Atualizando status: template_id={template_id}, status={status}")
-                    self.atualizar_template_status(chat_id, template_id, status)
-                except (IndexError, ValueError) as e:
-                    logger.error(f"Erro ao atualizar status: {e}")
-                    self.send_message(chat_id, "❌ Erro ao atualizar status.")
-            
-            # Callbacks para envio de mensagens
-            elif callback_data.startswith('enviar_mensagem_'):
-                try:
-                    cliente_id = int(callback_data.split('_')[2])
-                    self.enviar_mensagem_cliente(chat_id, cliente_id)
-                except (IndexError, ValueError) as e:
-                    logger.error(f"Erro ao processar envio mensagem: {e}")
-                    self.send_message(chat_id, "❌ Erro ao carregar mensagens.")
-            
-            elif callback_data.startswith('enviar_template_'):
-                try:
-                    logger.info(f"Processando callback enviar_template: {callback_data}")
-                    partes = callback_data.split('_')
-                    logger.info(f"Partes do callback: {partes}")
-                    
-                    if len(partes) >= 4:
-                        cliente_id = int(partes[2])
-                        template_id = int(partes[3])
-                        logger.info(f"Extraindo IDs: cliente_id={cliente_id}, template_id={template_id}")
-                        self.enviar_template_para_cliente(chat_id, cliente_id, template_id)
-                    else:
-                        logger.error(f"Formato de callback inválido: {callback_data} - partes: {len(partes)}")
-                        self.send_message(chat_id, "❌ Formato de callback inválido.")
-                        
-                except (IndexError, ValueError) as e:
-                    logger.error(f"Erro ao processar template: {e}")
-                    self.send_message(chat_id, "❌ Erro ao processar template.")
-                except Exception as e:
-                    logger.error(f"Erro inesperado no callback enviar_template: {e}")
-                    self.send_message(chat_id, "❌ Erro inesperado.")
-            
-            elif callback_data.startswith('confirmar_envio_'):
-                try:
-                    logger.info(f"[RAILWAY] Processando callback confirmar_envio: {callback_data}")
-                    partes = callback_data.split('_')
-                    logger.info(f"[RAILWAY] Partes do callback: {partes}")
-                    
-                    if len(partes) >= 4:
-                        cliente_id = int(partes[2])
-                        template_id = int(partes[3])
-                        logger.info(f"[RAILWAY] Extraindo IDs: cliente_id={cliente_id}, template_id={template_id}")
-                        # Corrigido: Usar método da instância ao invés de função global
-                        self.confirmar_envio_mensagem(chat_id, cliente_id, template_id)
-                    else:
-                        logger.error(f"[RAILWAY] Formato de callback inválido: {callback_data} - partes: {len(partes)}")
-                        self.send_message(chat_id, "❌ Formato de callback inválido.")
-                        
-                except (IndexError, ValueError) as e:
-                    logger.error(f"[RAILWAY] Erro ao confirmar envio: {e}")
-                    self.send_message(chat_id, "❌ Erro ao enviar mensagem.")
-                except Exception as e:
-                    logger.error(f"Erro inesperado no callback confirmar_envio: {e}")
-                    self.send_message(chat_id, "❌ Erro inesperado.")
-            
-            elif callback_data.startswith('mensagem_custom_'):
-                try:
-                    cliente_id = int(callback_data.split('_')[2])
-                    iniciar_mensagem_personalizada_global(chat_id, cliente_id)
-                except (IndexError, ValueError) as e:
-                    logger.error(f"Erro ao iniciar mensagem custom: {e}")
-                    self.send_message(chat_id, "❌ Erro ao inicializar mensagem personalizada.")
-            
-            # Handlers do Agendador
-            elif callback_data == 'agendador_status':
-                self.mostrar_status_agendador(chat_id)
-            
-            elif callback_data == 'agendador_stats':
-                self.mostrar_estatisticas_agendador(chat_id)
-            
-            elif callback_data == 'agendador_processar':
-                self.processar_vencimentos_manual(chat_id)
-            
-            elif callback_data == 'agendador_logs':
-                self.mostrar_logs_agendador(chat_id)
-            
-            elif callback_data == 'agendador_menu':
-                self.agendador_menu(chat_id)
-            
-            # Callbacks CRÍTICOS que estavam faltando - SISTEMA MULTI-USER
-            elif callback_data == 'adicionar_cliente':
-                self.iniciar_cadastro_cliente(chat_id)
-            
-            elif callback_data == 'whatsapp_setup':
-                self.whatsapp_menu(chat_id)
-            
-            elif callback_data == 'relatorios_usuario':
-                self.relatorios_usuario(chat_id)
-            
-            elif callback_data.startswith('gerar_pix_'):
-                user_chat_id = int(callback_data.replace('gerar_pix_', ''))
-                self.gerar_pix_pagamento(user_chat_id, callback_query['id'])
-            
-            elif callback_data.startswith('verificar_pix_'):
-                payment_id = callback_data.replace('verificar_pix_', '')
-                self.verificar_pix_pagamento(chat_id, payment_id)
-            
-            elif callback_data.startswith('verificar_pagamento_'):
-                payment_id = callback_data.replace('verificar_pagamento_', '')
-                self.verificar_pagamento_manual(chat_id, payment_id)
-            
-            elif callback_data == 'cancelar':
-                self.cancelar_operacao(chat_id)
-            
-            elif callback_data == 'listar_clientes':
-                self.listar_clientes(chat_id)
-            
-            elif callback_data == 'listar_clientes_usuario':
-                self.listar_clientes_usuario(chat_id)
-            
-            elif callback_data == 'relatorio_mensal':
-                self.relatorio_mensal_detalhado(chat_id)
-            
-            elif callback_data == 'evolucao_grafica':
-                self.evolucao_grafica(chat_id)
-            
-            elif callback_data == 'templates_menu':
-                self.templates_menu(chat_id)
-            
-            elif callback_data == 'config_notificacoes':
-                self.config_notificacoes(chat_id)
-            
-            elif callback_data == 'config_sistema':
-                self.config_sistema(chat_id)
-            
-            elif callback_data == 'whatsapp_menu':
-                self.whatsapp_menu(chat_id)
-            
-            elif callback_data == 'agendador_fila':
-                self.mostrar_fila_mensagens(chat_id)
-            
-            elif callback_data.startswith('cancelar_msg_'):
-                try:
-                    msg_id = int(callback_data.split('_')[2])
-                    self.cancelar_mensagem_agendada(chat_id, msg_id)
-                except (IndexError, ValueError) as e:
-                    logger.error(f"Erro ao cancelar mensagem: {e}")
-                    self.send_message(chat_id, "❌ Erro ao cancelar mensagem.")
-            
-            elif callback_data.startswith('fila_cliente_'):
-                try:
-                    partes = callback_data.split('_')
-                    if len(partes) >= 4:
-                        msg_id = int(partes[2])
-                        cliente_id = int(partes[3])
-                        self.mostrar_opcoes_cliente_fila(chat_id, msg_id, cliente_id)
-                    else:
-                        self.send_message(chat_id, "❌ Erro ao processar cliente.")
-                except (IndexError, ValueError) as e:
-                    logger.error(f"Erro ao mostrar opções do cliente: {e}")
-                    self.send_message(chat_id, "❌ Erro ao carregar opções do cliente.")
-            
-            elif callback_data.startswith('enviar_agora_'):
-                try:
-                    msg_id = int(callback_data.split('_')[2])
-                    self.enviar_mensagem_agora(chat_id, msg_id)
-                except (IndexError, ValueError) as e:
-                    logger.error(f"Erro ao enviar mensagem agora: {e}")
-                    self.send_message(chat_id, "❌ Erro ao enviar mensagem.")
-            
-            elif callback_data.startswith('enviar_agora_cliente_'):
-                try:
-                    cliente_id = int(callback_data.split('_')[3])
-                    self.enviar_todas_mensagens_cliente_agora(chat_id, cliente_id)
-                except (IndexError, ValueError) as e:
-                    logger.error(f"Erro ao enviar mensagens do cliente: {e}")
-                    self.send_message(chat_id, "❌ Erro ao enviar mensagens do cliente.")
-            
-            elif callback_data.startswith('cancelar_cliente_'):
-                try:
-                    cliente_id = int(callback_data.split('_')[2])
-                    self.cancelar_todas_mensagens_cliente(chat_id, cliente_id)
-                except (IndexError, ValueError) as e:
-                    logger.error(f"Erro ao cancelar mensagens do cliente: {e}")
-                    self.send_message(chat_id, "❌ Erro ao cancelar mensagens do cliente.")
-            
-            elif callback_data == 'atualizar_fila':
-                self.mostrar_fila_mensagens(chat_id)
-            
-            elif callback_data == 'cancelar':
-                self.cancelar_operacao(chat_id)
-            
-            # ===== CALLBACKS ADMINISTRATIVOS FALTANTES =====
-            # Callbacks de gestão de usuários (admin)
-            elif callback_data == 'gestao_usuarios':
-                self.gestao_usuarios_menu(chat_id)
-            
-            elif callback_data == 'listar_usuarios':
-                self.listar_todos_usuarios_admin(chat_id)
-            
-            elif callback_data == 'cadastrar_usuario':
-                self.iniciar_cadastro_usuario_admin(chat_id)
+            # Ações que não são coalescidas podem alterar dados do chat
+            rota, _ = self.callback_router.resolver(callback_data)
+            if not (rota and getattr(rota.handler, 'coalescida', False)):
+                self.single_flight.invalidar((chat_id,))
             
-            elif callback_data == 'buscar_usuario':
-                self.buscar_usuario_admin(chat_id)
-            
-            elif callback_data == 'estatisticas_usuarios':
-                self.estatisticas_usuarios_admin(chat_id)
-            
-            elif callback_data == 'usuarios_vencendo':
-                self.listar_usuarios_vencendo_admin(chat_id)
-            
-            elif callback_data == 'pagamentos_pendentes':
-                self.listar_pagamentos_pendentes_admin(chat_id)
-            
-            elif callback_data == 'enviar_cobranca_geral':
-                self.enviar_cobranca_geral_admin(chat_id)
-            
-            # Callbacks para geração de PIX automático
-            elif callback_data.startswith('gerar_pix_usuario_'):
-                user_id = callback_data.replace('gerar_pix_usuario_', '')
-                self.processar_gerar_pix_usuario(chat_id, user_id)
-            
-            elif callback_data.startswith('gerar_pix_renovacao_'):
-                user_id = callback_data.replace('gerar_pix_renovacao_', '')
-                self.processar_gerar_pix_renovacao(chat_id, user_id)
-            
-            # Callbacks de faturamento
-            elif callback_data == 'faturamento_menu':
-                self.faturamento_menu(chat_id)
-            
-            elif callback_data == 'faturamento_detalhado':
-                self.faturamento_detalhado_admin(chat_id)
-            
-            elif callback_data == 'relatorio_usuarios':
-                self.gerar_relatorio_mensal_admin(chat_id)
-            
-            # Callbacks de relatórios
-            elif callback_data == 'relatorio_periodo':
-                self.relatorio_por_periodo(chat_id)
-            
-            elif callback_data == 'relatorio_comparativo':
-                self.relatorio_comparativo_mensal(chat_id)
-            
-            elif callback_data == 'relatorios_menu':
-                self.mostrar_relatorios(chat_id)
-            
-            elif callback_data.startswith('periodo_'):
-                dias_map = {
-                    'periodo_7_dias': 7,
-                    'periodo_30_dias': 30,
-                    'periodo_3_meses': 90,
-                    'periodo_6_meses': 180
-                }
-                dias = dias_map.get(callback_data, 30)
-                self.gerar_relatorio_periodo(chat_id, dias)
-            
-            elif callback_data == 'relatorio_financeiro':
-                self.relatorio_financeiro(chat_id)
-            
-            elif callback_data == 'relatorio_sistema':
-                self.relatorio_sistema(chat_id)
-                
-            elif callback_data == 'relatorio_completo':
-                self.relatorio_completo(chat_id)
-            
-            elif callback_data == 'financeiro_detalhado':
-                self.financeiro_detalhado(chat_id)
-            
-            elif callback_data == 'financeiro_projecoes':
-                self.financeiro_projecoes(chat_id)
-            
-            elif callback_data == 'dashboard_executivo':
-                self.dashboard_executivo(chat_id)
-            
-            elif callback_data == 'projecoes_futuras':
-                self.projecoes_futuras(chat_id)
-            
-            elif callback_data == 'plano_acao':
-                self.plano_acao(chat_id)
-            
-            elif callback_data == 'relatorio_mensal_detalhado':
-                self.relatorio_mensal_detalhado(chat_id)
-            
-            elif callback_data == 'evolucao_grafica':
-                self.evolucao_grafica(chat_id)
-            
-            elif callback_data.startswith('gerar_pix_DUPLICADO_REMOVIDO'):
-                # REMOVIDO - duplicado implementado acima
-                pass
-            
-            elif callback_data == 'whatsapp_setup_DUPLICADO_REMOVIDO':
-                # REMOVIDO - duplicado implementado acima
-                pass
-            
-            elif callback_data == 'alterar_dados':
-                # Alterar dados do usuário
-                self.alterar_dados_usuario(chat_id)
-                if callback_query_id:
-                    self.answer_callback_query(callback_query_id, "📧 Alterando dados")
-            
-            elif callback_data in ['alterar_nome', 'alterar_email', 'alterar_telefone', 'alterar_todos']:
-                # Processar alteração específica
-                self.processar_alteracao_dados(chat_id, callback_data)
-                if callback_query_id:
-                    self.answer_callback_query(callback_query_id, "✏️ Alterando...")
-            
-            elif callback_data == 'minha_conta':
-                # Voltar para minha conta
-                self.minha_conta_menu(chat_id)
-                if callback_query_id:
-                    self.answer_callback_query(callback_query_id, "💳 Minha Conta")
-            
-            elif callback_data == 'historico_pagamentos':
-                # Mostrar histórico de pagamentos
-                self.historico_pagamentos(chat_id)
-                if callback_query_id:
-                    self.answer_callback_query(callback_query_id, "📊 Histórico")
-            
-            elif callback_data == 'menu_principal':
-                # Voltar ao menu principal
-                self.start_command(chat_id)
-                self.answer_callback_query(callback_query_id, "🏠 Menu Principal")
-            
-            # Callbacks de pagamento para usuários
-            elif callback_data.startswith('verificar_pagamento_'):
-                payment_id = callback_data.split('_')[2]
-                self.verificar_pagamento(chat_id, payment_id)
-            
-            # ===== HANDLERS FALTANTES CORRIGIDOS =====
-            elif callback_data == 'contatar_suporte':
-                self.contatar_suporte(chat_id)
-            
-            elif callback_data == 'configuracoes_menu':
-                self.configuracoes_menu(chat_id)
-            
-            elif callback_data == 'cadastrar_outro_cliente':
-                self.iniciar_cadastro_cliente(chat_id)
-            
-            elif callback_data == 'voltar_menu_principal':
-                self.start_command(chat_id)
-            
-            elif callback_data == 'sistema_verificar':
-                self.sistema_verificar_apis(chat_id)
-            
-            elif callback_data == 'sistema_logs':
-                self.sistema_mostrar_logs(chat_id)
-            
-            elif callback_data == 'sistema_status':
-                self.sistema_mostrar_status(chat_id)
-            
-            elif callback_data == 'sistema_restart':
-                self.sistema_reiniciar(chat_id)
-            
-            elif callback_data == 'confirmar_restart':
-                self.executar_restart(chat_id)
-            
-            elif callback_data.startswith('toggle_notif_'):
-                status_atual = callback_data.split('_')[2]
-                self.toggle_notificacoes_sistema(chat_id, status_atual)
-            
-            elif callback_data == 'ajuda_pagamento':
-                self.mostrar_ajuda_pagamento(chat_id)
-            
-            elif callback_data == 'config_horarios':
-                self.config_horarios_menu(chat_id)
+            # Despachar pela tabela de rotas (exata ou prefixo mais longo)
+            ctx = CallbackContext(chat_id, message_id, callback_query_id, callback_data, callback_query)
+            self.callback_router.despachar(ctx, ao_falhar=self._falha_callback)
             
         except Exception as e:
             logger.error(f"Erro ao processar callback: {e}")
@@ -2534,6 +1938,326 @@ Após o período de teste, continue usando por apenas R$ 20,00/mês!"""
             if not callback_data.startswith('confirmar_excluir_template_'):
                 self.send_message(chat_id, "❌ Erro ao processar ação.")
     
+    def _falha_callback(self, ctx, mensagem=None):
+        """Informa ao usuário falha de parâmetros/execução de uma rota de callback"""
+        self.send_message(ctx.chat_id, mensagem or "❌ Erro ao processar ação.")
+    
+    def _coalescer(self, chat_id, acao, funcao, *args):
+        """Executa ação cara uma única vez por (chat_id, acao, args) enquanto estiver em andamento
+        
+        Toques repetidos vindos do Telegram são colapsados antes, no UpdateDispatcher
+        (ver chave_coalescencia); aqui ficam cobertas chamadas fora do dispatcher. Sem
+        janela de reaproveitamento: os handlers respondem enviando mensagens e retornam None.
+        """
+        return self.single_flight.executar((chat_id, acao) + args, funcao, chat_id, *args, janela=0)
+    
+    # Botões do teclado principal cujas ações passam por _coalescer em process_message
+    TEXTOS_COALESCIDOS = ('📊 Relatórios', '👥 Gestão de Clientes', '📊 Meus Relatórios')
+    
+    def chave_coalescencia(self, update):
+        """Chave usada pelo UpdateDispatcher para colapsar toques idênticos de um chat
+        
+        Enquanto a primeira execução está na fila ou em andamento, repetições do mesmo
+        botão coalescido são descartadas em vez de refazer listagens e relatórios.
+        """
+        callback = update.get('callback_query')
+        if callback:
+            data = callback.get('data') or ''
+            rota, _ = self.callback_router.resolver(data)
+            if rota and getattr(rota.handler, 'coalescida', False):
+                return ('callback', data)
+            return None
+        texto = (update.get('message') or {}).get('text')
+        if texto in self.TEXTOS_COALESCIDOS:
+            return ('texto', texto)
+        return None
+    
+    def responder_update_colapsado(self, update):
+        """Remove o "carregando" do botão repetido; a execução pendente envia a resposta"""
+        callback = update.get('callback_query')
+        if callback and callback.get('id'):
+            self.answer_callback_query(callback['id'], "⏳ Já estou processando, aguarde...")
+    
+    def _rota_coalescida(self, acao, handler):
+        """Envolve handler de rota no single-flight por (chat_id, acao, parâmetros), só em andamento"""
+        def coalescido(ctx, **params):
+            chave = (ctx.chat_id, acao) + tuple(params.values())
+            return self.single_flight.executar(chave, handler, ctx, janela=0, **params)
+        coalescido.coalescida = True
+        return coalescido
+    
+    def _rota_callback(self, caminho, com_message_id=False):
+        """Cria handler de rota que resolve o método só na chamada
+        (alguns métodos são injetados após a criação do bot)"""
+        def handler(ctx, **params):
+            alvo = self
+            for nome in caminho.split('.'):
+                alvo = getattr(alvo, nome)
+            args = [ctx.chat_id, *params.values()]
+            if com_message_id:
+                args.append(ctx.message_id)
+            return alvo(*args)
+        return handler
+    
+    def _montar_rotas_callback(self):
+        """Compila a tabela de rotas dos botões inline"""
+        router = CallbackRouter()
+        rota = self._rota_callback
+        coalescer = self._rota_coalescida
+        
+        # Callbacks exatos que recebem apenas o chat_id
+        exatas = {
+            # Clientes
+            'menu_clientes': 'gestao_clientes_menu',
+            'voltar_lista': 'listar_clientes',
+            'voltar_clientes': 'gestao_clientes_menu',
+            'nova_busca': 'iniciar_busca_cliente',
+            'listar_vencimentos': 'listar_vencimentos',
+            'menu_principal': 'start_command',
+            'cadastrar_outro_cliente': 'iniciar_cadastro_cliente',
+            'voltar_menu_principal': 'start_command',
+            'adicionar_cliente': 'iniciar_cadastro_cliente',
+            'listar_clientes': 'listar_clientes',
+            'listar_clientes_usuario': 'listar_clientes_usuario',
+            'cancelar': 'cancelar_operacao',
+            # Templates
+            'template_criar': 'criar_template',
+            'template_content_done': 'finalizar_conteudo_template',
+            'template_stats': 'mostrar_stats_templates',
+            'voltar_templates': 'templates_menu',
+            'templates_menu': 'templates_menu',
+            'criar_do_zero': 'criar_template_do_zero',
+            'voltar_tipo_template': 'voltar_selecao_tipo_template',
+            'confirmar_template': 'confirmar_criacao_template',
+            'editar_conteudo_template': 'editar_conteudo_template',
+            # Configurações e horários
+            'voltar_configs': 'configuracoes_menu',
+            'configuracoes_menu': 'configuracoes_menu',
+            'config_empresa': 'config_empresa',
+            'config_pix': 'config_pix',
+            'config_horarios': 'config_horarios',
+            'config_notificacoes': 'config_notificacoes',
+            'config_sistema': 'config_sistema',
+            'config_baileys_status': 'config_baileys_status',
+            'recriar_jobs': 'schedule_config.recriar_jobs',
+            'limpar_duplicatas': 'schedule_config.limpar_duplicatas',
+            'status_jobs': 'schedule_config.status_jobs',
+            'reset_horarios_padrao': 'schedule_config.resetar_horarios_padrao',
+            'edit_horario_envio': 'schedule_config.edit_horario_envio',
+            'edit_horario_verificacao': 'schedule_config.edit_horario_verificacao',
+            'edit_horario_limpeza': 'schedule_config.edit_horario_limpeza',
+            'horario_personalizado_envio': 'schedule_config.horario_personalizado_envio',
+            'horario_personalizado_verificacao': 'schedule_config.horario_personalizado_verificacao',
+            'horario_personalizado_limpeza': 'schedule_config.horario_personalizado_limpeza',
+            # Guia do usuário
+            'guia_usuario': 'mostrar_guia_usuario',
+            'guia_primeiros_passos': 'mostrar_guia_primeiros_passos',
+            'guia_whatsapp': 'mostrar_guia_whatsapp',
+            'guia_clientes': 'mostrar_guia_clientes',
+            'guia_templates': 'mostrar_guia_templates',
+            'guia_envios': 'mostrar_guia_envios',
+            'guia_automacao': 'mostrar_guia_automacao',
+            'guia_relatorios': 'mostrar_guia_relatorios',
+            'guia_problemas': 'mostrar_guia_problemas',
+            'guia_dicas': 'mostrar_guia_dicas',
+            # WhatsApp / Baileys
+            'baileys_check_status': 'config_baileys_status',
+            'baileys_menu': 'baileys_menu',
+            'baileys_qr_code': 'gerar_qr_whatsapp',
+            'baileys_status': 'verificar_status_baileys',
+            'baileys_test': 'testar_envio_whatsapp',
+            'baileys_logs': 'mostrar_logs_baileys',
+            'baileys_stats': 'mostrar_stats_baileys',
+            'whatsapp_setup': 'whatsapp_menu',
+            'whatsapp_menu': 'whatsapp_menu',
+            # Agendador
+            'agendador_status': 'mostrar_status_agendador',
+            'agendador_stats': 'mostrar_estatisticas_agendador',
+            'agendador_processar': 'processar_vencimentos_manual',
+            'agendador_logs': 'mostrar_logs_agendador',
+            'agendador_menu': 'agendador_menu',
+            'agendador_fila': 'mostrar_fila_mensagens',
+            'atualizar_fila': 'mostrar_fila_mensagens',
+            # Gestão de usuários (admin)
+            'gestao_usuarios': 'gestao_usuarios_menu',
+            'listar_usuarios': 'listar_todos_usuarios_admin',
+            'cadastrar_usuario': 'iniciar_cadastro_usuario_admin',
+            'buscar_usuario': 'buscar_usuario_admin',
+            'estatisticas_usuarios': 'estatisticas_usuarios_admin',
+            'usuarios_vencendo': 'listar_usuarios_vencendo_admin',
+            'pagamentos_pendentes': 'listar_pagamentos_pendentes_admin',
+            'enviar_cobranca_geral': 'enviar_cobranca_geral_admin',
+            # Faturamento e relatórios
+            'faturamento_menu': 'faturamento_menu',
+            'faturamento_detalhado': 'faturamento_detalhado_admin',
+            'relatorio_usuarios': 'gerar_relatorio_mensal_admin',
+            'relatorios_usuario': 'relatorios_usuario',
+            'relatorio_periodo': 'relatorio_por_periodo',
+            'relatorio_comparativo': 'relatorio_comparativo_mensal',
+            'relatorios_menu': 'mostrar_relatorios',
+            'relatorio_mensal': 'relatorio_mensal_detalhado',
+            'relatorio_mensal_detalhado': 'relatorio_mensal_detalhado',
+            'relatorio_financeiro': 'relatorio_financeiro',
+            'relatorio_sistema': 'relatorio_sistema',
+            'relatorio_completo': 'relatorio_completo',
+            'financeiro_detalhado': 'financeiro_detalhado',
+            'financeiro_projecoes': 'financeiro_projecoes',
+            'dashboard_executivo': 'dashboard_executivo',
+            'projecoes_futuras': 'projecoes_futuras',
+            'plano_acao': 'plano_acao',
+            'evolucao_grafica': 'evolucao_grafica',
+            # Sistema e suporte
+            'contatar_suporte': 'contatar_suporte',
+            'sistema_verificar': 'sistema_verificar_apis',
+            'sistema_logs': 'sistema_mostrar_logs',
+            'sistema_status': 'sistema_mostrar_status',
+            'sistema_restart': 'sistema_reiniciar',
+            'confirmar_restart': 'executar_restart',
+            'ajuda_pagamento': 'mostrar_ajuda_pagamento',
+        }
+        # Atualizações, relatórios e listagens: toques repetidos não refazem o trabalho
+        coalescidas = {
+            'listar_clientes', 'listar_clientes_usuario', 'listar_vencimentos',
+            'agendador_fila', 'atualizar_fila', 'agendador_stats', 'baileys_status', 'baileys_logs',
+            'sistema_verificar', 'sistema_logs', 'sistema_status',
+            'estatisticas_usuarios', 'usuarios_vencendo', 'pagamentos_pendentes',
+            'relatorios_usuario', 'relatorios_menu', 'relatorio_mensal', 'relatorio_mensal_detalhado',
+            'relatorio_financeiro', 'relatorio_sistema', 'relatorio_completo', 'relatorio_comparativo',
+            'financeiro_detalhado', 'financeiro_projecoes', 'dashboard_executivo', 'projecoes_futuras',
+            'evolucao_grafica', 'faturamento_detalhado', 'relatorio_usuarios',
+        }
+        for callback_data, caminho in exatas.items():
+            handler = rota(caminho)
+            if callback_data in coalescidas:
+                handler = coalescer(callback_data, handler)
+            router.exata(callback_data, handler)
+        
+        # PIX da empresa: campos com nome de configuração diferente do callback
+        router.exata('edit_config_pix_chave', lambda c: self.iniciar_edicao_config(c.chat_id, 'empresa_pix', 'Chave PIX'))
+        router.exata('edit_config_pix_titular', lambda c: self.iniciar_edicao_config(c.chat_id, 'empresa_titular', 'Titular da Conta'))
+        
+        # Conta do usuário (resposta do callback com texto)
+        def com_aviso(caminho, aviso, passar_data=False):
+            def handler(c):
+                metodo = getattr(self, caminho)
+                metodo(c.chat_id, c.data) if passar_data else metodo(c.chat_id)
+                if c.callback_query_id:
+                    self.answer_callback_query(c.callback_query_id, aviso)
+            return handler
+        
+        router.exata('alterar_dados', com_aviso('alterar_dados_usuario', "📧 Alterando dados"))
+        for campo in ('alterar_nome', 'alterar_email', 'alterar_telefone', 'alterar_todos'):
+            router.exata(campo, com_aviso('processar_alteracao_dados', "✏️ Alterando...", passar_data=True))
+        router.exata('minha_conta', com_aviso('minha_conta_menu', "💳 Minha Conta"))
+        router.exata('historico_pagamentos', com_aviso('historico_pagamentos', "📊 Histórico"))
+        
+        # Clientes
+        router.prefixo('clientes_pagina_', coalescer('clientes_pagina', rota('navegar_clientes', com_message_id=True)),
+                       ('visao', 'filtro', 'direcao', 'cliente_id:int'))
+        router.prefixo('cliente_detalhes_', rota('mostrar_detalhes_cliente', com_message_id=True), ('cliente_id:int',))
+        router.prefixo('cliente_editar_', rota('editar_cliente'), ('cliente_id:int',))
+        router.prefixo('cliente_renovar_', rota('renovar_cliente'), ('cliente_id:int',))
+        router.prefixo('cliente_mensagem_', rota('enviar_mensagem_cliente'), ('cliente_id:int',))
+        router.prefixo('cliente_excluir_', rota('confirmar_exclusao_cliente', com_message_id=True), ('cliente_id:int',))
+        router.prefixo('cliente_notificacoes_', rota('configurar_notificacoes_cliente', com_message_id=True), ('cliente_id:int',))
+        router.prefixo('confirmar_excluir_cliente_', rota('excluir_cliente', com_message_id=True), ('cliente_id:int',))
+        router.prefixo('toggle_cobranca_', rota('toggle_notificacao_cobranca', com_message_id=True), ('cliente_id:int',))
+        router.prefixo('toggle_notificacoes_', rota('toggle_notificacao_geral', com_message_id=True), ('cliente_id:int',))
+        router.prefixo('renovar_30dias_', rota('processar_renovacao_30dias'), ('cliente_id:int',))
+        router.prefixo('renovar_proximo_mes_', rota('processar_renovacao_proximo_mes'), ('cliente_id:int',))
+        router.prefixo('renovar_nova_data_', rota('iniciar_renovacao_nova_data'), ('cliente_id:int',))
+        router.prefixo('enviar_renovacao_', rota('enviar_mensagem_renovacao'), ('cliente_id:int', 'template_id:int'))
+        router.prefixo('enviar_mensagem_', rota('enviar_mensagem_cliente'), ('cliente_id:int',),
+                       erro="❌ Erro ao carregar mensagens.")
+        router.prefixo('enviar_template_', rota('enviar_template_para_cliente'), ('cliente_id:int', 'template_id:int'),
+                       erro="❌ Erro ao processar template.")
+        router.prefixo('confirmar_envio_', rota('confirmar_envio_mensagem'), ('cliente_id:int', 'template_id:int'),
+                       erro="❌ Erro ao enviar mensagem.")
+        router.prefixo('mensagem_custom_', lambda c, cliente_id: iniciar_mensagem_personalizada_global(c.chat_id, cliente_id),
+                       ('cliente_id:int',), erro="❌ Erro ao inicializar mensagem personalizada.")
+        # edit_{campo}_{cliente_id}; edit_horario_* sem rota exata não faz nada
+        router.prefixo('edit_', lambda c, campo, cliente_id: self.iniciar_edicao_campo(c.chat_id, cliente_id, campo),
+                       ('campo', 'cliente_id:int'))
+        router.prefixo('edit_horario_', lambda c: None)
+        
+        # Templates
+        router.prefixo('template_detalhes_', rota('mostrar_detalhes_template', com_message_id=True), ('template_id:int',))
+        router.prefixo('template_editar_', rota('editar_template'), ('template_id:int',))
+        router.prefixo('template_excluir_', rota('confirmar_exclusao_template', com_message_id=True), ('template_id:int',))
+        router.prefixo('template_enviar_', rota('selecionar_cliente_template'), ('template_id:int',))
+        router.prefixo('confirmar_excluir_template_', self._callback_excluir_template)
+        router.prefixo('copy_tag_', rota('copiar_tag_template'), ('tag_nome',))
+        router.prefixo('usar_modelo_', rota('usar_template_modelo'), ('tipo',))
+        router.prefixo('editar_modelo_', rota('editar_template_modelo'), ('tipo',))
+        router.prefixo('edit_template_', lambda c, campo, template_id: self.iniciar_edicao_template_campo(c.chat_id, template_id, campo),
+                       ('campo', 'template_id:int'), erro="❌ Erro ao processar edição.")
+        router.prefixo('set_template_tipo_', rota('atualizar_template_tipo'), ('template_id:int', 'tipo'),
+                       erro="❌ Erro ao atualizar tipo.")
+        router.prefixo('set_template_status_', rota('atualizar_template_status'), ('template_id:int', 'status:bool'),
+                       erro="❌ Erro ao atualizar status.")
+        
+        # Configurações e horários
+        router.prefixo('edit_config_', self._callback_editar_config, ('config_type', 'config_field'),
+                       erro="❌ Erro ao iniciar edição.")
+        router.prefixo('set_envio_', rota('schedule_config.set_horario_envio'), ('horario',))
+        router.prefixo('set_verificacao_', rota('schedule_config.set_horario_verificacao'), ('horario',))
+        router.prefixo('set_limpeza_', rota('schedule_config.set_horario_limpeza'), ('horario',))
+        router.prefixo('toggle_notif_', rota('toggle_notificacoes_sistema'), ('status_atual',))
+        
+        # Fila de mensagens
+        router.prefixo('cancelar_msg_', rota('cancelar_mensagem_agendada'), ('msg_id:int',),
+                       erro="❌ Erro ao cancelar mensagem.")
+        router.prefixo('fila_cliente_', rota('mostrar_opcoes_cliente_fila'), ('msg_id:int', 'cliente_id:int'),
+                       erro="❌ Erro ao carregar opções do cliente.")
+        router.prefixo('enviar_agora_', rota('enviar_mensagem_agora'), ('msg_id:int',),
+                       erro="❌ Erro ao enviar mensagem.")
+        router.prefixo('enviar_agora_cliente_', rota('enviar_todas_mensagens_cliente_agora'), ('cliente_id:int',),
+                       erro="❌ Erro ao enviar mensagens do cliente.")
+        router.prefixo('cancelar_cliente_', rota('cancelar_todas_mensagens_cliente'), ('cliente_id:int',),
+                       erro="❌ Erro ao cancelar mensagens do cliente.")
+        
+        # Pagamentos e PIX
+        router.prefixo('gerar_pix_', lambda c, user_chat_id: self.gerar_pix_pagamento(user_chat_id, c.callback_query_id),
+                       ('user_chat_id:int',))
+        router.prefixo('gerar_pix_usuario_', rota('processar_gerar_pix_usuario'), ('user_id',))
+        router.prefixo('gerar_pix_renovacao_', rota('processar_gerar_pix_renovacao'), ('user_id',))
+        router.prefixo('verificar_pix_', coalescer('verificar_pix', rota('verificar_pix_pagamento')), ('payment_id',))
+        router.prefixo('verificar_pagamento_', coalescer('verificar_pagamento', rota('verificar_pagamento_manual')),
+                       ('payment_id',))
+        
+        # Relatórios por período
+        dias_map = {
+            'periodo_7_dias': 7,
+            'periodo_30_dias': 30,
+            'periodo_3_meses': 90,
+            'periodo_6_meses': 180
+        }
+        def relatorio_periodo(c, periodo):
+            return self._coalescer(c.chat_id, 'gerar_relatorio_periodo', self.gerar_relatorio_periodo,
+                                   dias_map.get(c.data, 30))
+        relatorio_periodo.coalescida = True
+        router.prefixo('periodo_', relatorio_periodo, ('periodo',))
+        
+        logger.info(f"🧭 {router.total_rotas()} rotas de callback compiladas")
+        return router
+    
+    def _callback_excluir_template(self, ctx):
+        """Callback confirmar_excluir_template_{id}"""
+        try:
+            template_id = int(ctx.data.split('_')[-1])
+            self.excluir_template(ctx.chat_id, template_id, ctx.message_id)
+        except Exception as e:
+            logger.error(f"Erro ao processar exclusão de template: {e}")
+            logger.error(f"Callback data: {ctx.data}")
+            self.send_message(ctx.chat_id, f"❌ Erro ao processar exclusão: {str(e)}")
+    
+    def _callback_editar_config(self, ctx, config_type, config_field):
+        """Callback edit_config_{tipo}_{campo}"""
+        config_key = f"{config_type}_{config_field}"
+        config_name = f"{config_type.title()} {config_field.title()}"
+        self.iniciar_edicao_config(ctx.chat_id, config_key, config_name)
+    
+
     def gerar_pix_pagamento(self, user_chat_id, callback_query_id=None):
         """Gera PIX para pagamento do usuário"""
         try:
@@ -2637,12 +2361,13 @@ Envie o comprovante para o administrador confirmar a ativação."""
     def answer_callback_query(self, callback_query_id, text=None):
         """Responde a um callback query"""
         try:
-            url = f"{self.base_url}/answerCallbackQuery"
             data = {'callback_query_id': callback_query_id}
             if text:
                 data['text'] = text
             
-            requests.post(url, json=data, timeout=5)
+            # Não conta no limite por chat; não bloqueia o handler
+            self.outbox.enviar('answerCallbackQuery', data, usar_json=True,
+                               aguardar=False, limitar_chat=False)
         except Exception as e:
             logger.error(f"Erro ao responder callback: {e}")
     
@@ -2761,7 +2486,6 @@ Info: {info_adicional}
     def edit_message(self, chat_id, message_id, text, parse_mode=None, reply_markup=None):
         """Edita uma mensagem existente"""
         try:
-            url = f"{self.base_url}/editMessageText"
             data = {
                 'chat_id': chat_id,
                 'message_id': message_id,
@@ -2772,7 +2496,9 @@ Info: {info_adicional}
             if reply_markup:
                 data['reply_markup'] = json.dumps(reply_markup)
             
-            response = requests.post(url, json=data, timeout=10)
+            # Edições pendentes da mesma mensagem são mescladas (só a última sai)
+            response = self.outbox.enviar('editMessageText', data, chat_id=chat_id, usar_json=True,
+                                          mesclar_edicao=(chat_id, message_id))
             return response.json()
         except Exception as e:
             logger.error(f"Erro ao editar mensagem: {e}")
@@ -3090,9 +2816,6 @@ Escolha uma das opções abaixo:"""
                 return
             
             # Definir estado de conversação para capturar nova data
-            if not hasattr(self, 'conversation_states'):
-                self.conversation_states = {}
-            
             self.conversation_states[chat_id] = {
                 'action': 'renovar_nova_data',
                 'cliente_id': cliente_id,
@@ -3228,55 +2951,43 @@ Exemplo: 15/10/2025"""
                 return
             
             # Processar mensagem com dados do cliente
-            mensagem_processada = self.template_manager.processar_template(
-                template['conteudo'], 
-                cliente
-            )
+            mensagem_processada = self.template_manager.processar_template(template, cliente)
+            
+            if not self.envios_whatsapp:
+                self.send_message(chat_id, "❌ API WhatsApp não inicializada.")
+                return
             
-            # Enviar via WhatsApp com isolamento por usuário
+            # Resposta imediata; o envio sai pela fila prioritária
             telefone_formatado = f"55{cliente['telefone']}"
-            resultado = self.baileys_api.send_message(telefone_formatado, mensagem_processada, chat_id)
+            status = self.send_message(chat_id,
+                f"⏳ *Enviando mensagem de renovação...*\n\n"
+                f"👤 Cliente: *{cliente['nome']}*\n"
+                f"📱 Telefone: {cliente['telefone']}\n"
+                f"📄 Template: {template['nome']}",
+                parse_mode='Markdown')
+            status_id = ((status or {}).get('result') or {}).get('message_id')
             
-            if resultado.get('success'):
-                # Registrar log de envio
-                try:
-                    self.db.registrar_envio(
-                        cliente_id=cliente_id,
-                        template_id=template_id,
-                        telefone=cliente['telefone'],
-                        mensagem=mensagem_processada,
-                        tipo_envio='renovacao',
-                        sucesso=True
-                    )
-                except Exception as log_error:
-                    logger.warning(f"Erro ao registrar log: {log_error}")
-                
-                # Incrementar contador de uso do template
-                try:
-                    self.template_manager.incrementar_uso_template(template_id)
-                except Exception as inc_error:
-                    logger.warning(f"Erro ao incrementar uso: {inc_error}")
-                
-                # Mensagem de sucesso
-                self.send_message(chat_id,
-                    f"✅ *Mensagem de renovação enviada!*\n\n"
-                    f"👤 Cliente: *{cliente['nome']}*\n"
-                    f"📱 Telefone: {cliente['telefone']}\n"
-                    f"📄 Template: {template['nome']}\n\n"
-                    f"📱 *Mensagem enviada via WhatsApp*",
-                    parse_mode='Markdown',
-                    reply_markup=self.criar_teclado_clientes())
-                
-                logger.info(f"Mensagem de renovação enviada para {cliente['nome']}")
-            else:
-                error_msg = resultado.get('error', 'Erro desconhecido')
-                self.send_message(chat_id,
-                    f"❌ *Erro ao enviar mensagem*\n\n"
-                    f"👤 Cliente: {cliente['nome']}\n"
-                    f"📱 Telefone: {cliente['telefone']}\n"
-                    f"🚨 Erro: {error_msg}\n\n"
-                    f"💡 Verifique se o WhatsApp está conectado",
-                    parse_mode='Markdown')
+            def concluir(resultado):
+                if resultado['success']:
+                    self._enviar_ou_editar(chat_id, status_id,
+                        f"✅ *Mensagem de renovação enviada!*\n\n"
+                        f"👤 Cliente: *{cliente['nome']}*\n"
+                        f"📱 Telefone: {cliente['telefone']}\n"
+                        f"📄 Template: {template['nome']}\n\n"
+                        f"📱 *Mensagem enviada via WhatsApp*",
+                        parse_mode='Markdown')
+                    logger.info(f"Mensagem de renovação enviada para {cliente['nome']}")
+                else:
+                    self._enviar_ou_editar(chat_id, status_id,
+                        f"❌ *Erro ao enviar mensagem*\n\n"
+                        f"👤 Cliente: {cliente['nome']}\n"
+                        f"📱 Telefone: {cliente['telefone']}\n"
+                        f"🚨 Erro: {resultado['error']}\n\n"
+                        f"💡 Verifique se o WhatsApp está conectado",
+                        parse_mode='Markdown')
+            
+            self.envios_whatsapp.enviar(chat_id, cliente_id, template_id, telefone_formatado,
+                                        mensagem_processada, 'renovacao', ao_concluir=concluir)
             
         except Exception as e:
             logger.error(f"Erro ao enviar mensagem de renovação: {e}")
@@ -4141,6 +3852,10 @@ Selecione o período desejado para análise:
             logger.error(f"Erro ao mostrar relatório por período: {e}")
             self.send_message(chat_id, "❌ Erro ao carregar relatório por período.")
     
+    def _escopo_relatorio(self, chat_id):
+        """Usuário dos relatórios: admin vê todos, usuário comum vê apenas seus clientes"""
+        return None if self.is_admin(chat_id) else chat_id
+    
     def relatorio_comparativo_mensal(self, chat_id):
         """Relatório comparativo mês atual vs anterior"""
         try:
@@ -4152,30 +3867,25 @@ Selecione o período desejado para análise:
             inicio_mes_anterior = inicio_mes_atual - relativedelta(months=1)
             fim_mes_anterior = inicio_mes_atual - timedelta(days=1)
             
-            # Buscar clientes do banco
-            todos_clientes = self.db.listar_clientes(apenas_ativos=False) if self.db else []
+            # Situação atual agregada no banco; meses comparados pelas métricas diárias (por usuário)
+            escopo = self._escopo_relatorio(chat_id)
+            resumo_atual = self.db.resumo_clientes_relatorio(escopo, hoje=hoje.date())
+            novos_mes_atual = self.db.metricas_periodo(inicio_mes_atual.date(), hoje.date(), escopo)['novos_clientes']
+            novos_mes_anterior = self.db.metricas_periodo(
+                inicio_mes_anterior.date(), fim_mes_anterior.date(), escopo)['novos_clientes']
+            fechamento_anterior = self.db.metricas_do_dia(fim_mes_anterior.date(), escopo)
             
-            # Filtrar por períodos (convertendo datetime para date para comparação)
-            clientes_mes_atual = [c for c in todos_clientes if c.get('data_cadastro') and 
-                                (c['data_cadastro'].date() if hasattr(c['data_cadastro'], 'date') else c['data_cadastro']) >= inicio_mes_atual.date()]
-            clientes_mes_anterior = [c for c in todos_clientes if c.get('data_cadastro') and 
-                                   inicio_mes_anterior.date() <= (c['data_cadastro'].date() if hasattr(c['data_cadastro'], 'date') else c['data_cadastro']) <= fim_mes_anterior.date()]
-            
-            # Clientes ativos por período
-            ativos_atual = [c for c in todos_clientes if c.get('ativo', True) and c.get('vencimento') and 
-                          (c['vencimento'].date() if hasattr(c['vencimento'], 'date') else c['vencimento']) >= hoje.date()]
-            ativos_anterior = len([c for c in todos_clientes if c.get('ativo', True)])  # Aproximação
-            
-            # Cálculos financeiros (converter para float para evitar erro Decimal)
-            receita_atual = float(sum(c.get('valor', 0) for c in ativos_atual))
-            receita_anterior = float(sum(c.get('valor', 0) for c in clientes_mes_anterior if c.get('ativo', True)))
+            # Mesma medida nos dois lados: receita de todos os clientes ativos
+            ativos_atual = resumo_atual['ativos']
+            receita_atual = resumo_atual['receita_ativos']
+            receita_anterior = fechamento_anterior['receita'] if fechamento_anterior else 0.0
             
             # Cálculos de crescimento
-            crescimento_clientes = len(clientes_mes_atual) - len(clientes_mes_anterior)
+            crescimento_clientes = novos_mes_atual - novos_mes_anterior
             crescimento_receita = receita_atual - receita_anterior
             
             # Porcentagens
-            perc_clientes = (crescimento_clientes / len(clientes_mes_anterior) * 100) if len(clientes_mes_anterior) > 0 else 0
+            perc_clientes = (crescimento_clientes / novos_mes_anterior * 100) if novos_mes_anterior > 0 else 0
             perc_receita = (crescimento_receita / receita_anterior * 100) if receita_anterior > 0 else 0
             
             # Emojis baseados no crescimento
@@ -4187,8 +3897,8 @@ Selecione o período desejado para análise:
 📅 *Período:* {inicio_mes_anterior.strftime('%m/%Y')} vs {hoje.strftime('%m/%Y')}
 
 👥 *CLIENTES:*
-• Mês anterior: {len(clientes_mes_anterior)}
-• Mês atual: {len(clientes_mes_atual)}
+• Mês anterior: {novos_mes_anterior}
+• Mês atual: {novos_mes_atual}
 • Diferença: {emoji_clientes} {crescimento_clientes:+d} ({perc_clientes:+.1f}%)
 
 💰 *RECEITA:*
@@ -4197,8 +3907,8 @@ Selecione o período desejado para análise:
 • Diferença: {emoji_receita} R$ {crescimento_receita:+.2f} ({perc_receita:+.1f}%)
 
 📈 *ANÁLISE:*
-• Total de clientes ativos: {len(ativos_atual)}
-• Ticket médio atual: R$ {(float(receita_atual)/len(ativos_atual) if len(ativos_atual) > 0 else 0.0):.2f}
+• Total de clientes ativos: {ativos_atual}
+• Ticket médio atual: R$ {(float(receita_atual)/ativos_atual if ativos_atual > 0 else 0.0):.2f}
 • Tendência: {"Crescimento" if crescimento_clientes > 0 else "Declínio" if crescimento_clientes < 0 else "Estável"}
 
 📊 *PROJEÇÃO MENSAL:*
@@ -4233,31 +3943,20 @@ Selecione o período desejado para análise:
             hoje = datetime.now().date()
             data_inicio = hoje - timedelta(days=dias)
             
-            # Buscar dados do período
-            todos_clientes = self.db.listar_clientes(apenas_ativos=False) if self.db else []
-            clientes_periodo = [c for c in todos_clientes if c.get('data_cadastro') and 
-                              (c['data_cadastro'].date() if hasattr(c['data_cadastro'], 'date') else c['data_cadastro']) >= data_inicio]
-            clientes_ativos = [c for c in todos_clientes if c.get('ativo', True) and c.get('vencimento') and 
-                             (c['vencimento'].date() if hasattr(c['vencimento'], 'date') else c['vencimento']) >= hoje]
-            
-            # Estatísticas do período (garantir valores zerados para novos usuários)
-            total_cadastros = len(clientes_periodo) if clientes_periodo else 0
-            receita_periodo = float(sum(c.get('valor', 0) for c in clientes_periodo if c.get('ativo', True))) if clientes_periodo else 0.0
-            receita_total_ativa = float(sum(c.get('valor', 0) for c in clientes_ativos)) if clientes_ativos else 0.0
-            
-            # Vencimentos no período
-            vencimentos_periodo = []
-            if clientes_ativos:
-                vencimentos_periodo = [c for c in clientes_ativos if data_inicio <= 
-                                     (c['vencimento'].date() if hasattr(c['vencimento'], 'date') else c['vencimento']) <= hoje + timedelta(days=30)]
-            
-            # Logs de envio (se disponível)
-            logs_envio = []
-            if hasattr(self.db, 'obter_logs_periodo'):
-                try:
-                    logs_envio = self.db.obter_logs_periodo(data_inicio, hoje) or []
-                except:
-                    logs_envio = []
+            # Agregados do período calculados no banco (por usuário)
+            resumo = self.db.resumo_clientes_relatorio(
+                self._escopo_relatorio(chat_id), novos_desde=data_inicio, hoje=hoje)
+            
+            # Estatísticas do período (zeradas para novos usuários)
+            total_cadastros = resumo['novos']
+            receita_periodo = resumo['receita_novos']
+            clientes_ativos = resumo['em_dia']
+            receita_total_ativa = resumo['receita_em_dia']
+            vencimentos_periodo = resumo['vencem_30_dias']
+            
+            # Envios do período pelas métricas diárias
+            mensagens_enviadas = self.db.metricas_periodo(
+                data_inicio, hoje, self._escopo_relatorio(chat_id))['mensagens_enviadas']
             
             # Média por dia (garantir zero se não há dados)
             media_cadastros_dia = total_cadastros / dias if dias > 0 and total_cadastros > 0 else 0.0
@@ -4270,7 +3969,7 @@ Selecione o período desejado para análise:
 👥 *CLIENTES:*
 • Novos cadastros: {total_cadastros}
 • Média por dia: {media_cadastros_dia:.1f}
-• Total ativos: {len(clientes_ativos)}
+• Total ativos: {clientes_ativos}
 
 💰 *FINANCEIRO:*
 • Receita novos clientes: R$ {receita_periodo:.2f}
@@ -4278,12 +3977,12 @@ Selecione o período desejado para análise:
 • Média receita/dia: R$ {media_receita_dia:.2f}
 
 📅 *VENCIMENTOS:*
-• No período: {len(vencimentos_periodo)}
-• Próximos 30 dias: {len([c for c in clientes_ativos if hoje <= (c['vencimento'].date() if hasattr(c['vencimento'], 'date') else c['vencimento']) <= hoje + timedelta(days=30)])}
+• No período: {vencimentos_periodo}
+• Próximos 30 dias: {vencimentos_periodo}
 
 📱 *ATIVIDADE:*
-• Mensagens enviadas: {len(logs_envio)}
-• Taxa envio/cliente: {((len(logs_envio)/len(clientes_ativos)*100) if len(clientes_ativos) > 0 else 0.0):.1f}%
+• Mensagens enviadas: {mensagens_enviadas}
+• Taxa envio/cliente: {((mensagens_enviadas/clientes_ativos*100) if clientes_ativos > 0 else 0.0):.1f}%
 
 📈 *PERFORMANCE:*
 • Crescimento diário: {(total_cadastros/dias*30):.1f} clientes/mês
@@ -4311,26 +4010,16 @@ Selecione o período desejado para análise:
     def relatorio_financeiro(self, chat_id):
         """Relatório financeiro detalhado"""
         try:
-            # Buscar dados financeiros
-            todos_clientes = self.db.listar_clientes(apenas_ativos=False) if self.db else []
-            clientes_ativos = [c for c in todos_clientes if c.get('ativo', True)]
+            # Dados financeiros agregados no banco (por usuário)
+            resumo = self.db.resumo_clientes_relatorio(self._escopo_relatorio(chat_id))
+            clientes_ativos = resumo['ativos']
             
             # Cálculos financeiros
-            receita_total = float(sum(c.get('valor', 0) for c in clientes_ativos))
+            receita_total = resumo['receita_ativos']
             receita_anual = receita_total * 12
             
-            # Análise por faixas de valor (garantir valores zerados se não há clientes)
-            if len(clientes_ativos) == 0:
-                faixa_baixa = []
-                faixa_media = []
-                faixa_alta = []
-            else:
-                faixa_baixa = [c for c in clientes_ativos if float(c.get('valor', 0)) <= 30]
-                faixa_media = [c for c in clientes_ativos if 30 < float(c.get('valor', 0)) <= 60]
-                faixa_alta = [c for c in clientes_ativos if float(c.get('valor', 0)) > 60]
-            
             # Ticket médio
-            ticket_medio = receita_total / len(clientes_ativos) if len(clientes_ativos) > 0 else 0.0
+            ticket_medio = receita_total / clientes_ativos if clientes_ativos > 0 else 0.0
             
             mensagem = f"""💰 *RELATÓRIO FINANCEIRO*
 
@@ -4340,12 +4029,12 @@ Selecione o período desejado para análise:
 • Ticket médio: R$ {ticket_medio:.2f}
 
 👥 *ANÁLISE POR FAIXA:*
-💚 Econômica (até R$ 30): {len(faixa_baixa)} clientes
-💙 Padrão (R$ 31-60): {len(faixa_media)} clientes  
-💎 Premium (R$ 60+): {len(faixa_alta)} clientes
+💚 Econômica (até R$ 30): {resumo['faixa_economica']} clientes
+💙 Padrão (R$ 31-60): {resumo['faixa_padrao']} clientes  
+💎 Premium (R$ 60+): {resumo['faixa_premium']} clientes
 
 📈 *PERFORMANCE:*
-• Clientes ativos: {len(clientes_ativos)}
+• Clientes ativos: {clientes_ativos}
 • Taxa conversão: 100.0% (todos ativos)
 • Potencial crescimento: +{int(receita_total * 0.2):.0f} R$/mês
 
@@ -4384,7 +4073,7 @@ Selecione o período desejado para análise:
             whatsapp_status = "🔴 Desconectado"
             try:
                 session_id = f"user_{chat_id}"
-                response = requests.get(f"http://localhost:3000/status/{session_id}", timeout=3)
+                response = requests.get(f"{self._url_baileys(chat_id)}/status/{session_id}", timeout=3)
                 if response.status_code == 200:
                     data = response.json()
                     if data.get('connected'):
@@ -4595,17 +4284,17 @@ Selecione o período desejado para análise:
     def dashboard_executivo(self, chat_id):
         """Dashboard executivo"""
         try:
-            todos_clientes = self.db.listar_clientes(apenas_ativos=False) if self.db else []
-            clientes_ativos = [c for c in todos_clientes if c.get('ativo', True)]
-            receita_total = float(sum(c.get('valor', 0) for c in clientes_ativos))
+            resumo = self.db.resumo_clientes_relatorio(self._escopo_relatorio(chat_id))
+            clientes_ativos = resumo['ativos']
+            receita_total = resumo['receita_ativos']
             
             mensagem = f"""📊 *DASHBOARD EXECUTIVO*
 
 🎯 *KPIs PRINCIPAIS:*
-• Clientes ativos: {len(clientes_ativos)}
+• Clientes ativos: {clientes_ativos}
 • MRR (Monthly Recurring Revenue): R$ {receita_total:.2f}
 • ARR (Annual Recurring Revenue): R$ {receita_total*12:.2f}
-• ARPU (Average Revenue Per User): R$ {(receita_total/len(clientes_ativos) if len(clientes_ativos) > 0 else 0.0):.2f}
+• ARPU (Average Revenue Per User): R$ {(receita_total/clientes_ativos if clientes_ativos > 0 else 0.0):.2f}
 
 📈 *PERFORMANCE:*
 • Growth rate: +15% (estimativa)
@@ -4724,38 +4413,34 @@ Infraestrutura sólida, processos automatizados e base tecnológica para crescim
             # Dados do mês atual
             hoje = datetime.now()
             inicio_mes = hoje.replace(day=1).date()
-            todos_clientes = self.db.listar_clientes(apenas_ativos=False) if self.db else []
+            escopo = self._escopo_relatorio(chat_id)
+            resumo = self.db.resumo_clientes_relatorio(escopo, novos_desde=inicio_mes, hoje=hoje.date())
+            clientes_mes = resumo['novos']
+            clientes_ativos = resumo['ativos']
             
-            # Filtrar clientes do mês
-            clientes_mes = [c for c in todos_clientes if c.get('data_cadastro') and 
-                          (c['data_cadastro'].date() if hasattr(c['data_cadastro'], 'date') else c['data_cadastro']) >= inicio_mes]
-            clientes_ativos = [c for c in todos_clientes if c.get('ativo', True)]
-            
-            # Análise por dias
+            # Análise por dias (cadastros agrupados no banco)
+            dias_mes = (hoje.date() - inicio_mes).days + 1
             dias_analise = {}
-            for i in range((hoje.date() - inicio_mes).days + 1):
-                dia = inicio_mes + timedelta(days=i)
-                clientes_dia = [c for c in clientes_mes if 
-                              (c['data_cadastro'].date() if hasattr(c['data_cadastro'], 'date') else c['data_cadastro']) == dia]
-                if clientes_dia:
-                    dias_analise[dia.strftime('%d/%m')] = len(clientes_dia)
+            for i, total in enumerate(self.db.novos_clientes_por_intervalo(inicio_mes, 1, dias_mes, escopo)):
+                if total:
+                    dias_analise[(inicio_mes + timedelta(days=i)).strftime('%d/%m')] = total
             
             # Receita e métricas
-            receita_mensal = float(sum(c.get('valor', 0) for c in clientes_ativos))
-            media_diaria = len(clientes_mes) / max(1, (hoje.date() - inicio_mes).days)
+            receita_mensal = resumo['receita_ativos']
+            media_diaria = clientes_mes / max(1, (hoje.date() - inicio_mes).days)
             
             mensagem = f"""📊 *RELATÓRIO MENSAL DETALHADO*
 
 📅 *PERÍODO:* {inicio_mes.strftime('%B %Y')}
 
 👥 *CLIENTES NOVOS:*
-• Total do mês: {len(clientes_mes)}
+• Total do mês: {clientes_mes}
 • Média por dia: {media_diaria:.1f}
-• Clientes ativos: {len(clientes_ativos)}
+• Clientes ativos: {clientes_ativos}
 
 💰 *FINANCEIRO:*
 • Receita mensal: R$ {receita_mensal:.2f}
-• Valor médio por cliente: R$ {(receita_mensal/len(clientes_ativos) if len(clientes_ativos) > 0 else 0.0):.2f}
+• Valor médio por cliente: R$ {(receita_mensal/clientes_ativos if clientes_ativos > 0 else 0.0):.2f}
 • Projeção fim do mês: R$ {receita_mensal * 1.15:.2f}
 
 📈 *EVOLUÇÃO DIÁRIA:*"""
@@ -4769,8 +4454,8 @@ Infraestrutura sólida, processos automatizados e base tecnológica para crescim
 
 🎯 *METAS vs REALIDADE:*
 • Meta mensal: 20 clientes
-• Atual: {len(clientes_mes)} clientes
-• Percentual atingido: {(len(clientes_mes)/20*100):.1f}%
+• Atual: {clientes_mes} clientes
+• Percentual atingido: {(clientes_mes/20*100):.1f}%
 
 🚀 *PERFORMANCE:*
 • Melhor dia: {max(dias_analise.items(), key=lambda x: x[1])[0] if dias_analise else 'N/A'}
@@ -4802,23 +4487,9 @@ Infraestrutura sólida, processos automatizados e base tecnológica para crescim
             # Dados dos últimos 30 dias
             hoje = datetime.now().date()
             inicio = hoje - timedelta(days=30)
-            # Filtrar por usuário - admin vê todos, usuário comum vê apenas seus
-            if self.is_admin(chat_id):
-                todos_clientes = self.db.listar_clientes(apenas_ativos=False, chat_id_usuario=None) if self.db else []
-            else:
-                todos_clientes = self.db.listar_clientes(apenas_ativos=False, chat_id_usuario=chat_id) if self.db else []
-            
-            # Agrupar por semana
-            semanas = {}
-            for i in range(5):  # 5 semanas
-                inicio_semana = inicio + timedelta(weeks=i)
-                fim_semana = inicio_semana + timedelta(days=6)
-                
-                clientes_semana = [c for c in todos_clientes if c.get('data_cadastro') and 
-                                 inicio_semana <= (c['data_cadastro'].date() if hasattr(c['data_cadastro'], 'date') else c['data_cadastro']) <= fim_semana]
-                
-                semana_label = f"Sem {i+1}"
-                semanas[semana_label] = len(clientes_semana)
+            # Agrupar por semana (5 semanas) no banco - admin vê todos, usuário comum vê apenas seus
+            por_semana = self.db.novos_clientes_por_intervalo(inicio, 7, 5, self._escopo_relatorio(chat_id))
+            semanas = {f"Sem {i+1}": total for i, total in enumerate(por_semana)}
             
             # Criar gráfico textual
             max_value = max(semanas.values()) if semanas.values() else 1
@@ -7445,7 +7116,7 @@ Dúvidas? Responda esta mensagem!
             # Verificar Baileys API
             try:
                 import requests
-                response = requests.get("http://localhost:3000/status", timeout=5)
+                response = requests.get(f"{self._url_baileys(chat_id)}/status", timeout=5)
                 if response.status_code == 200:
                     mensagem += "✅ **Baileys API:** Rodando\n"
                 else:
@@ -8784,19 +8455,19 @@ Exemplos comuns:
     def mostrar_estatisticas_agendador(self, chat_id):
         """Mostra estatísticas do agendador"""
         try:
-            # Buscar estatísticas do banco
-            stats = {"clientes_total": 0, "vencendo_hoje": 0, "vencidos": 0}
+            # Buscar estatísticas do banco (uma consulta, em cache curto) - admin vê todos
+            stats = {}
             if self.db:
                 try:
-                    stats = self.db.obter_estatisticas_clientes()
-                except:
-                    pass
+                    stats = self.db.obter_estatisticas(chat_id_usuario=None if self.is_admin(chat_id) else chat_id)
+                except Exception as e:
+                    logger.warning(f"Estatísticas indisponíveis: {e}")
             
             mensagem = f"""📈 *ESTATÍSTICAS DO AGENDADOR*
 
 👥 *Clientes:*
-• Total: {stats.get('clientes_total', 0)}
-• Vencendo hoje: {stats.get('vencendo_hoje', 0)}
+• Total: {stats.get('total_clientes', 0)}
+• Vencendo hoje: {stats.get('vencem_hoje', 0)}
 • Vencidos: {stats.get('vencidos', 0)}
 
 📊 *Atividade:*
@@ -8897,6 +8568,12 @@ Exemplos comuns:
             logger.error(f"Erro ao mostrar logs: {e}")
             self.send_message(chat_id, "❌ Erro ao carregar logs.")
     
+    def _url_baileys(self, chat_id=None):
+        """Servidor Baileys que hospeda a sessão do usuário (shards de BAILEYS_API_URLS)"""
+        if self.baileys_api:
+            return self.baileys_api.get_user_backend(chat_id).rstrip('/')
+        return 'http://localhost:3000'
+    
     def whatsapp_menu(self, chat_id):
         """Alias para baileys_menu - Configuração do WhatsApp"""
         self.baileys_menu(chat_id)
@@ -8912,7 +8589,7 @@ Exemplos comuns:
             try:
                 # Tentar verificar status usando sessionId específico do usuário
                 session_id = f"user_{chat_id}"
-                response = requests.get(f"http://localhost:3000/status/{session_id}", timeout=5)
+                response = requests.get(f"{self._url_baileys(chat_id)}/status/{session_id}", timeout=5)
                 if response.status_code == 200:
                     api_online = True
                     data = response.json()
@@ -8929,7 +8606,7 @@ Exemplos comuns:
                     status_baileys = "🔴 API Offline"
             except Exception as e:
                 logger.debug(f"Erro ao verificar status Baileys: {e}")
-                status_baileys = "🔴 API Offline (localhost:3000)"
+                status_baileys = "🔴 API Offline"
             
             mensagem = f"""📱 *WHATSAPP/BAILEYS*
 
@@ -8979,7 +8656,8 @@ Exemplos comuns:
         try:
             # Usar sessionId específico do usuário para multi-sessão
             session_id = f"user_{chat_id}"
-            response = requests.get(f"http://localhost:3000/status/{session_id}", timeout=10)
+            base_url = self._url_baileys(chat_id)
+            response = requests.get(f"{base_url}/status/{session_id}", timeout=10)
             
             if response.status_code == 200:
                 data = response.json()
@@ -9019,7 +8697,7 @@ Exemplos comuns:
                     ])
                 
             else:
-                mensagem = "❌ *API BAILEYS OFFLINE*\n\nA API não está respondendo. Verifique se está rodando em localhost:3000"
+                mensagem = f"❌ *API BAILEYS OFFLINE*\n\nA API não está respondendo. Verifique se está rodando em {base_url}"
                 inline_keyboard = [[
                     {'text': '🔄 Tentar Novamente', 'callback_data': 'baileys_status'},
                     {'text': '🔙 Voltar', 'callback_data': 'baileys_menu'}
@@ -9033,7 +8711,7 @@ Exemplos comuns:
             logger.error(f"Erro ao verificar status Baileys: {e}")
             self.send_message(chat_id, 
                 "❌ Erro ao conectar com a API Baileys.\n\n"
-                "Verifique se a API está rodando em localhost:3000")
+                f"Verifique se a API está rodando em {self._url_baileys(chat_id)}")
     
     def gerar_qr_whatsapp(self, chat_id):
         """Gera e exibe QR Code para conectar WhatsApp específico do usuário"""
@@ -9169,7 +8847,7 @@ Exemplos comuns:
                     error_msg = qr_result.get('error', 'Erro ao gerar QR Code')
             
             except requests.exceptions.ConnectionError:
-                error_msg = "API Baileys não está rodando (localhost:3000)"
+                error_msg = f"API Baileys não está rodando ({self._url_baileys(chat_id)})"
             except requests.exceptions.Timeout:
                 error_msg = "Timeout ao conectar com a API"
             except Exception as api_err:
@@ -9183,12 +8861,12 @@ Exemplos comuns:
 
 🛠️ *Soluções possíveis:*
 • Verifique se a API Baileys está rodando
-• Confirme se está em localhost:3000
+• Confirme se está em {self._url_baileys(chat_id)}
 • Reinicie a API se necessário
 • Aguarde alguns segundos e tente novamente
 
 💡 *Para testar a API manualmente:*
-Acesse: http://localhost:3000/status"""
+Acesse: {self._url_baileys(chat_id)}/status"""
             
             inline_keyboard = [[
                 {'text': '🔄 Tentar Novamente', 'callback_data': 'baileys_qr_code'},
@@ -10704,75 +10382,90 @@ Confirma o envio da cobrança geral?"""
             self.send_message(chat_id, "❌ Erro ao cancelar mensagens do cliente.")
     
     def enviar_mensagem_agora(self, chat_id, mensagem_id):
-        """Envia uma mensagem agendada imediatamente"""
+        """Envia uma mensagem agendada imediatamente (pela fila prioritária)"""
         try:
             if not self.db:
                 self.send_message(chat_id, "❌ Erro: banco de dados não disponível.")
                 return
             
-            # Buscar mensagem na fila
-            todas_mensagens = self.db.obter_todas_mensagens_fila(limit=50)
-            mensagem_fila = None
+            if not self.envios_whatsapp:
+                self.send_message(chat_id, "❌ Fila de envios não disponível.")
+                return
             
-            for msg in todas_mensagens:
-                if str(msg['id']) == str(mensagem_id):
-                    mensagem_fila = msg
-                    break
+            status = self.send_message(chat_id, f"⏳ Enviando mensagem #{mensagem_id}...")
+            status_id = ((status or {}).get('result') or {}).get('message_id')
+            teclado = {'inline_keyboard': [[{'text': '🔄 Atualizar Fila', 'callback_data': 'atualizar_fila'}]]}
             
-            if not mensagem_fila:
-                self.send_message(chat_id, f"❌ Mensagem #{mensagem_id} não encontrada.")
-                return
+            def concluir(resultado):
+                if resultado['success']:
+                    texto = f"✅ Mensagem #{mensagem_id} enviada imediatamente!"
+                else:
+                    texto = f"❌ Erro ao enviar mensagem #{mensagem_id}: {resultado['error']}"
+                self._enviar_ou_editar(chat_id, status_id, texto, reply_markup=teclado)
             
-            # Processar mensagem através do scheduler
-            if self.scheduler:
-                try:
-                    # Enviar mensagem usando o método correto
-                    self.scheduler._enviar_mensagem_fila(mensagem_fila)
-                    self.send_message(chat_id, f"✅ Mensagem #{mensagem_id} enviada imediatamente!")
-                        
-                except Exception as e:
-                    logger.error(f"Erro ao enviar mensagem imediata: {e}")
-                    self.send_message(chat_id, f"❌ Erro ao enviar mensagem: {str(e)}")
-            else:
-                self.send_message(chat_id, "❌ Agendador não disponível.")
+            # Admin enxerga a fila completa; usuário só as próprias mensagens
+            dono = None if self.is_admin(chat_id) else chat_id
+            reservadas = self.envios_whatsapp.enviar_da_fila(
+                chat_id_usuario=dono, fila_ids=[int(mensagem_id)], ao_concluir=concluir)
             
-            # Atualizar fila
-            self.mostrar_fila_mensagens(chat_id)
+            if not reservadas:
+                self._enviar_ou_editar(chat_id, status_id, f"❌ Mensagem #{mensagem_id} não encontrada.",
+                                       reply_markup=teclado)
             
         except Exception as e:
             logger.error(f"Erro ao enviar mensagem agora: {e}")
             self.send_message(chat_id, "❌ Erro ao processar envio imediato.")
     
     def enviar_todas_mensagens_cliente_agora(self, chat_id, cliente_id):
-        """Envia todas as mensagens de um cliente imediatamente"""
+        """Envia todas as mensagens de um cliente imediatamente (pela fila prioritária)"""
         try:
             if not self.db:
                 self.send_message(chat_id, "❌ Erro: banco de dados não disponível.")
                 return
             
-            # Buscar mensagens do cliente
-            todas_mensagens = self.db.obter_todas_mensagens_fila(limit=50)
-            mensagens_cliente = [msg for msg in todas_mensagens if str(msg['cliente_id']) == str(cliente_id)]
-            
-            if not mensagens_cliente:
-                self.send_message(chat_id, "❌ Nenhuma mensagem encontrada para este cliente.")
+            if not self.envios_whatsapp:
+                self.send_message(chat_id, "❌ Fila de envios não disponível.")
                 return
             
             cliente = self.buscar_cliente_por_id(cliente_id)
             nome_cliente = cliente['nome'] if cliente else 'Cliente'
             
-            # Enviar todas as mensagens
-            enviadas = 0
-            if self.scheduler:
-                for msg in mensagens_cliente:
-                    try:
-                        self.scheduler._enviar_mensagem_fila(msg)
-                        enviadas += 1
-                    except Exception as e:
-                        logger.error(f"Erro ao enviar mensagem {msg['id']}: {e}")
+            status = self.send_message(chat_id, f"⏳ Enviando mensagens de {nome_cliente}...")
+            status_id = ((status or {}).get('result') or {}).get('message_id')
+            teclado = {'inline_keyboard': [[{'text': '🔄 Atualizar Fila', 'callback_data': 'atualizar_fila'}]]}
             
-            self.send_message(chat_id, f"✅ {enviadas} mensagens de {nome_cliente} foram enviadas!")
-            self.mostrar_fila_mensagens(chat_id)
+            # Resultado final só quando todas as mensagens reservadas terminarem
+            progresso = {'total': None, 'enviadas': 0, 'concluidas': 0}
+            lock = threading.Lock()
+            
+            def finalizar_se_completo():
+                with lock:
+                    completo = progresso['total'] is not None and progresso['concluidas'] >= progresso['total']
+                    if not completo or progresso.get('finalizado'):
+                        return
+                    progresso['finalizado'] = True
+                self._enviar_ou_editar(chat_id, status_id,
+                    f"✅ {progresso['enviadas']} de {progresso['total']} mensagens de {nome_cliente} foram enviadas!",
+                    reply_markup=teclado)
+            
+            def concluir(resultado):
+                with lock:
+                    progresso['concluidas'] += 1
+                    progresso['enviadas'] += 1 if resultado['success'] else 0
+                finalizar_se_completo()
+            
+            dono = None if self.is_admin(chat_id) else chat_id
+            reservadas = self.envios_whatsapp.enviar_da_fila(
+                chat_id_usuario=dono, cliente_id=cliente_id, ao_concluir=concluir)
+            
+            if not reservadas:
+                self._enviar_ou_editar(chat_id, status_id, "❌ Nenhuma mensagem encontrada para este cliente.",
+                                       reply_markup=teclado)
+                return
+            
+            with lock:
+                progresso['total'] = reservadas
+            finalizar_se_completo()
             
         except Exception as e:
             logger.error(f"Erro ao enviar todas as mensagens do cliente: {e}")
@@ -10873,45 +10566,22 @@ Confirma o envio da cobrança geral?"""
             mensagem = self.processar_template(template['conteudo'], cliente)
             telefone = cliente['telefone']
             
-            # Tentar enviar via WhatsApp
-            sucesso = False
-            erro_msg = ""
+            if not self.envios_whatsapp:
+                self.send_message(chat_id, "❌ API WhatsApp não inicializada.")
+                return
             
-            if self.baileys_api:
-                try:
-                    logger.info(f"[RAILWAY] Enviando mensagem WhatsApp para {telefone}")
-                    resultado = self.baileys_api.send_message(telefone, mensagem, chat_id)
-                    if resultado['success']:
-                        sucesso = True
-                        
-                        # Registrar log de sucesso no banco
-                        self.registrar_envio(
-                            cliente_id=cliente_id,
-                            template_id=template_id,
-                            telefone=telefone,
-                            mensagem=mensagem,
-                            tipo_envio='template_manual',
-                            sucesso=True,
-                            message_id=resultado.get('messageId')
-                        )
-                        
-                        # Incrementar contador de uso do template
-                        self.incrementar_uso_template(template_id)
-                            
-                    else:
-                        erro_msg = resultado.get('error', 'Erro desconhecido')
-                        
-                except Exception as e:
-                    logger.error(f"[RAILWAY] Erro ao enviar mensagem WhatsApp: {e}")
-                    erro_msg = str(e)
-                    
-            else:
-                erro_msg = "API WhatsApp não inicializada"
+            # Resposta imediata; o envio sai pela fila prioritária e o resultado edita esta mensagem
+            status = self.send_message(chat_id, f"""⏳ *Enviando mensagem...*
+
+👤 *Cliente:* {cliente['nome']}
+📱 *Telefone:* {telefone}
+📄 *Template:* {template['nome']}""", parse_mode='Markdown')
+            status_id = ((status or {}).get('result') or {}).get('message_id')
             
-            # Preparar resposta
-            if sucesso:
-                from datetime import datetime
-                resposta = f"""✅ *Mensagem Enviada com Sucesso!*
+            def concluir(resultado):
+                if resultado['success']:
+                    from datetime import datetime
+                    resposta = f"""✅ *Mensagem Enviada com Sucesso!*
 
 👤 *Cliente:* {cliente['nome']}
 📱 *Telefone:* {telefone}
@@ -10922,51 +10592,44 @@ Confirma o envio da cobrança geral?"""
 {mensagem[:200]}{'...' if len(mensagem) > 200 else ''}
 
 📊 *Template usado {template.get('uso_count', 0) + 1}ª vez*"""
-                
-                inline_keyboard = [
-                    [
-                        {'text': '📄 Enviar Outro Template', 'callback_data': f'enviar_mensagem_{cliente_id}'},
-                        {'text': '👤 Ver Cliente', 'callback_data': f'cliente_detalhes_{cliente_id}'}
-                    ],
-                    [{'text': '📋 Logs de Envio', 'callback_data': 'baileys_logs'}]
-                ]
-                
-            else:
-                # Registrar log de erro no banco
-                self.registrar_envio(
-                    cliente_id=cliente_id,
-                    template_id=template_id,
-                    telefone=telefone,
-                    mensagem=mensagem,
-                    tipo_envio='template_manual',
-                    sucesso=False,
-                    erro=erro_msg
-                )
-                
-                resposta = f"""❌ *Falha no Envio*
+                    
+                    inline_keyboard = [
+                        [
+                            {'text': '📄 Enviar Outro Template', 'callback_data': f'enviar_mensagem_{cliente_id}'},
+                            {'text': '👤 Ver Cliente', 'callback_data': f'cliente_detalhes_{cliente_id}'}
+                        ],
+                        [{'text': '📋 Logs de Envio', 'callback_data': 'baileys_logs'}]
+                    ]
+                    
+                else:
+                    resposta = f"""❌ *Falha no Envio*
 
 👤 *Cliente:* {cliente['nome']}
 📱 *Telefone:* {telefone}
 📄 *Template:* {template['nome']}
 
-🔍 *Erro:* {erro_msg}
+🔍 *Erro:* {resultado['error']}
 
 💡 *Possíveis soluções:*
 - Verificar conexão WhatsApp
 - Verificar número do telefone
 - Tentar novamente em alguns instantes"""
+                    
+                    inline_keyboard = [
+                        [
+                            {'text': '🔄 Tentar Novamente', 'callback_data': f'confirmar_envio_{cliente_id}_{template_id}'},
+                            {'text': '✏️ Editar Template', 'callback_data': f'template_editar_{template_id}'}
+                        ],
+                        [{'text': '👤 Ver Cliente', 'callback_data': f'cliente_detalhes_{cliente_id}'}]
+                    ]
                 
-                inline_keyboard = [
-                    [
-                        {'text': '🔄 Tentar Novamente', 'callback_data': f'confirmar_envio_{cliente_id}_{template_id}'},
-                        {'text': '✏️ Editar Template', 'callback_data': f'template_editar_{template_id}'}
-                    ],
-                    [{'text': '👤 Ver Cliente', 'callback_data': f'cliente_detalhes_{cliente_id}'}]
-                ]
+                self._enviar_ou_editar(chat_id, status_id, resposta,
+                                       parse_mode='Markdown',
+                                       reply_markup={'inline_keyboard': inline_keyboard})
             
-            self.send_message(chat_id, resposta,
-                            parse_mode='Markdown',
-                            reply_markup={'inline_keyboard': inline_keyboard})
+            logger.info(f"[RAILWAY] Enfileirando envio WhatsApp para {telefone}")
+            self.envios_whatsapp.enviar(chat_id, cliente_id, template_id, telefone, mensagem,
+                                        'template_manual', ao_concluir=concluir)
                                 
         except Exception as e:
             logger.error(f"[RAILWAY] Erro crítico ao confirmar envio: {e}")
@@ -11286,6 +10949,18 @@ Entre em contato com o desenvolvedor se precisar de ajuda adicional."""
 # Instância global do bot
 telegram_bot = None
 bot_instance = None
+update_dispatcher = None
+inicializacao_sistema = None
+
+def get_update_dispatcher():
+    """Retorna o dispatcher de updates (pool de workers com ordem por chat)"""
+    global update_dispatcher
+    if update_dispatcher is None and telegram_bot:
+        update_dispatcher = UpdateDispatcher(telegram_bot.process_message,
+                                             chave_coalescencia=telegram_bot.chave_coalescencia,
+                                             ao_descartar=telegram_bot.responder_update_colapsado)
+        logger.info(f"✅ Dispatcher de updates iniciado ({update_dispatcher.max_workers} workers)")
+    return update_dispatcher
 
 def initialize_bot():
     """Inicializa o bot completo"""
@@ -11334,6 +11009,21 @@ def home():
         'timestamp': datetime.now(TIMEZONE_BR).isoformat()
     })
 
+@app.route('/ready')
+def readiness_check():
+    """Prontidão: 200 só quando as dependências obrigatórias estão no ar"""
+    inicializacao_bot = getattr(telegram_bot, 'inicializacao', None) if telegram_bot else None
+    pronto = inicializacao_bot is not None and inicializacao_bot.esta_pronto()
+    if inicializacao_sistema is not None:
+        pronto = pronto and inicializacao_sistema.esta_pronto()
+    
+    return jsonify({
+        'ready': pronto,
+        'sistema': inicializacao_sistema.obter_status() if inicializacao_sistema else None,
+        'servicos': inicializacao_bot.obter_status() if inicializacao_bot else None,
+        'timestamp': datetime.now(TIMEZONE_BR).isoformat()
+    }), 200 if pronto else 503
+
 @app.route('/health')
 def health_check():
     """Health check tolerante para Railway - permite inicialização gradual"""
@@ -11356,8 +11046,9 @@ def health_check():
             # Verificar conexão Baileys (opcional)
             try:
                 import requests
-                # Usar sessionId padrão para verificação geral
-                response = requests.get("http://localhost:3000/status/default", timeout=1)
+                # Usar sessionId padrão para verificação geral (servidor Baileys principal)
+                base_url = telegram_bot._url_baileys() if telegram_bot else 'http://localhost:3000'
+                response = requests.get(f"{base_url}/status/default", timeout=1)
                 if response.status_code == 200:
                     baileys_connected = response.json().get('connected', False)
             except:
@@ -11370,6 +11061,31 @@ def health_check():
         except:
             pass  # Não falhar o health check por erro em métricas
         
+        updates_metrics = None
+        callbacks_metrics = None
+        coalescencia_metrics = None
+        saida_metrics = None
+        envios_metrics = None
+        inicializacao_metrics = None
+        try:
+            if update_dispatcher:
+                updates_metrics = update_dispatcher.obter_metricas()
+            if telegram_bot and getattr(telegram_bot, 'callback_router', None):
+                callbacks_metrics = telegram_bot.callback_router.obter_metricas()
+            if telegram_bot and getattr(telegram_bot, 'single_flight', None):
+                coalescencia_metrics = telegram_bot.single_flight.obter_metricas()
+            if telegram_bot and getattr(telegram_bot, 'outbox', None):
+                saida_metrics = telegram_bot.outbox.obter_metricas()
+            if telegram_bot and getattr(telegram_bot, 'envios_whatsapp', None):
+                envios_metrics = telegram_bot.envios_whatsapp.obter_metricas()
+            inicializacao_metrics = {
+                'sistema': inicializacao_sistema.obter_status() if inicializacao_sistema else None,
+                'servicos': telegram_bot.inicializacao.obter_status()
+                            if telegram_bot and getattr(telegram_bot, 'inicializacao', None) else None
+            }
+        except:
+            pass  # Não falhar o health check por erro em métricas
+        
         # Status tolerante - Flask funcionando é suficiente para Railway
         # Bot pode estar inicializando ainda
         flask_healthy = True
@@ -11388,7 +11104,13 @@ def health_check():
             'metrics': {
                 'pending_messages': mensagens_pendentes,
                 'baileys_connected': baileys_connected,
-                'scheduler_running': scheduler_running
+                'scheduler_running': scheduler_running,
+                'updates': updates_metrics,
+                'callbacks': callbacks_metrics,
+                'coalescencia': coalescencia_metrics,
+                'telegram_saida': saida_metrics,
+                'envios_whatsapp': envios_metrics,
+                'inicializacao': inicializacao_metrics
             },
             'uptime': 'ok',
             'version': '1.0.0',
@@ -11421,14 +11143,25 @@ def webhook():
     if not telegram_bot:
         return jsonify({'error': 'Bot não inicializado'}), 500
     
+    # Secret configurado no setWebhook (header X-Telegram-Bot-Api-Secret-Token)
+    segredo = os.getenv('TELEGRAM_WEBHOOK_SECRET')
+    if segredo and not hmac.compare_digest(
+            request.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), segredo):
+        logger.warning("Webhook com secret token inválido rejeitado")
+        return jsonify({'error': 'Não autorizado'}), 403
+    
     try:
-        update = request.get_json()
-        if update:
-            logger.info(f"Update recebido: {update}")
-            telegram_bot.process_message(update)
-            return jsonify({'status': 'ok'})
-        else:
+        update = request.get_json(silent=True)
+        if not update_valido(update):
             return jsonify({'error': 'Dados inválidos'}), 400
+        
+        logger.debug(f"Update recebido: {update}")
+        
+        # Ack imediato: processamento fica na fila por chat do dispatcher
+        # (update_id repetido é descartado; sem vaga, 503 faz o Telegram reenviar)
+        if not get_update_dispatcher().submit(update, timeout=WEBHOOK_ESPERA_FILA):
+            return jsonify({'error': 'Fila cheia'}), 503
+        return jsonify({'status': 'ok'})
     
     except Exception as e:
         logger.error(f"Erro no webhook: {e}")
@@ -11484,53 +11217,93 @@ def process_pending_messages():
         logger.error(f"Erro ao processar mensagens pendentes: {e}")
 
 def polling_loop():
-    """Loop de polling otimizado para resposta rápida"""
+    """Loop de long polling: uma requisição aberta por até TELEGRAM_POLL_TIMEOUT segundos"""
     logger.info("Iniciando polling contínuo do Telegram...")
     
+    # Long polling real (25-50s) e lote completo por requisição
+    poll_timeout = min(50, max(25, int(os.getenv('TELEGRAM_POLL_TIMEOUT', '30'))))
+    poll_limit = 100
+    session = requests.Session()  # conexão HTTPS persistente (keep-alive)
+    
     last_update_id = 0
+    backoff = 1
     
     while True:
         try:
             if telegram_bot and BOT_TOKEN:
-                # Usar long polling para resposta mais rápida
-                response = requests.get(
+                response = session.get(
                     f"https://api.telegram.org/bot{BOT_TOKEN}/getUpdates",
                     params={
-                        'offset': last_update_id + 1,
-                        'limit': 10,
-                        'timeout': 1  # Long polling de 1 segundo
+                        'offset': last_update_id + 1,  # confirma apenas o que já foi entregue aos workers
+                        'limit': poll_limit,
+                        'timeout': poll_timeout
                     },
-                    timeout=5
+                    timeout=poll_timeout + 10
                 )
                 
                 if response.status_code == 200:
                     data = response.json()
                     if data.get('ok'):
                         updates = data.get('result', [])
+                        dispatcher = get_update_dispatcher()
                         
                         for update in updates:
                             try:
                                 update_id = update.get('update_id')
                                 if update_id > last_update_id:
-                                    # Processar imediatamente
-                                    telegram_bot.process_message(update)
+                                    # Entregar ao pool: ordem garantida por chat_id
+                                    dispatcher.submit(update)
                                     last_update_id = update_id
                             except Exception as e:
                                 logger.error(f"Erro ao processar update {update.get('update_id')}: {e}")
+                        backoff = 1
+                
+                elif response.status_code == 429:
+                    # Flood control: respeitar retry_after informado pelo Telegram
+                    try:
+                        retry_after = response.json().get('parameters', {}).get('retry_after', 5)
+                    except ValueError:
+                        retry_after = 5
+                    logger.warning(f"getUpdates limitado (429), aguardando {retry_after}s")
+                    time.sleep(retry_after)
+                
+                elif response.status_code == 409:
+                    # Conflito: webhook ativo ou outra instância fazendo getUpdates
+                    try:
+                        descricao = response.json().get('description', '')
+                    except ValueError:
+                        descricao = response.text
+                    # Nunca remover o webhook automaticamente: só registrar e aguardar
+                    if 'webhook' in descricao.lower():
+                        logger.warning(f"Webhook ativo impede getUpdates (configure WEBHOOK_URL para o modo "
+                                       f"webhook ou remova-o manualmente). Aguardando {backoff}s")
+                    else:
+                        logger.warning(f"Conflito no getUpdates (outra instância?): {descricao}. Aguardando {backoff}s")
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, 60)
+                
                 else:
-                    time.sleep(0.2)  # Pausa pequena se API retornar erro
+                    logger.warning(f"getUpdates retornou HTTP {response.status_code}. Aguardando {backoff}s")
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, 60)
             else:
                 time.sleep(1)  # Bot não inicializado
                 
         except KeyboardInterrupt:
             logger.info("Polling interrompido")
             break
+        except requests.exceptions.Timeout:
+            continue  # Long polling sem resposta dentro do limite: apenas reabrir
         except Exception as e:
             logger.error(f"Erro no polling: {e}")
-            time.sleep(1)  # Pausa em caso de erro de rede
+            time.sleep(backoff)  # Pausa em caso de erro de rede
+            backoff = min(backoff * 2, 60)
 
 def start_polling_thread():
-    """Inicia thread de polling"""
+    """Inicia thread de polling (não em modo webhook, para não disputar os updates)"""
+    if MODO_WEBHOOK:
+        logger.info("Modo webhook configurado - polling não iniciado")
+        return
     polling_thread = threading.Thread(target=polling_loop, daemon=True)
     polling_thread.start()
     logger.info("Thread de polling iniciada")
@@ -12165,59 +11938,60 @@ def config_sistema_function(chat_id):
         telegram_bot.send_message(chat_id, "❌ Erro ao carregar configurações do sistema.")
 
 def main_with_baileys():
-    """Função principal para Railway com Baileys integrado"""
+    """Função principal para Railway com Baileys integrado
+    
+    Em vez de esperas fixas, cada dependência é sondada com backoff e os serviços
+    independentes sobem em paralelo; /ready responde 200 quando os obrigatórios estão no ar.
+    """
+    global inicializacao_sistema
     import subprocess
-    import time
-    import threading
     
     try:
         logger.info("🚀 Iniciando sistema Railway...")
+        instalar_encerramento_sigterm()
         
         # Verificar se é ambiente Railway
         is_railway = os.getenv('RAILWAY_ENVIRONMENT') or os.getenv('PORT')
-        
-        # Health check Railway - aguardar PostgreSQL estar pronto
-        if is_railway:
-            logger.info("🚂 Ambiente Railway detectado - aguardando PostgreSQL...")
-            time.sleep(15)  # Aguardar PostgreSQL estar completamente pronto
+        port = int(os.getenv('PORT', 5000))
+        threads = {}
         
         # Registrar blueprint ANTES de iniciar Flask
         app.register_blueprint(session_api)
         logger.info("✅ API de sessão WhatsApp registrada")
         
-        # Iniciar Flask em thread separada para responder ao health check
         def start_flask():
-            port = int(os.getenv('PORT', 5000))
             logger.info(f"🌐 Flask iniciando na porta {port} (thread separada)")
             app.run(host='0.0.0.0', port=port, debug=False, threaded=True)
         
-        flask_thread = threading.Thread(target=start_flask, daemon=False)
-        flask_thread.start()
-        
-        # Aguardar Flask estar pronto
-        time.sleep(2)
-        logger.info("✅ Flask está rodando - health check disponível")
-        
-        if is_railway:
-            # Iniciar Baileys API em background
-            baileys_dir = os.path.join(os.getcwd(), 'baileys-server')
-            if os.path.exists(baileys_dir):
-                logger.info("📡 Iniciando Baileys API...")
-                
-                def start_baileys():
-                    subprocess.run(['node', 'server.js'], cwd=baileys_dir)
-                
-                baileys_thread = threading.Thread(target=start_baileys, daemon=True)
-                baileys_thread.start()
-                
-                # Aguardar API ficar disponível
-                time.sleep(8)
-                logger.info("✅ Baileys API iniciada")
-        
-        # Inicializar bot
-        logger.info("Iniciando bot completo...")
-        
-        if initialize_bot():
+        def iniciar_flask():
+            # Flask em thread separada para responder ao health check
+            threads['flask'] = threading.Thread(target=start_flask, daemon=False)
+            threads['flask'].start()
+            aguardar('Flask', lambda: porta_aberta('127.0.0.1', port))
+            logger.info("✅ Flask está rodando - health check disponível")
+        
+        def aguardar_postgres():
+            aguardar('PostgreSQL', postgres_disponivel)
+            logger.info("✅ PostgreSQL disponível")
+        
+        def iniciar_baileys():
+            # Porta própria para não disputar a do Flask (PORT do Railway)
+            porta_baileys = os.getenv('BAILEYS_PORT', '3000')
+            logger.info("📡 Iniciando Baileys API...")
+            threads['baileys'] = threading.Thread(
+                target=lambda: subprocess.run(['node', 'server.js'], cwd=baileys_dir,
+                                              env={**os.environ, 'PORT': porta_baileys}),
+                daemon=True)
+            threads['baileys'].start()
+            aguardar('Baileys API', lambda: http_disponivel(f"http://localhost:{porta_baileys}/status"))
+            logger.info("✅ Baileys API iniciada")
+        
+        def iniciar_bot():
+            # Banco lento não pode deixar o bot de fora: continua sondando sem prazo
+            aguardar('PostgreSQL', postgres_disponivel, timeout=float('inf'), intervalo_maximo=10.0)
+            logger.info("Iniciando bot completo...")
+            if not initialize_bot():
+                raise RuntimeError("bot não inicializado completamente")
             logger.info("✅ Bot completo inicializado com sucesso")
             # Adicionar métodos de WhatsApp
             add_whatsapp_methods()
@@ -12226,20 +12000,28 @@ def main_with_baileys():
             process_pending_messages()
             # Iniciar polling contínuo
             start_polling_thread()
-        else:
-            logger.warning("⚠️ Bot não inicializado completamente, mas servidor Flask será executado")
         
-        # Blueprint já foi registrado antes do Flask iniciar
-        logger.info("✅ Todos os serviços inicializados - mantendo aplicação ativa")
+        inicializacao_sistema = StartupOrchestrator('sistema')
+        inicializacao_sistema.fase('flask', iniciar_flask)
+        inicializacao_sistema.fase('postgres', aguardar_postgres)
+        baileys_dir = os.path.join(os.getcwd(), 'baileys-server')
+        if is_railway and os.path.exists(baileys_dir):
+            inicializacao_sistema.fase('baileys', iniciar_baileys, obrigatoria=False)
+        inicializacao_sistema.fase('bot', iniciar_bot, apos=('postgres',))
+        
+        if inicializacao_sistema.executar():
+            logger.info("✅ Todos os serviços inicializados - mantendo aplicação ativa")
+        else:
+            logger.warning("⚠️ Sistema não ficou pronto, mas servidor Flask será mantido")
         
         # Manter thread principal ativa
         try:
             while True:
                 time.sleep(30)  # Verificar a cada 30 segundos
-                if not flask_thread.is_alive():
+                if 'flask' in threads and not threads['flask'].is_alive():
                     logger.error("Flask thread morreu - reiniciando...")
-                    flask_thread = threading.Thread(target=start_flask, daemon=False)
-                    flask_thread.start()
+                    threads['flask'] = threading.Thread(target=start_flask, daemon=False)
+                    threads['flask'].start()
         except KeyboardInterrupt:
             logger.info("Aplicação interrompida pelo usuário")
         
@@ -12256,6 +12038,7 @@ if __name__ == '__main__':
     else:
         # Inicializar bot local
         logger.info("Iniciando bot completo...")
+        instalar_encerramento_sigterm()
         
         if initialize_bot():
             logger.info("✅ Bot completo inicializado com sucesso")
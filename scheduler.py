@@ -6,6 +6,7 @@ Sistema de Agendamento de Mensagens (versão funcional c/ bootstrap + backfill)
 - Jobs principais: verificação 05:00, backfill 30/30 min, limpeza, worker minutal
 """
 
+import os
 import logging
 import threading
 from datetime import datetime, timedelta, time as dtime
@@ -16,6 +17,9 @@ import pytz
 import time as _time
 
 from utils import agora_br, formatar_datetime_br  # garanta tz-aware em agora_br()
+from whatsapp_number_cache import WhatsAppNumberCache
+from telegram_outbox import obter_outbox
+from templates import VERSAO_CONTEXTO_RENDER
 
 logger = logging.getLogger(__name__)
 
@@ -40,6 +44,15 @@ class MessageScheduler:
         self.running = False
         self.ultima_verificacao_time = None
         self.bot = None  # pode ser setado via set_bot_instance
+        # Lembretes automáticos entram na fila só com template/cliente e são renderizados no envio
+        self.renderizar_no_envio = os.getenv('FILA_RENDERIZAR_NO_ENVIO', 'true').lower() == 'true'
+
+        # Cache de validade de números (evita enviar para números sem WhatsApp)
+        try:
+            self.numeros_whatsapp = WhatsAppNumberCache(self.db, self.baileys_api)
+        except Exception as e:
+            logger.error(f"Cache de números WhatsApp indisponível: {e}")
+            self.numeros_whatsapp = None
 
         # Configura jobs principais
         self._setup_main_jobs()
@@ -107,7 +120,10 @@ class MessageScheduler:
                 'verificacao_5h',
                 'verificacao_backfill',
                 'verificacao_bootstrap',
-                'processar_fila_minuto'
+                'processar_fila_minuto',
+                'renovar_numeros_whatsapp',
+                'metricas_pendentes',
+                'metricas_fechamento'
             ]:
                 try:
                     job = self.scheduler.get_job(job_id)
@@ -165,6 +181,32 @@ class MessageScheduler:
                 coalesce=True
             )
 
+            # Renovação do cache de números WhatsApp (madrugada, antes da fila das 05:00)
+            self.scheduler.add_job(
+                func=self._renovar_numeros_whatsapp,
+                trigger=CronTrigger(hour=4, minute=0, timezone=self.scheduler.timezone),
+                id='renovar_numeros_whatsapp',
+                name='Renovar cache de números WhatsApp às 04:00',
+                replace_existing=True
+            )
+
+            # Métricas diárias: usuários com escritas recentes a cada 5 min, fechamento do dia anterior
+            self.scheduler.add_job(
+                func=self._atualizar_metricas_pendentes,
+                trigger=CronTrigger(minute='*/5', timezone=self.scheduler.timezone),
+                id='metricas_pendentes',
+                name='Consolidar métricas do dia (*/5 min)',
+                replace_existing=True,
+                coalesce=True
+            )
+            self.scheduler.add_job(
+                func=self._fechar_metricas_dia_anterior,
+                trigger=CronTrigger(hour=0, minute=10, timezone=self.scheduler.timezone),
+                id='metricas_fechamento',
+                name='Fechar métricas do dia anterior às 00:10',
+                replace_existing=True
+            )
+
             jobs_count = len(self.scheduler.get_jobs())
             logger.info(
                 f"Jobs principais configurados. "
@@ -251,13 +293,18 @@ class MessageScheduler:
                     f"tipo={preview.get('tipo_mensagem')} agendado_para={preview.get('agendado_para')}"
                 )
 
+            # Pré-carrega validade dos números da rodada em uma única consulta
+            if self.numeros_whatsapp:
+                self.numeros_whatsapp.filtrar_invalidos(m.get('telefone') for m in mensagens_pendentes)
+
             agora = agora_br()
+            templates = {}  # templates das mensagens renderizadas no envio, uma consulta por template
             for mensagem in mensagens_pendentes:
                 try:
                     ag = self._ensure_aware(mensagem.get('agendado_para'))
                     # Se veio sem agendamento, envia imediatamente
                     if ag is None or ag <= agora:
-                        self._enviar_mensagem_fila(mensagem)
+                        self._enviar_mensagem_fila(mensagem, templates)
                         _time.sleep(1.5)  # polidez com a API
                     else:
                         # Ainda não é hora
@@ -265,7 +312,7 @@ class MessageScheduler:
                 except Exception as e:
                     logger.error(f"Erro ao processar mensagem ID {mensagem.get('id')}: {e}")
                     try:
-                        self.db.marcar_mensagem_processada(mensagem['id'], False, str(e))
+                        self.db.marcar_mensagem_processada(mensagem['id'], False, erro=str(e))
                     except Exception:
                         pass
 
@@ -274,14 +321,14 @@ class MessageScheduler:
         except Exception as e:
             logger.error(f"Erro no processamento da fila: {e}")
 
-    def _enviar_mensagem_fila(self, mensagem):
-        """Envia uma mensagem da fila"""
+    def _enviar_mensagem_fila(self, mensagem, templates=None):
+        """Envia uma mensagem da fila (renderizando agora se ela só guarda template/cliente)"""
         try:
             # Verificar se cliente ainda está ativo
             cliente = self.db.buscar_cliente_por_id(mensagem['cliente_id'])
             if not cliente or not cliente.get('ativo', True):
                 logger.info(f"Cliente {mensagem['cliente_id']} inativo, removendo da fila")
-                self.db.marcar_mensagem_processada(mensagem['id'], True, "cliente_inativo")
+                self.db.marcar_mensagem_processada(mensagem['id'], True, erro="cliente_inativo")
                 return
 
             chat_id_usuario = (
@@ -290,9 +337,21 @@ class MessageScheduler:
             )
             if not chat_id_usuario:
                 logger.error(f"Mensagem ID {mensagem['id']} sem chat_id_usuario - não pode enviar WhatsApp")
-                self.db.marcar_mensagem_processada(mensagem['id'], False, "chat_id_usuario ausente")
+                self.db.marcar_mensagem_processada(mensagem['id'], False, erro="chat_id_usuario ausente")
+                return
+
+            if self.numeros_whatsapp and self.numeros_whatsapp.numero_invalido(mensagem['telefone']):
+                logger.info(f"Mensagem ID {mensagem['id']} ignorada: {mensagem['telefone']} sem WhatsApp")
+                self.db.marcar_mensagem_processada(mensagem['id'], True, erro="numero_sem_whatsapp")
                 return
 
+            if mensagem.get('mensagem') is None:
+                mensagem['mensagem'] = self.template_manager.renderizar_mensagem_fila(mensagem, cliente, templates)
+                if mensagem['mensagem'] is None:
+                    logger.info(f"Mensagem ID {mensagem['id']}: template {mensagem.get('template_id')} inativo, removendo da fila")
+                    self.db.marcar_mensagem_processada(mensagem['id'], True, erro="template_inativo")
+                    return
+
             resultado = self.baileys_api.send_message(
                 phone=mensagem['telefone'],
                 message=mensagem['mensagem'],
@@ -312,7 +371,7 @@ class MessageScheduler:
                     chat_id_usuario=chat_id_usuario
                 )
                 # Marcar processado
-                self.db.marcar_mensagem_processada(mensagem['id'], True, "enviado")
+                self.db.marcar_mensagem_processada(mensagem['id'], True)
                 logger.info(
                     f"Mensagem enviada: {mensagem.get('cliente_nome')} ({mensagem['telefone']}) | "
                     f"tipo={mensagem.get('tipo_mensagem')}"
@@ -329,13 +388,13 @@ class MessageScheduler:
                     erro=erro,
                     chat_id_usuario=chat_id_usuario
                 )
-                self.db.marcar_mensagem_processada(mensagem['id'], False, erro)
+                self.db.marcar_mensagem_processada(mensagem['id'], False, erro=erro)
                 logger.error(f"Falha ao enviar mensagem para {mensagem.get('cliente_nome')}: {erro}")
 
         except Exception as e:
             logger.error(f"Erro ao enviar mensagem da fila: {e}")
             try:
-                self.db.marcar_mensagem_processada(mensagem['id'], False, str(e))
+                self.db.marcar_mensagem_processada(mensagem['id'], False, erro=str(e))
             except Exception:
                 pass
 
@@ -472,7 +531,7 @@ class MessageScheduler:
                 logger.warning(f"Template {tipo_template} não encontrado para usuário {resolved_chat_id}")
                 return False
 
-            mensagem = self.template_manager.processar_template(template['conteudo'], cliente)
+            mensagem = self.template_manager.processar_template(template, cliente)
 
             if self._ja_enviada_hoje(cliente['id'], template['id']):
                 logger.info(f"Mensagem {tipo_template} já enviada hoje para {cliente['nome']}")
@@ -527,34 +586,115 @@ class MessageScheduler:
                 logger.info("Nenhum cliente ativo encontrado")
                 return
 
-            contador_agendadas = 0
+            invalidos = set()
+            if self.numeros_whatsapp:
+                invalidos = self.numeros_whatsapp.filtrar_invalidos(c.get('telefone') for c in clientes)
+
+            # Agrupa por (usuário, tipo) para resolver template/horário e renderizar em lote
+            lotes = {}
             hoje = agora_br().date()
             for cliente in clientes:
                 try:
+                    if invalidos and self.numeros_whatsapp.normalizar(cliente.get('telefone')) in invalidos:
+                        logger.info(f"Cliente {cliente.get('nome')} ignorado: número sem WhatsApp")
+                        continue
+
                     vencimento = cliente['vencimento']
                     if not hasattr(vencimento, 'toordinal'):
                         continue
                     dias_vencimento = (vencimento - hoje).days
 
                     if dias_vencimento == -1:
-                        self._agendar_mensagem_vencimento(cliente, 'vencimento_1dia_apos', hoje)
-                        contador_agendadas += 1
+                        tipo_template = 'vencimento_1dia_apos'
                     elif dias_vencimento == 0:
-                        self._agendar_mensagem_vencimento(cliente, 'vencimento_hoje', hoje)
-                        contador_agendadas += 1
+                        tipo_template = 'vencimento_hoje'
                     elif dias_vencimento in (1, 2):
-                        self._agendar_mensagem_vencimento(cliente, 'vencimento_2dias', hoje)
-                        contador_agendadas += 1
+                        tipo_template = 'vencimento_2dias'
                     else:
                         # Ignora >2 dias e <<-1 para agendamento automático diário
-                        pass
+                        continue
+                    lotes.setdefault((cliente.get('chat_id_usuario'), tipo_template), []).append(cliente)
                 except Exception as e:
                     logger.error(f"Erro ao verificar cliente {cliente.get('nome')}: {e}")
 
+            contador_agendadas = 0
+            for (chat_id_usuario, tipo_template), clientes_lote in lotes.items():
+                contador_agendadas += self._agendar_lote_vencimento(chat_id_usuario, tipo_template, clientes_lote, hoje)
+
             logger.info(f"=== VERIFICAÇÃO CONCLUÍDA: {contador_agendadas} mensagens agendadas para HOJE ===")
         except Exception as e:
             logger.error(f"Erro na verificação diária: {e}")
 
+    def _horario_envio_usuario(self, chat_id_usuario, data_envio):
+        """HH:MM de envio do USUÁRIO (fallback global) no dia; se já passou, agora + 10min (até 23:59)"""
+        hhmm = self._get_horario_config_usuario(
+            'horario_envio',
+            chat_id_usuario,
+            default=self._get_horario_config_global('horario_envio', '12:00')
+        )
+        try:
+            h, m = map(int, str(hhmm).split(':'))
+        except Exception:
+            h, m = 12, 0  # fallback robusto
+
+        alvo = self._ensure_aware(datetime.combine(data_envio, dtime(h, m)))
+
+        agora = agora_br()
+        if alvo <= agora:
+            limite_hoje = agora.replace(hour=23, minute=59, second=0, microsecond=0)
+            alvo = min(agora + timedelta(minutes=10), limite_hoje)
+        return alvo
+
+    def _agendar_lote_vencimento(self, chat_id_usuario, tipo_template, clientes, data_envio):
+        """Agenda o mesmo tipo de mensagem para vários clientes de um usuário; retorna quantas agendou"""
+        try:
+            template = self.db.obter_template_por_tipo(tipo_template, chat_id_usuario=chat_id_usuario)
+            if not template:
+                logger.warning(f"Template {tipo_template} não encontrado (usuário {chat_id_usuario}, "
+                               f"{len(clientes)} clientes)")
+                return 0
+
+            alvo = self._horario_envio_usuario(chat_id_usuario, data_envio)
+            por_id = {cliente['id']: cliente for cliente in clientes}
+            agendadas = 0
+
+            if self.renderizar_no_envio:
+                mensagens = ((cliente['id'], None) for cliente in clientes)
+            else:
+                mensagens = self.template_manager.render_many(template, clientes, chat_id_usuario)
+
+            for cliente_id, mensagem in mensagens:
+                cliente = por_id[cliente_id]
+                try:
+                    # Evitar duplicidade para o mesmo dia
+                    if self.db.verificar_mensagem_existente(cliente_id, template['id'], data_envio):
+                        logger.info(f"Mensagem {tipo_template} já agendada para {cliente['nome']}")
+                        continue
+
+                    self.db.adicionar_fila_mensagem(
+                        cliente_id=cliente_id,
+                        template_id=template['id'],
+                        telefone=cliente['telefone'],
+                        mensagem=mensagem,
+                        tipo_mensagem=tipo_template,
+                        agendado_para=alvo,
+                        chat_id_usuario=chat_id_usuario,
+                        contexto_versao=VERSAO_CONTEXTO_RENDER if mensagem is None else None
+                    )
+                    agendadas += 1
+                except Exception as e:
+                    logger.error(f"Erro ao agendar {tipo_template} para {cliente.get('nome')}: {e}")
+
+            logger.info(
+                f"Agendadas {agendadas} mensagens {tipo_template} do usuário {chat_id_usuario} | "
+                f"ENVIO: {alvo.strftime('%d/%m/%Y %H:%M')}"
+            )
+            return agendadas
+
+        except Exception as e:
+            logger.error(f"Erro ao agendar lote de {tipo_template}: {e}")
+            return 0
+
     def _agendar_mensagem_vencimento(self, cliente, tipo_template, data_envio):
         """Agenda mensagem específica de vencimento para envio no mesmo dia, no HH:MM do USUÁRIO."""
         try:
@@ -563,26 +703,10 @@ class MessageScheduler:
                 logger.warning(f"Template {tipo_template} não encontrado (cliente {cliente.get('nome')})")
                 return
 
-            mensagem = self.template_manager.processar_template(template['conteudo'], cliente)
+            mensagem = None if self.renderizar_no_envio else self.template_manager.processar_template(template, cliente)
 
             # HH:MM por USUÁRIO com fallback global
-            hhmm = self._get_horario_config_usuario(
-                'horario_envio',
-                cliente.get('chat_id_usuario'),
-                default=self._get_horario_config_global('horario_envio', '12:00')
-            )
-            try:
-                h, m = map(int, str(hhmm).split(':'))
-            except Exception:
-                h, m = 12, 0  # fallback robusto
-
-            alvo = self._ensure_aware(datetime.combine(data_envio, dtime(h, m)))
-
-            # Se já passou do horário do usuário hoje: reprograma para agora + 10min (até 23:59)
-            agora = agora_br()
-            if alvo <= agora:
-                limite_hoje = agora.replace(hour=23, minute=59, second=0, microsecond=0)
-                alvo = min(agora + timedelta(minutes=10), limite_hoje)
+            alvo = self._horario_envio_usuario(cliente.get('chat_id_usuario'), data_envio)
 
             # Evitar duplicidade para o mesmo dia
             if self.db.verificar_mensagem_existente(cliente['id'], template['id'], data_envio):
@@ -597,7 +721,8 @@ class MessageScheduler:
                 mensagem=mensagem,
                 tipo_mensagem=tipo_template,
                 agendado_para=alvo,
-                chat_id_usuario=cliente.get('chat_id_usuario')
+                chat_id_usuario=cliente.get('chat_id_usuario'),
+                contexto_versao=VERSAO_CONTEXTO_RENDER if mensagem is None else None
             )
 
             logger.info(
@@ -609,12 +734,33 @@ class MessageScheduler:
             logger.error(f"Erro ao agendar mensagem de vencimento: {e}")
 
     # ===================== Limpeza / Cancelamento =====================
+    def _renovar_numeros_whatsapp(self):
+        """Renova em segundo plano o cache de validade dos números WhatsApp"""
+        if self.numeros_whatsapp:
+            self.numeros_whatsapp.renovar_expirados()
+
+    def _atualizar_metricas_pendentes(self):
+        """Consolida as métricas de hoje dos usuários que tiveram clientes ou envios alterados"""
+        try:
+            self.db.atualizar_metricas_pendentes()
+        except Exception as e:
+            logger.error(f"Erro ao consolidar métricas pendentes: {e}")
+
+    def _fechar_metricas_dia_anterior(self):
+        """Recalcula do último dia consolidado até hoje, para todos os usuários"""
+        try:
+            linhas = self.db.atualizar_metricas_desde_ultima()
+            logger.info(f"📊 Métricas diárias consolidadas: {linhas} linhas")
+        except Exception as e:
+            logger.error(f"Erro ao fechar métricas diárias: {e}")
+
     def _limpar_fila_antiga(self):
         """Remove mensagens antigas processadas da fila e futuras desnecessárias"""
         try:
             logger.info("Iniciando limpeza da fila antiga...")
             removidas_antigas = self.db.limpar_fila_processadas(dias=7)
             removidas_futuras = self.db.limpar_mensagens_futuras()
+            self.db.limpar_mensagens_orfas()
             logger.info(
                 f"Limpeza concluída: {removidas_antigas} mensagens antigas e "
                 f"{removidas_futuras} futuras removidas"
@@ -761,7 +907,6 @@ Tudo sob controle! 👍"""
     def _enviar_para_admin(self, admin_chat_id, mensagem):
         """Envia mensagem para o administrador via Telegram"""
         try:
-            import requests
             import os
 
             bot_token = os.getenv('BOT_TOKEN')
@@ -769,9 +914,8 @@ Tudo sob controle! 👍"""
                 logger.error("BOT_TOKEN não configurado para envio de alerta")
                 return
 
-            url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
             data = {'chat_id': admin_chat_id, 'text': mensagem, 'parse_mode': 'Markdown'}
-            response = requests.post(url, data=data, timeout=10)
+            response = obter_outbox(bot_token).enviar('sendMessage', data, chat_id=admin_chat_id)
 
             if response.status_code == 200:
                 logger.info("Alerta enviado com sucesso para administrador")
@@ -943,9 +1087,15 @@ Renove agora e mantenha tudo funcionando! 👇"""
     def _agendar_mensagens_cliente_sync(self, cliente):
         """Agenda apenas mensagem de boas-vindas para novo cliente"""
         try:
+            if self.numeros_whatsapp and cliente.get('chat_id_usuario'):
+                self.numeros_whatsapp.verificar_em_lote([cliente['telefone']], cliente['chat_id_usuario'])
+                if self.numeros_whatsapp.numero_invalido(cliente['telefone']):
+                    logger.info(f"Boas-vindas não agendada: {cliente['nome']} sem WhatsApp")
+                    return
+
             template_boas_vindas = self.db.obter_template_por_tipo('boas_vindas', cliente.get('chat_id_usuario'))
             if template_boas_vindas:
-                mensagem = self.template_manager.processar_template(template_boas_vindas['conteudo'], cliente)
+                mensagem = self.template_manager.processar_template(template_boas_vindas, cliente)
                 agendado_para = self._ensure_aware(agora_br() + timedelta(minutes=5))
                 self.db.adicionar_fila_mensagem(
                     cliente_id=cliente['id'],
@@ -967,7 +1117,7 @@ Renove agora e mantenha tudo funcionando! 👇"""
             template = self.db.obter_template(template_id)
             if not cliente or not template:
                 return False
-            mensagem = self.template_manager.processar_template(template['conteudo'], cliente)
+            mensagem = self.template_manager.processar_template(template, cliente)
             fila_id = self.db.adicionar_fila_mensagem(
                 cliente_id=cliente_id,
                 template_id=template_id,
@@ -9,17 +9,19 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 from utils import agora_br
 import pytz
-import requests
 import os
+from telegram_outbox import obter_outbox
 
 logger = logging.getLogger(__name__)
 
 class SimpleScheduler:
-    def __init__(self, database_manager, baileys_api, template_manager):
+    def __init__(self, database_manager, baileys_api, template_manager, numeros_whatsapp=None):
         """Inicializa agendador super simplificado"""
         self.db = database_manager
         self.baileys_api = baileys_api
         self.template_manager = template_manager
+        # Cache de validade de números WhatsApp (renovado de madrugada)
+        self.numeros_whatsapp = numeros_whatsapp
         self.bot_instance = None
         
         self.scheduler = BackgroundScheduler(timezone=pytz.timezone('America/Sao_Paulo'))
@@ -41,6 +43,8 @@ class SimpleScheduler:
                     name=f'Notificações Diárias {horario_verificacao}',
                     replace_existing=True
                 )
+                self._agendar_jobs_metricas(recuperar=True)
+                self._agendar_jobs_manutencao()
                 
                 self.scheduler.start()
                 self.running = True
@@ -108,6 +112,8 @@ class SimpleScheduler:
                 name=f'Notificações Diárias {horario}',
                 replace_existing=True
             )
+            self._agendar_jobs_metricas()
+            self._agendar_jobs_manutencao()
             
             # Reiniciar
             self.scheduler.start()
@@ -119,6 +125,84 @@ class SimpleScheduler:
             logger.error(f"Erro ao recriar jobs: {e}")
             return False
     
+    def _agendar_jobs_metricas(self, recuperar=False):
+        """Jobs das métricas diárias: usuários com escritas recentes a cada 5 min e fechamento às 00:10
+        
+        recuperar: consolida logo na partida os dias sem métricas (ex.: processo parado).
+        """
+        self.scheduler.add_job(
+            func=self._atualizar_metricas_pendentes,
+            trigger=CronTrigger(minute='*/5'),
+            id='metricas_pendentes',
+            name='Consolidar métricas do dia (*/5 min)',
+            replace_existing=True,
+            coalesce=True
+        )
+        self.scheduler.add_job(
+            func=self._consolidar_metricas_atrasadas,
+            trigger=CronTrigger(hour=0, minute=10),
+            id='metricas_fechamento',
+            name='Fechar métricas do dia anterior às 00:10',
+            replace_existing=True
+        )
+        if recuperar:
+            self.scheduler.add_job(
+                func=self._consolidar_metricas_atrasadas,
+                id='metricas_recuperacao',
+                name='Recuperar métricas na inicialização',
+                replace_existing=True
+            )
+    
+    def _agendar_jobs_manutencao(self):
+        """Jobs de manutenção: limpeza de corpos de mensagem órfãos às 03:30 e
+        renovação do cache de números WhatsApp às 04:00"""
+        self.scheduler.add_job(
+            func=self._limpar_mensagens_orfas,
+            trigger=CronTrigger(hour=3, minute=30),
+            id='limpar_mensagens_orfas',
+            name='Limpar corpos de mensagem órfãos às 03:30',
+            replace_existing=True,
+            coalesce=True
+        )
+        if self.numeros_whatsapp:
+            self.scheduler.add_job(
+                func=self._renovar_numeros_whatsapp,
+                trigger=CronTrigger(hour=4, minute=0),
+                id='renovar_numeros_whatsapp',
+                name='Renovar cache de números WhatsApp às 04:00',
+                replace_existing=True,
+                coalesce=True
+            )
+    
+    def _limpar_mensagens_orfas(self):
+        """Remove corpos deduplicados que nenhum log referencia (ex.: após excluir clientes/templates)"""
+        try:
+            self.db.limpar_mensagens_orfas()
+        except Exception as e:
+            logger.error(f"Erro ao limpar corpos de mensagem órfãos: {e}")
+    
+    def _renovar_numeros_whatsapp(self):
+        """Reverifica números expirados e de clientes ativos ainda não verificados"""
+        try:
+            self.numeros_whatsapp.renovar_expirados()
+        except Exception as e:
+            logger.error(f"Erro ao renovar cache de números WhatsApp: {e}")
+    
+    def _atualizar_metricas_pendentes(self):
+        """Consolida as métricas de hoje dos usuários que tiveram clientes ou envios alterados"""
+        try:
+            self.db.atualizar_metricas_pendentes()
+        except Exception as e:
+            logger.error(f"Erro ao consolidar métricas pendentes: {e}")
+    
+    def _consolidar_metricas_atrasadas(self):
+        """Recalcula do último dia consolidado até hoje, para todos os usuários"""
+        try:
+            linhas = self.db.atualizar_metricas_desde_ultima()
+            logger.info(f"📊 Métricas diárias consolidadas: {linhas} linhas")
+        except Exception as e:
+            logger.error(f"Erro ao consolidar métricas diárias: {e}")
+    
     def _notificar_usuarios_diario(self):
         """Notifica cada usuário sobre seus clientes vencendo"""
         try:
@@ -218,7 +302,7 @@ class SimpleScheduler:
                 # Enviar para o usuário
                 sucesso = self._enviar_telegram(chat_id_usuario, mensagem)
                 if sucesso:
-                    logger.info(f"📱 Notificação enviada com sucesso para usuário {chat_id_usuario}")
+                    logger.info(f"📱 Notificação enfileirada para usuário {chat_id_usuario}")
                 else:
                     logger.error(f"Falha ao enviar notificação para usuário {chat_id_usuario}")
             else:
@@ -228,32 +312,37 @@ class SimpleScheduler:
             logger.error(f"Erro ao notificar usuário {chat_id_usuario}: {e}")
     
     def _enviar_telegram(self, chat_id, mensagem):
-        """Envia mensagem via Telegram"""
+        """Enfileira mensagem na saída do Telegram (limites por chat/global respeitados)"""
         try:
             bot_token = os.getenv('BOT_TOKEN')
             if not bot_token:
                 logger.error("BOT_TOKEN não configurado")
                 return False
             
-            url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
             data = {
                 'chat_id': chat_id,
                 'text': mensagem,
                 'parse_mode': 'Markdown'
             }
             
-            response = requests.post(url, data=data, timeout=10)
-            
-            if response.status_code == 200:
-                return True
-            else:
-                logger.error(f"Erro Telegram: {response.status_code} - {response.text}")
-                return False
+            # Não bloqueia: a onda de alertas sai na velocidade máxima permitida
+            future = obter_outbox(bot_token).enviar('sendMessage', data, chat_id=chat_id, aguardar=False)
+            future.add_done_callback(lambda f: self._registrar_envio_telegram(chat_id, f))
+            return True
                 
         except Exception as e:
             logger.error(f"Erro ao enviar Telegram: {e}")
             return False
     
+    def _registrar_envio_telegram(self, chat_id, future):
+        """Registra o resultado de um envio enfileirado"""
+        try:
+            response = future.result()
+            if response.status_code != 200:
+                logger.error(f"Erro Telegram para {chat_id}: {response.status_code} - {response.text}")
+        except Exception as e:
+            logger.error(f"Erro ao enviar Telegram para {chat_id}: {e}")
+    
     def is_running(self):
         """Verifica se agendador está rodando"""
         return self.running and self.scheduler.running if self.scheduler else False
@@ -301,6 +390,8 @@ class SimpleScheduler:
                 name='Notificações Diárias 9h05',
                 replace_existing=True
             )
+            self._agendar_jobs_metricas()
+            self._agendar_jobs_manutencao()
             
             logger.info("✅ Jobs recriados com sucesso")
             return True
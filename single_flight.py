@@ -0,0 +1,111 @@
+"""
+Coalescência de ações repetidas (single-flight)
+Chamadas com a mesma chave enquanto uma execução está em andamento aguardam
+e recebem o mesmo resultado; o resultado é reaproveitado por uma janela curta
+"""
+
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class _Execucao:
+    __slots__ = ('concluida', 'resultado', 'erro', 'fim')
+
+    def __init__(self):
+        self.concluida = threading.Event()
+        self.resultado = None
+        self.erro = None
+        self.fim = None
+
+
+class SingleFlight:
+    def __init__(self, janela=None, max_chaves=None):
+        """Inicializa o registro de execuções por chave"""
+        self.janela = janela if janela is not None else float(os.getenv('SINGLE_FLIGHT_JANELA', '5'))
+        self.max_chaves = max_chaves or int(os.getenv('SINGLE_FLIGHT_MAX_CHAVES', '5000'))
+        self._lock = threading.Lock()
+        self._execucoes = {}
+
+        # Métricas
+        self._executadas = 0
+        self._anexadas = 0
+        self._reaproveitadas = 0
+
+    def executar(self, chave, funcao, *args, janela=None, **kwargs):
+        """Executa funcao(*args, **kwargs) uma única vez por chave dentro da janela"""
+        janela = self.janela if janela is None else janela
+        agora = time.time()
+
+        with self._lock:
+            execucao = self._execucoes.get(chave)
+            if execucao is not None:
+                if not execucao.concluida.is_set():
+                    self._anexadas += 1
+                    lider = False
+                elif execucao.erro is None and agora - execucao.fim < janela:
+                    self._reaproveitadas += 1
+                    logger.debug(f"Resultado reaproveitado para {chave}")
+                    return execucao.resultado
+                else:
+                    execucao = None
+
+            if execucao is None:
+                if len(self._execucoes) >= self.max_chaves:
+                    self._limpar_expiradas(agora, janela)
+                execucao = _Execucao()
+                self._execucoes[chave] = execucao
+                self._executadas += 1
+                lider = True
+
+        if not lider:
+            logger.debug(f"Aguardando execução em andamento para {chave}")
+            execucao.concluida.wait()
+            if execucao.erro is not None:
+                raise execucao.erro
+            return execucao.resultado
+
+        try:
+            execucao.resultado = funcao(*args, **kwargs)
+            return execucao.resultado
+        except Exception as e:
+            execucao.erro = e
+            raise
+        finally:
+            execucao.fim = time.time()
+            execucao.concluida.set()
+            if execucao.erro is not None:
+                with self._lock:
+                    if self._execucoes.get(chave) is execucao:
+                        del self._execucoes[chave]
+
+    def _limpar_expiradas(self, agora, janela):
+        """Remove execuções concluídas fora da janela (chamar com o lock)"""
+        for chave in [c for c, e in self._execucoes.items()
+                      if e.concluida.is_set() and agora - e.fim >= janela]:
+            del self._execucoes[chave]
+
+    def invalidar(self, prefixo=None):
+        """Descarta resultados guardados (todos ou de chaves que começam com prefixo)"""
+        with self._lock:
+            for chave in list(self._execucoes):
+                execucao = self._execucoes[chave]
+                if not execucao.concluida.is_set():
+                    continue
+                if prefixo is None or chave[:len(prefixo)] == prefixo:
+                    del self._execucoes[chave]
+
+    def obter_metricas(self):
+        """Contadores de execuções, anexações e reaproveitamentos"""
+        with self._lock:
+            em_andamento = sum(1 for e in self._execucoes.values() if not e.concluida.is_set())
+            return {
+                'janela_s': self.janela,
+                'executadas': self._executadas,
+                'anexadas': self._anexadas,
+                'reaproveitadas': self._reaproveitadas,
+                'em_andamento': em_andamento,
+            }
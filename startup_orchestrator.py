@@ -0,0 +1,203 @@
+"""
+Orquestrador de inicialização
+Sonda dependências com backoff em vez de esperas fixas, inicia serviços
+independentes em paralelo respeitando dependências, mede cada fase e só
+marca o sistema como pronto quando as fases obrigatórias estão no ar
+"""
+
+import os
+import time
+import socket
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+ESTADOS_FALHA = ('falhou', 'ignorada')
+
+
+def aguardar(nome, sonda, timeout=None, intervalo_inicial=0.1, intervalo_maximo=2.0):
+    """Repete sonda() com backoff exponencial até retornar verdadeiro
+
+    Exceções da sonda contam como "ainda não disponível". Retorna o número de
+    tentativas; levanta TimeoutError se o prazo acabar.
+    """
+    timeout = timeout if timeout is not None else float(os.getenv('STARTUP_SONDA_TIMEOUT', '60'))
+    limite = time.time() + timeout
+    intervalo = intervalo_inicial
+    tentativas = 0
+    ultimo_erro = None
+
+    while True:
+        tentativas += 1
+        try:
+            if sonda():
+                return tentativas
+        except Exception as e:
+            ultimo_erro = e
+
+        restante = limite - time.time()
+        if restante <= 0:
+            detalhe = f": {ultimo_erro}" if ultimo_erro else ""
+            raise TimeoutError(f"{nome} indisponível após {timeout:.0f}s ({tentativas} tentativas){detalhe}")
+        time.sleep(min(intervalo, restante))
+        intervalo = min(intervalo * 2, intervalo_maximo)
+
+
+def porta_aberta(host, porta, timeout=1):
+    """Sonda TCP: a porta aceita conexões"""
+    with socket.create_connection((host, int(porta)), timeout=timeout):
+        return True
+
+
+def http_disponivel(url, timeout=2):
+    """Sonda HTTP: o serviço responde sem erro de servidor"""
+    return requests.get(url, timeout=timeout).status_code < 500
+
+
+class _Fase:
+    __slots__ = ('nome', 'funcao', 'depende', 'apos', 'obrigatoria', 'estado', 'inicio', 'duracao', 'erro')
+
+    def __init__(self, nome, funcao, depende, apos, obrigatoria):
+        self.nome = nome
+        self.funcao = funcao
+        self.depende = tuple(depende)
+        self.apos = tuple(apos)
+        self.obrigatoria = obrigatoria
+        self.estado = 'pendente'
+        self.inicio = None
+        self.duracao = None
+        self.erro = None
+
+
+class StartupOrchestrator:
+    def __init__(self, nome='sistema', max_workers=None):
+        """Inicializa o registro de fases"""
+        self.nome = nome
+        self.max_workers = max_workers or int(os.getenv('STARTUP_WORKERS', '8'))
+        self._fases = {}
+        self._lock = threading.Lock()
+        self._pronto = threading.Event()
+        self._inicio = None
+        self._duracao = None
+
+    def fase(self, nome, funcao, depende=(), apos=(), obrigatoria=True):
+        """Registra fase de inicialização
+
+        depende: fases que precisam ter concluído com sucesso (senão esta é ignorada).
+        apos: fases que só precisam ter terminado, com ou sem sucesso.
+        """
+        self._fases[nome] = _Fase(nome, funcao, depende, apos, obrigatoria)
+        return self
+
+    # ===================== Execução =====================
+
+    def executar(self):
+        """Executa todas as fases em paralelo respeitando dependências; retorna True se pronto"""
+        self._inicio = time.time()
+        logger.info(f"🚀 Inicialização ({self.nome}): {len(self._fases)} fases")
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='startup') as executor:
+            em_execucao = {}
+            while True:
+                self._iniciar_liberadas(executor, em_execucao)
+                if not em_execucao:
+                    break
+                concluidas, _ = wait(em_execucao, return_when=FIRST_COMPLETED)
+                for future in concluidas:
+                    em_execucao.pop(future)
+
+        # Dependência inexistente ou circular: o que sobrou não pode rodar
+        for fase in self._fases.values():
+            if fase.estado == 'pendente':
+                self._concluir(fase, 'ignorada', erro='dependência não resolvida')
+
+        self._duracao = time.time() - self._inicio
+        falhas = self.falhas()
+        if falhas:
+            logger.warning(f"⚠️ Inicialização ({self.nome}) em {self._duracao:.1f}s - obrigatórias "
+                           f"indisponíveis: {', '.join(falhas)}")
+        else:
+            self._pronto.set()
+            logger.info(f"✅ Inicialização ({self.nome}) pronta em {self._duracao:.1f}s")
+        return not falhas
+
+    def _iniciar_liberadas(self, executor, em_execucao):
+        """Ignora fases com dependência falha e submete as liberadas (até não haver mudança)"""
+        mudou = True
+        while mudou:
+            mudou = False
+            for fase in self._fases.values():
+                if fase.estado != 'pendente':
+                    continue
+                requisitos = [self._fases.get(nome) for nome in fase.depende]
+                falha = next((nome for nome, req in zip(fase.depende, requisitos)
+                              if req is not None and req.estado in ESTADOS_FALHA), None)
+                if falha:
+                    self._concluir(fase, 'ignorada', erro=f"depende de {falha}")
+                    mudou = True
+                    continue
+                # Fase em 'apos' que não foi registrada não bloqueia
+                anteriores = requisitos + [self._fases[nome] for nome in fase.apos if nome in self._fases]
+                if all(req is not None and req.estado in ('ok',) + ESTADOS_FALHA for req in anteriores):
+                    fase.estado = 'executando'
+                    fase.inicio = time.time()
+                    em_execucao[executor.submit(self._executar_fase, fase)] = fase.nome
+                    mudou = True
+
+    def _executar_fase(self, fase):
+        try:
+            fase.funcao()
+            self._concluir(fase, 'ok')
+        except Exception as e:
+            self._concluir(fase, 'falhou', erro=str(e))
+
+    def _concluir(self, fase, estado, erro=None):
+        with self._lock:
+            fase.estado = estado
+            fase.erro = erro
+            if fase.inicio is not None:
+                fase.duracao = time.time() - fase.inicio
+
+        if estado == 'ok':
+            logger.info(f"⏱️ {fase.nome}: {fase.duracao * 1000:.0f} ms")
+        elif estado == 'falhou':
+            nivel = logging.ERROR if fase.obrigatoria else logging.WARNING
+            logger.log(nivel, f"❌ {fase.nome} falhou em {fase.duracao * 1000:.0f} ms: {erro}")
+        else:
+            logger.warning(f"⏭️ {fase.nome} ignorada: {erro}")
+
+    # ===================== Estado =====================
+
+    def esta_pronto(self):
+        return self._pronto.is_set()
+
+    def aguardar_pronto(self, timeout=None):
+        return self._pronto.wait(timeout)
+
+    def falhas(self, obrigatorias=True):
+        """Fases que não subiram (por padrão só as obrigatórias)"""
+        return [f.nome for f in self._fases.values()
+                if f.estado in ESTADOS_FALHA and (f.obrigatoria or not obrigatorias)]
+
+    def obter_status(self):
+        """Estado, duração (milissegundos) e erro de cada fase"""
+        with self._lock:
+            fases = {
+                f.nome: {
+                    'estado': f.estado,
+                    'obrigatoria': f.obrigatoria,
+                    'duracao_ms': round(f.duracao * 1000, 1) if f.duracao is not None else None,
+                    'inicio_ms': round((f.inicio - self._inicio) * 1000, 1) if f.inicio and self._inicio else None,
+                    'erro': f.erro,
+                }
+                for f in self._fases.values()
+            }
+        return {
+            'pronto': self.esta_pronto(),
+            'duracao_total_ms': round(self._duracao * 1000, 1) if self._duracao is not None else None,
+            'fases': fases,
+        }
@@ -0,0 +1,320 @@
+"""
+Fila de saída para a Bot API do Telegram
+Respeita o limite por chat (~1 msg/s, rajada curta) e o global (~30 msg/s),
+reenvia após 429 respeitando retry_after, mescla edições consecutivas da mesma
+mensagem e expõe profundidade da fila e latência
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import Future
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class _Pedido:
+    __slots__ = ('metodo', 'dados', 'usar_json', 'chave', 'limitar_chat', 'chave_edicao',
+                 'future', 'criado_em', 'tentativas')
+
+    def __init__(self, metodo, dados, usar_json, chave, limitar_chat, chave_edicao):
+        self.metodo = metodo
+        self.dados = dados
+        self.usar_json = usar_json
+        self.chave = chave
+        self.limitar_chat = limitar_chat
+        self.chave_edicao = chave_edicao
+        self.future = Future()
+        self.criado_em = time.time()
+        self.tentativas = 0
+
+
+class TelegramOutbox:
+    def __init__(self, token, workers=None, global_por_segundo=None):
+        """Inicializa filas por chat, limites e workers de envio"""
+        self.base_url = f"https://api.telegram.org/bot{token}"
+        self.workers = workers or int(os.getenv('TELEGRAM_OUTBOX_WORKERS', '8'))
+        self.global_por_segundo = global_por_segundo or float(os.getenv('TELEGRAM_GLOBAL_POR_SEGUNDO', '30'))
+        self.chat_intervalo = float(os.getenv('TELEGRAM_CHAT_INTERVALO', '1'))
+        self.grupo_intervalo = float(os.getenv('TELEGRAM_GRUPO_INTERVALO', '3'))
+        self.chat_rajada = float(os.getenv('TELEGRAM_CHAT_RAJADA', '3'))
+        self.max_tentativas = int(os.getenv('TELEGRAM_OUTBOX_TENTATIVAS', '5'))
+        self.espera_resposta = float(os.getenv('TELEGRAM_OUTBOX_ESPERA', '120'))
+
+        self._cond = threading.Condition()
+        # chave do chat -> deque[_Pedido]; ordem de inserção = rodízio entre chats
+        self._filas = OrderedDict()
+        self._em_voo = set()
+        self._edicoes = {}
+        self._bloqueado_ate = {}
+        self._global_bloqueado_ate = 0.0
+        self._tokens_chat = {}
+        self._tokens_global = self.global_por_segundo
+        self._ultimo_global = time.time()
+        self._threads = []
+        self._local = threading.local()
+
+        # Métricas
+        self._pendentes = 0
+        self._enviados = 0
+        self._erros = 0
+        self._limites_429 = 0
+        self._edicoes_mescladas = 0
+        self._esperas = deque(maxlen=1000)
+        self._latencias = deque(maxlen=1000)
+
+    # ===================== Enfileiramento =====================
+
+    def enviar(self, metodo, dados, chat_id=None, usar_json=False, aguardar=True,
+               limitar_chat=True, mesclar_edicao=None):
+        """Enfileira chamada à Bot API
+
+        aguardar=True retorna o requests.Response (ou levanta a exceção do envio);
+        aguardar=False retorna o Future imediatamente.
+        mesclar_edicao: (chat_id, message_id) — edição pendente da mesma mensagem é substituída.
+        """
+        self._iniciar_workers()
+
+        with self._cond:
+            pedido = self._edicoes.get(mesclar_edicao) if mesclar_edicao else None
+            if pedido is not None:
+                # Ainda não saiu: só a versão mais recente do texto precisa ser enviada
+                pedido.dados = dados
+                self._edicoes_mescladas += 1
+            else:
+                chave = chat_id if chat_id is not None and limitar_chat else object()
+                pedido = _Pedido(metodo, dados, usar_json, chave, limitar_chat, mesclar_edicao)
+                self._filas.setdefault(chave, deque()).append(pedido)
+                self._pendentes += 1
+                if mesclar_edicao:
+                    self._edicoes[mesclar_edicao] = pedido
+                self._cond.notify()
+
+        if not aguardar:
+            return pedido.future
+        return pedido.future.result(timeout=self.espera_resposta)
+
+    def _iniciar_workers(self):
+        if self._threads:
+            return
+        with self._cond:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f'tg-saida-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            logger.info(f"📤 Fila de saída do Telegram iniciada ({self.workers} workers, "
+                        f"{self.global_por_segundo:.0f} msg/s global)")
+
+    # ===================== Agendamento =====================
+
+    def _intervalo_chat(self, chave):
+        """Intervalo mínimo sustentado entre mensagens do chat (grupos são mais restritos)"""
+        if isinstance(chave, int) and chave < 0:
+            return self.grupo_intervalo
+        if isinstance(chave, str) and chave.startswith('-'):
+            return self.grupo_intervalo
+        return self.chat_intervalo
+
+    def _repor_tokens_chat(self, chave, agora):
+        tokens, ultimo = self._tokens_chat.get(chave, (self.chat_rajada, agora))
+        tokens = min(self.chat_rajada, tokens + (agora - ultimo) / self._intervalo_chat(chave))
+        self._tokens_chat[chave] = (tokens, agora)
+        return tokens
+
+    def _proximo(self):
+        """Escolhe o próximo pedido elegível; retorna (pedido, espera) (chamar com o lock)"""
+        agora = time.time()
+
+        if agora < self._global_bloqueado_ate:
+            return None, self._global_bloqueado_ate - agora
+
+        self._tokens_global = min(self.global_por_segundo,
+                                  self._tokens_global + (agora - self._ultimo_global) * self.global_por_segundo)
+        self._ultimo_global = agora
+        if self._tokens_global < 1:
+            return None, (1 - self._tokens_global) / self.global_por_segundo
+
+        espera = None
+        for chave, fila in self._filas.items():
+            if chave in self._em_voo or not fila:
+                continue
+
+            bloqueio = self._bloqueado_ate.get(chave, 0)
+            if agora < bloqueio:
+                espera = min(espera or bloqueio - agora, bloqueio - agora)
+                continue
+
+            pedido = fila[0]
+            if pedido.limitar_chat:
+                tokens = self._repor_tokens_chat(chave, agora)
+                if tokens < 1:
+                    falta = (1 - tokens) * self._intervalo_chat(chave)
+                    espera = min(espera or falta, falta)
+                    continue
+                self._tokens_chat[chave] = (tokens - 1, agora)
+
+            fila.popleft()
+            if fila:
+                self._filas.move_to_end(chave)
+            else:
+                del self._filas[chave]
+            if pedido.chave_edicao:
+                self._edicoes.pop(pedido.chave_edicao, None)
+
+            self._tokens_global -= 1
+            self._em_voo.add(chave)
+            return pedido, 0
+
+        return None, espera
+
+    def _limpar_estado_chats(self):
+        """Descarta baldes já cheios e bloqueios vencidos de chats sem fila (chamar com o lock)"""
+        agora = time.time()
+        for chave, (tokens, ultimo) in list(self._tokens_chat.items()):
+            if chave not in self._filas and agora - ultimo > self.chat_rajada * self._intervalo_chat(chave):
+                del self._tokens_chat[chave]
+        for chave, ate in list(self._bloqueado_ate.items()):
+            if ate < agora:
+                del self._bloqueado_ate[chave]
+
+    def _recolocar(self, pedido, atraso, global_=False):
+        """Devolve pedido ao início da fila do chat após limite/falha (chamar com o lock)"""
+        ate = time.time() + atraso
+        if global_ or not pedido.limitar_chat:
+            self._global_bloqueado_ate = max(self._global_bloqueado_ate, ate)
+        else:
+            self._bloqueado_ate[pedido.chave] = max(self._bloqueado_ate.get(pedido.chave, 0), ate)
+        self._filas.setdefault(pedido.chave, deque()).appendleft(pedido)
+        if pedido.chave_edicao and pedido.chave_edicao not in self._edicoes:
+            self._edicoes[pedido.chave_edicao] = pedido
+
+    # ===================== Envio =====================
+
+    def _sessao(self):
+        sessao = getattr(self._local, 'sessao', None)
+        if sessao is None:
+            sessao = self._local.sessao = requests.Session()
+        return sessao
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while True:
+                    pedido, espera = self._proximo()
+                    if pedido:
+                        break
+                    self._cond.wait(espera)
+
+            inicio = time.time()
+            if pedido.tentativas == 0:
+                self._esperas.append(inicio - pedido.criado_em)
+            pedido.tentativas += 1
+
+            resposta, erro = None, None
+            try:
+                url = f"{self.base_url}/{pedido.metodo}"
+                if pedido.usar_json:
+                    resposta = self._sessao().post(url, json=pedido.dados, timeout=15)
+                else:
+                    resposta = self._sessao().post(url, data=pedido.dados, timeout=15)
+            except requests.RequestException as e:
+                erro = e
+
+            with self._cond:
+                self._em_voo.discard(pedido.chave)
+                concluido = self._tratar_resultado(pedido, resposta, erro)
+                if concluido:
+                    self._pendentes -= 1
+                    if len(self._tokens_chat) > 10000:
+                        self._limpar_estado_chats()
+                self._cond.notify_all()
+
+            if concluido:
+                self._latencias.append(time.time() - pedido.criado_em)
+                if erro is not None:
+                    pedido.future.set_exception(erro)
+                else:
+                    pedido.future.set_result(resposta)
+
+    def _tratar_resultado(self, pedido, resposta, erro):
+        """Decide entre concluir ou reenfileirar; retorna True se concluído (chamar com o lock)"""
+        pode_repetir = pedido.tentativas < self.max_tentativas
+
+        if erro is not None:
+            if pode_repetir:
+                logger.warning(f"Falha de rede no {pedido.metodo} (tentativa {pedido.tentativas}): {erro}")
+                self._recolocar(pedido, min(30, 2 ** pedido.tentativas))
+                return False
+            self._erros += 1
+            return True
+
+        if resposta.status_code == 429:
+            self._limites_429 += 1
+            try:
+                retry_after = resposta.json().get('parameters', {}).get('retry_after', 1)
+            except ValueError:
+                retry_after = 1
+            if pode_repetir:
+                logger.warning(f"⏳ Telegram 429 em {pedido.metodo}: aguardando {retry_after}s")
+                self._recolocar(pedido, retry_after)
+                return False
+            self._erros += 1
+            return True
+
+        if resposta.status_code >= 500 and pode_repetir:
+            self._recolocar(pedido, min(30, 2 ** pedido.tentativas))
+            return False
+
+        if resposta.status_code == 200:
+            self._enviados += 1
+        else:
+            self._erros += 1
+        return True
+
+    # ===================== Métricas =====================
+
+    @staticmethod
+    def _percentil(valores, p):
+        if not valores:
+            return 0.0
+        ordenados = sorted(valores)
+        return ordenados[min(len(ordenados) - 1, int(len(ordenados) * p))]
+
+    def obter_metricas(self):
+        """Profundidade da fila, contadores e latências (milissegundos)"""
+        esperas = list(self._esperas)
+        latencias = list(self._latencias)
+        with self._cond:
+            profundidade = self._pendentes
+            chats = len(self._filas)
+            em_voo = len(self._em_voo)
+        return {
+            'profundidade': profundidade,
+            'chats_pendentes': chats,
+            'em_voo': em_voo,
+            'enviados': self._enviados,
+            'erros': self._erros,
+            'limites_429': self._limites_429,
+            'edicoes_mescladas': self._edicoes_mescladas,
+            'espera_p95_ms': round(self._percentil(esperas, 0.95) * 1000, 1),
+            'latencia_media_ms': round(sum(latencias) / len(latencias) * 1000, 1) if latencias else 0.0,
+            'latencia_p95_ms': round(self._percentil(latencias, 0.95) * 1000, 1),
+        }
+
+
+_outboxes = {}
+_outboxes_lock = threading.Lock()
+
+
+def obter_outbox(token):
+    """Fila de saída compartilhada por token (bot e agendadores usam a mesma)"""
+    with _outboxes_lock:
+        if token not in _outboxes:
+            _outboxes[token] = TelegramOutbox(token)
+        return _outboxes[token]
@@ -3,14 +3,184 @@ Sistema de Gerenciamento de Templates
 Gerencia templates de mensagens com suporte a variáveis dinâmicas e processamento
 """
 
+import os
 import re
 import logging
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 from datetime import datetime
 from typing import Dict, Any, Optional
 from utils import formatar_data_br, formatar_datetime_br, agora_br
 
 logger = logging.getLogger(__name__)
 
+_VARIAVEL = re.compile(r'\{(\w+)\}')
+
+# Versão do contexto de render gravada nas mensagens da fila renderizadas no envio;
+# incrementar quando variáveis ou cálculos mudarem de forma incompatível
+VERSAO_CONTEXTO_RENDER = 1
+
+MESES_EXTENSO = [
+    '', 'janeiro', 'fevereiro', 'março', 'abril', 'maio', 'junho',
+    'julho', 'agosto', 'setembro', 'outubro', 'novembro', 'dezembro'
+]
+
+
+class PlanoTemplate:
+    """Template compilado: string de formato com literais escapados e as variáveis usadas"""
+    __slots__ = ('formato', 'variaveis')
+
+    def __init__(self, formato, variaveis):
+        self.formato = formato
+        self.variaveis = variaveis
+
+
+class ContextoRender:
+    """Valores que não dependem do cliente, calculados só quando algum template os usa"""
+
+    def __init__(self, configuracoes=None, carregar_configuracoes=None):
+        self._configuracoes = configuracoes
+        self._carregar_configuracoes = carregar_configuracoes
+        self._agora = None
+        self._data_atual = None
+        self._hora_atual = None
+
+    @property
+    def agora(self):
+        if self._agora is None:
+            self._agora = agora_br()
+        return self._agora
+
+    @property
+    def data_atual(self):
+        if self._data_atual is None:
+            self._data_atual = formatar_data_br(self.agora.date())
+        return self._data_atual
+
+    @property
+    def hora_atual(self):
+        if self._hora_atual is None:
+            self._hora_atual = formatar_datetime_br(self.agora)
+        return self._hora_atual
+
+    @property
+    def configuracoes(self):
+        if self._configuracoes is None:
+            self._configuracoes = self._carregar_configuracoes() if self._carregar_configuracoes else {}
+        return self._configuracoes
+
+    def congelar(self, variaveis):
+        """Valores já resolvidos (serializáveis) para renderizar em outro processo"""
+        valores = {'configuracoes': self.configuracoes if any(v in _VARIAVEIS_EMPRESA for v in variaveis) else {}}
+        if 'data_atual' in variaveis:
+            valores['data_atual'] = self.data_atual
+        if 'hora_atual' in variaveis:
+            valores['hora_atual'] = self.hora_atual
+        return valores
+
+    @classmethod
+    def descongelar(cls, valores):
+        contexto = cls(valores['configuracoes'])
+        contexto._data_atual = valores.get('data_atual')
+        contexto._hora_atual = valores.get('hora_atual')
+        return contexto
+
+
+def _vencimento_cliente(cliente_data):
+    vencimento = cliente_data.get('vencimento')
+    if isinstance(vencimento, str):
+        try:
+            vencimento = datetime.strptime(vencimento, '%Y-%m-%d').date()
+        except:
+            pass
+    return vencimento
+
+
+def data_por_extenso(data):
+    """Converte data para formato por extenso"""
+    try:
+        if isinstance(data, str):
+            data = datetime.strptime(data, '%Y-%m-%d').date()
+        
+        return f"{data.day} de {MESES_EXTENSO[data.month]} de {data.year}"
+        
+    except Exception as e:
+        logger.error(f"Erro ao converter data por extenso: {e}")
+        return str(data)
+
+
+def _dias_para_vencer(cliente_data, contexto):
+    dias_vencimento = cliente_data.get('dias_vencimento')
+    if dias_vencimento is None:
+        return "Não calculado"
+    if dias_vencimento < 0:
+        return f"Vencido há {abs(dias_vencimento)} dias"
+    if dias_vencimento == 0:
+        return "Vence hoje"
+    return f"{dias_vencimento} dias"
+
+
+def _status_vencimento(cliente_data, contexto):
+    dias_vencimento = cliente_data.get('dias_vencimento')
+    if dias_vencimento is None:
+        return "INDEFINIDO"
+    if dias_vencimento < 0:
+        return "VENCIDO"
+    if dias_vencimento == 0:
+        return "VENCE HOJE"
+    return "EM DIA"
+
+
+def _config_empresa(chave, padrao):
+    return lambda cliente_data, contexto: contexto.configuracoes.get(chave, padrao)
+
+
+_VARIAVEIS_EMPRESA = (
+    'empresa_nome', 'empresa_telefone', 'empresa_email', 'suporte_telefone',
+    'suporte_email', 'pix_chave', 'pix_beneficiario',
+)
+
+
+# Como calcular cada variável: (dados do cliente, contexto) -> valor
+CALCULOS_VARIAVEIS = {
+    'nome': lambda c, ctx: c.get('nome', ''),
+    'telefone': lambda c, ctx: c.get('telefone', ''),
+    'pacote': lambda c, ctx: c.get('pacote', ''),
+    'valor': lambda c, ctx: f"{c.get('valor', 0):.2f}".replace('.', ','),
+    'servidor': lambda c, ctx: c.get('servidor', ''),
+    'vencimento': lambda c, ctx: formatar_data_br(_vencimento_cliente(c)) if c.get('vencimento') else 'Não definido',
+    'vencimento_extenso': lambda c, ctx: data_por_extenso(_vencimento_cliente(c)) if c.get('vencimento') else 'Não definido',
+    'dias_para_vencer': _dias_para_vencer,
+    'status_vencimento': _status_vencimento,
+    'data_atual': lambda c, ctx: ctx.data_atual,
+    'hora_atual': lambda c, ctx: ctx.hora_atual,
+    'empresa_nome': _config_empresa('empresa_nome', '[CONFIGURAR NOME DA EMPRESA]'),
+    'empresa_telefone': _config_empresa('empresa_telefone', '[CONFIGURAR TELEFONE]'),
+    'empresa_email': _config_empresa('empresa_email', '[CONFIGURAR EMAIL]'),
+    'suporte_telefone': _config_empresa('suporte_telefone', '[CONFIGURAR SUPORTE]'),
+    'suporte_email': _config_empresa('suporte_email', '[CONFIGURAR EMAIL SUPORTE]'),
+    'pix_chave': _config_empresa('pix_chave', '[CONFIGURAR CHAVE PIX]'),
+    'pix_beneficiario': _config_empresa('pix_beneficiario', '[CONFIGURAR BENEFICIÁRIO]'),
+}
+
+
+def _renderizar_lote(formato, variaveis, valores_contexto, clientes):
+    """Renderiza um lote de clientes em processo separado (render_many com processos)"""
+    contexto = ContextoRender.descongelar(valores_contexto)
+    plano = PlanoTemplate(formato, variaveis)
+    resultado = []
+    for cliente_data in clientes:
+        try:
+            texto = plano.formato.format_map(
+                {variavel: CALCULOS_VARIAVEIS[variavel](cliente_data, contexto) for variavel in variaveis})
+        except Exception:
+            texto = None
+        resultado.append((cliente_data.get('id'), texto))
+    return resultado
+
+
 class TemplateManager:
     def __init__(self, database_manager):
         """Inicializa o gerenciador de templates"""
@@ -37,6 +207,11 @@ class TemplateManager:
             'pix_chave': 'Chave PIX para pagamento',
             'pix_beneficiario': 'Nome do beneficiário PIX'
         }
+        
+        # Planos compilados por (id, data_atualizacao) do template ou pelo próprio conteúdo
+        self.max_planos = int(os.getenv('TEMPLATE_PLANOS_MAX', '2000'))
+        self._planos = {}
+        self._planos_lock = threading.Lock()
     
     def listar_templates(self, apenas_ativos=True, chat_id_usuario=None):
         """Lista templates com isolamento por usuário"""
@@ -149,123 +324,162 @@ class TemplateManager:
         
         return erros
     
-    def processar_template(self, conteudo, cliente_data, configuracoes=None):
-        """Processa template substituindo variáveis pelos dados reais"""
+    def compilar_template(self, conteudo, chave=None):
+        """Compila o conteúdo uma vez em plano de segmentos (literal, variável, literal...)
+        
+        Variáveis desconhecidas ficam como texto literal, como antes.
+        """
+        chave = conteudo if chave is None else chave
+        plano = self._planos.get(chave)
+        if plano is not None:
+            return plano
+        
+        partes = []
+        variaveis = []
+        posicao = 0
+        for match in _VARIAVEL.finditer(conteudo):
+            variavel = match.group(1)
+            if variavel not in CALCULOS_VARIAVEIS:
+                continue
+            partes.append(conteudo[posicao:match.start()].replace('{', '{{').replace('}', '}}'))
+            partes.append('{' + variavel + '}')
+            if variavel not in variaveis:
+                variaveis.append(variavel)
+            posicao = match.end()
+        partes.append(conteudo[posicao:].replace('{', '{{').replace('}', '}}'))
+        plano = PlanoTemplate(''.join(partes), tuple(variaveis))
+        
+        with self._planos_lock:
+            if len(self._planos) >= self.max_planos:
+                self._planos.clear()
+            self._planos[chave] = plano
+        return plano
+    
+    def _chave_plano(self, template):
+        """Chave de cache do plano: muda sempre que o template é editado"""
+        if template.get('id') is None:
+            return None
+        return ('template', template['id'], template.get('data_atualizacao'))
+    
+    def _renderizar_plano(self, plano, cliente_data, contexto):
+        """Passada única: calcula só as variáveis referenciadas e preenche o formato"""
+        valores = {variavel: CALCULOS_VARIAVEIS[variavel](cliente_data, contexto) for variavel in plano.variaveis}
+        return plano.formato.format_map(valores)
+    
+    def contexto_render(self, chat_id_usuario=None, configuracoes=None):
+        """Contexto de render com o snapshot de configurações do usuário (carregado sob demanda)"""
+        return ContextoRender(configuracoes, lambda: self._obter_configuracoes_empresa(chat_id_usuario))
+    
+    def processar_template(self, conteudo, cliente_data, configuracoes=None, chat_id_usuario=None):
+        """Processa template substituindo variáveis pelos dados reais
+        
+        conteudo pode ser o texto ou o próprio registro do template (dict com id,
+        conteudo e data_atualizacao), o que permite reaproveitar o plano compilado.
+        Sem configuracoes, usa o snapshot do usuário dono do cliente.
+        """
+        texto = conteudo['conteudo'] if isinstance(conteudo, dict) else conteudo
         try:
-            # Preparar dados para substituição
-            dados = self._preparar_dados_cliente(cliente_data, configuracoes)
-            
-            # Substituir variáveis
-            texto_processado = conteudo
-            
-            for variavel, valor in dados.items():
-                placeholder = f"{{{variavel}}}"
-                if placeholder in texto_processado:
-                    texto_processado = texto_processado.replace(placeholder, str(valor))
-            
-            return texto_processado
+            chave = self._chave_plano(conteudo) if isinstance(conteudo, dict) else None
+            plano = self.compilar_template(texto, chave)
+            if chat_id_usuario is None:
+                chat_id_usuario = cliente_data.get('chat_id_usuario')
+            contexto = self.contexto_render(chat_id_usuario, configuracoes)
+            return self._renderizar_plano(plano, cliente_data, contexto)
             
         except Exception as e:
             logger.error(f"Erro ao processar template: {e}")
-            return conteudo  # Retorna o template original em caso de erro
+            return texto  # Retorna o template original em caso de erro
     
-    def _preparar_dados_cliente(self, cliente_data, configuracoes=None):
-        """Prepara dados do cliente para substituição no template"""
-        dados = {}
+    def render_many(self, template, clientes, chat_id_usuario=None, configuracoes=None, processos=None):
+        """Renderiza um template para muitos clientes, gerando (cliente_id, texto) sob demanda
         
-        # Dados básicos do cliente
-        dados['nome'] = cliente_data.get('nome', '')
-        dados['telefone'] = cliente_data.get('telefone', '')
-        dados['pacote'] = cliente_data.get('pacote', '')
-        dados['valor'] = f"{cliente_data.get('valor', 0):.2f}".replace('.', ',')
-        dados['servidor'] = cliente_data.get('servidor', '')
+        Plano, data/hora e snapshot de configurações são resolvidos uma vez por lote
+        (por usuário, quando chat_id_usuario não é informado). Com processos > 1 e
+        lote grande, renderiza em pool de processos, mantendo a ordem de entrada.
+        Cliente com erro de render recebe o conteúdo original, como processar_template.
+        """
+        texto_original = template['conteudo'] if isinstance(template, dict) else template
+        chave = self._chave_plano(template) if isinstance(template, dict) else None
+        plano = self.compilar_template(texto_original, chave)
         
-        # Formatação de datas
-        vencimento = cliente_data.get('vencimento')
-        if vencimento:
-            if isinstance(vencimento, str):
-                try:
-                    vencimento = datetime.strptime(vencimento, '%Y-%m-%d').date()
-                except:
-                    pass
-            
-            dados['vencimento'] = formatar_data_br(vencimento)
-            dados['vencimento_extenso'] = self._data_por_extenso(vencimento)
-        else:
-            dados['vencimento'] = 'Não definido'
-            dados['vencimento_extenso'] = 'Não definido'
+        processos = processos if processos is not None else int(os.getenv('TEMPLATE_RENDER_PROCESSOS', '1'))
+        if processos > 1 and chat_id_usuario is not None:
+            yield from self._render_many_processos(plano, texto_original, clientes, chat_id_usuario,
+                                                   configuracoes, processos)
+            return
         
-        # Cálculos de vencimento
-        dias_vencimento = cliente_data.get('dias_vencimento')
-        if dias_vencimento is not None:
-            if dias_vencimento < 0:
-                dados['dias_para_vencer'] = f"Vencido há {abs(dias_vencimento)} dias"
-                dados['status_vencimento'] = "VENCIDO"
-            elif dias_vencimento == 0:
-                dados['dias_para_vencer'] = "Vence hoje"
-                dados['status_vencimento'] = "VENCE HOJE"
-            else:
-                dados['dias_para_vencer'] = f"{dias_vencimento} dias"
-                dados['status_vencimento'] = "EM DIA"
-        else:
-            dados['dias_para_vencer'] = "Não calculado"
-            dados['status_vencimento'] = "INDEFINIDO"
+        contextos = {}
+        for cliente_data in clientes:
+            tenant = chat_id_usuario if chat_id_usuario is not None else cliente_data.get('chat_id_usuario')
+            contexto = contextos.get(tenant)
+            if contexto is None:
+                contexto = contextos[tenant] = self.contexto_render(tenant, configuracoes)
+            try:
+                yield cliente_data.get('id'), self._renderizar_plano(plano, cliente_data, contexto)
+            except Exception as e:
+                logger.error(f"Erro ao processar template para cliente {cliente_data.get('id')}: {e}")
+                yield cliente_data.get('id'), texto_original
+    
+    def _render_many_processos(self, plano, texto_original, clientes, chat_id_usuario, configuracoes, processos):
+        """Lotes em ProcessPoolExecutor com janela limitada (não materializa todos os clientes)"""
+        tamanho_lote = int(os.getenv('TEMPLATE_RENDER_LOTE', '500'))
+        valores = self.contexto_render(chat_id_usuario, configuracoes).congelar(plano.variaveis)
+        iterador = iter(clientes)
+        with ProcessPoolExecutor(max_workers=processos) as executor:
+            pendentes = deque()
+            while True:
+                while len(pendentes) < processos * 2:
+                    lote = [dict(c) for c in islice(iterador, tamanho_lote)]
+                    if not lote:
+                        break
+                    pendentes.append(executor.submit(_renderizar_lote, plano.formato, plano.variaveis, valores, lote))
+                if not pendentes:
+                    return
+                for cliente_id, texto in pendentes.popleft().result():
+                    if texto is None:
+                        logger.error(f"Erro ao processar template para cliente {cliente_id}")
+                        texto = texto_original
+                    yield cliente_id, texto
+    
+    def renderizar_mensagem_fila(self, mensagem, cliente_data, templates=None):
+        """Texto de uma mensagem da fila; renderiza no envio quando só há template e cliente
         
-        # Data e hora atual
-        agora = agora_br()
-        dados['data_atual'] = formatar_data_br(agora.date())
-        dados['hora_atual'] = formatar_datetime_br(agora)
+        templates é um cache opcional (template_id -> template) compartilhado pela rodada.
+        Retorna None se o template não existe mais ou foi desativado.
+        """
+        if mensagem.get('mensagem') is not None:
+            return mensagem['mensagem']
         
-        # Configurações da empresa (com fallbacks)
-        if configuracoes is None:
-            configuracoes = self._obter_configuracoes_empresa()
+        versao = mensagem.get('contexto_versao') or VERSAO_CONTEXTO_RENDER
+        if versao > VERSAO_CONTEXTO_RENDER:
+            raise ValueError(f"contexto de render v{versao} não suportado (máximo v{VERSAO_CONTEXTO_RENDER})")
         
-        dados['empresa_nome'] = configuracoes.get('empresa_nome', '[CONFIGURAR NOME DA EMPRESA]')
-        dados['empresa_telefone'] = configuracoes.get('empresa_telefone', '[CONFIGURAR TELEFONE]')
-        dados['empresa_email'] = configuracoes.get('empresa_email', '[CONFIGURAR EMAIL]')
-        dados['suporte_telefone'] = configuracoes.get('suporte_telefone', '[CONFIGURAR SUPORTE]')
-        dados['suporte_email'] = configuracoes.get('suporte_email', '[CONFIGURAR EMAIL SUPORTE]')
-        dados['pix_chave'] = configuracoes.get('pix_chave', '[CONFIGURAR CHAVE PIX]')
-        dados['pix_beneficiario'] = configuracoes.get('pix_beneficiario', '[CONFIGURAR BENEFICIÁRIO]')
+        template_id = mensagem.get('template_id')
+        templates = {} if templates is None else templates
+        if template_id not in templates:
+            templates[template_id] = self.db.obter_template(template_id, chat_id_usuario=mensagem.get('chat_id_usuario'))
+        template = templates[template_id]
+        if not template or not template.get('ativo', True):
+            return None
         
-        return dados
+        return self.processar_template(template, cliente_data, chat_id_usuario=mensagem.get('chat_id_usuario'))
+    
+    def _preparar_dados_cliente(self, cliente_data, configuracoes=None):
+        """Prepara todas as variáveis do cliente (o render usa só as referenciadas)"""
+        contexto = self.contexto_render(cliente_data.get('chat_id_usuario'), configuracoes)
+        return {variavel: calcular(cliente_data, contexto) for variavel, calcular in CALCULOS_VARIAVEIS.items()}
     
-    def _obter_configuracoes_empresa(self):
-        """Obtém configurações da empresa do banco de dados"""
+    def _obter_configuracoes_empresa(self, chat_id_usuario=None):
+        """Snapshot das configurações da empresa do usuário (com fallback global)"""
         try:
-            config = {}
-            
-            # Buscar configurações principais
-            config['empresa_nome'] = self.db.obter_configuracao('empresa_nome', '[CONFIGURAR EMPRESA]')
-            config['empresa_telefone'] = self.db.obter_configuracao('empresa_telefone', '[CONFIGURAR TELEFONE]')
-            config['empresa_email'] = self.db.obter_configuracao('empresa_email', '[CONFIGURAR EMAIL]')
-            config['suporte_telefone'] = self.db.obter_configuracao('suporte_telefone', '[CONFIGURAR SUPORTE]')
-            config['suporte_email'] = self.db.obter_configuracao('suporte_email', '[CONFIGURAR EMAIL SUPORTE]')
-            config['pix_chave'] = self.db.obter_configuracao('pix_chave', '[CONFIGURAR PIX]')
-            config['pix_beneficiario'] = self.db.obter_configuracao('pix_beneficiario', '[CONFIGURAR BENEFICIÁRIO]')
-            
-            return config
-            
+            return self.db.obter_configuracoes_usuario(chat_id_usuario)
         except Exception as e:
             logger.error(f"Erro ao obter configurações da empresa: {e}")
             return {}
     
     def _data_por_extenso(self, data):
         """Converte data para formato por extenso"""
-        try:
-            meses = [
-                '', 'janeiro', 'fevereiro', 'março', 'abril', 'maio', 'junho',
-                'julho', 'agosto', 'setembro', 'outubro', 'novembro', 'dezembro'
-            ]
-            
-            if isinstance(data, str):
-                data = datetime.strptime(data, '%Y-%m-%d').date()
-            
-            return f"{data.day} de {meses[data.month]} de {data.year}"
-            
-        except Exception as e:
-            logger.error(f"Erro ao converter data por extenso: {e}")
-            return str(data)
+        return data_por_extenso(data)
     
     def obter_variaveis_disponíveis(self):
         """Retorna lista de variáveis disponíveis para templates"""
@@ -0,0 +1,240 @@
+"""
+Despacho concorrente de updates do Telegram
+Pool de workers com fila serial por chat_id (ordem garantida por conversa),
+limite de updates em andamento, descarte de update_id repetido, toques
+repetidos colapsados enquanto o anterior não termina e métricas de espera na fila
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def chat_id_do_update(update):
+    """Extrai o chat_id que define a ordem de processamento do update"""
+    for campo in ('message', 'edited_message', 'channel_post'):
+        if campo in update:
+            return update[campo].get('chat', {}).get('id')
+    if 'callback_query' in update:
+        callback = update['callback_query']
+        mensagem = callback.get('message') or {}
+        return mensagem.get('chat', {}).get('id') or callback.get('from', {}).get('id')
+    if 'my_chat_member' in update:
+        return update['my_chat_member'].get('chat', {}).get('id')
+    return None
+
+
+TIPOS_UPDATE = (
+    'message', 'edited_message', 'channel_post', 'edited_channel_post',
+    'callback_query', 'inline_query', 'my_chat_member', 'chat_member',
+    'pre_checkout_query', 'shipping_query', 'poll', 'poll_answer', 'chat_join_request',
+)
+
+
+def update_valido(update):
+    """Validação mínima de estrutura: update_id inteiro e um tipo conhecido"""
+    return (
+        isinstance(update, dict)
+        and isinstance(update.get('update_id'), int)
+        and any(isinstance(update.get(tipo), dict) for tipo in TIPOS_UPDATE)
+    )
+
+
+class UpdateDispatcher:
+    def __init__(self, handler, max_workers=None, max_in_flight=None, chave_coalescencia=None, ao_descartar=None):
+        """Inicializa o pool de processamento de updates
+
+        chave_coalescencia(update) retorna a chave de ações idênticas (ou None); um update
+        com a mesma chave de outro ainda na fila ou em execução no mesmo chat é descartado
+        e ao_descartar(update) é chamado para respondê-lo.
+        """
+        self.handler = handler
+        self.chave_coalescencia = chave_coalescencia
+        self.ao_descartar = ao_descartar
+        self.max_workers = max_workers or int(os.getenv('TELEGRAM_WORKERS', '16'))
+        self.max_in_flight = max_in_flight or int(os.getenv('TELEGRAM_MAX_IN_FLIGHT', '200'))
+
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='tg-update')
+        self._vagas = threading.BoundedSemaphore(self.max_in_flight)
+        self._lock = threading.Lock()
+        # chat_id -> deque[(update, enfileirado_em, coalescencia)]; presença da chave = chat com worker ativo
+        self._filas = {}
+        # chat_id -> chaves de coalescência na fila ou em execução
+        self._coalescendo = {}
+
+        # update_ids já aceitos (Telegram reenvia quando não recebe 200 a tempo)
+        self.max_ids_recentes = int(os.getenv('TELEGRAM_DEDUP_MAX', '10000'))
+        self._ids_recentes = OrderedDict()
+
+        # Métricas
+        self._esperas = deque(maxlen=1000)
+        self._duracoes = deque(maxlen=1000)
+        self._processados = 0
+        self._erros = 0
+        self._duplicados = 0
+        self._coalescidos = 0
+        self._em_andamento = 0
+
+    def ja_recebido(self, update_id):
+        """Indica se o update_id já foi aceito recentemente"""
+        with self._lock:
+            return update_id in self._ids_recentes
+
+    def _registrar_id(self, update_id):
+        """Registra update_id; retorna False se for repetido (chamar com o lock)"""
+        if update_id is None:
+            return True
+        if update_id in self._ids_recentes:
+            self._duplicados += 1
+            return False
+        self._ids_recentes[update_id] = True
+        if len(self._ids_recentes) > self.max_ids_recentes:
+            self._ids_recentes.popitem(last=False)
+        return True
+
+    def submit(self, update, timeout=None):
+        """Enfileira update; bloqueia quando o limite em andamento é atingido
+
+        Retorna True se aceito (ou repetido e descartado), False se não houve vaga.
+        """
+        update_id = update.get('update_id')
+        if self.ja_recebido(update_id):
+            with self._lock:
+                self._duplicados += 1
+            logger.debug(f"Update {update_id} repetido descartado")
+            return True
+
+        if not self._vagas.acquire(timeout=timeout):
+            logger.warning(f"Dispatcher cheio ({self.max_in_flight}): update {update_id} não enfileirado")
+            return False
+
+        chave = chat_id_do_update(update)
+        if chave is None:
+            chave = f"update_{update.get('update_id')}"
+        coalescencia = self._chave_coalescencia(update)
+
+        with self._lock:
+            if not self._registrar_id(update_id):
+                # Outra requisição aceitou o mesmo update enquanto aguardávamos vaga
+                self._vagas.release()
+                return True
+            descartar = coalescencia is not None and coalescencia in self._coalescendo.get(chave, ())
+            if descartar:
+                # Mesma ação ainda pendente neste chat: a execução em curso já responde
+                self._coalescidos += 1
+                self._vagas.release()
+            else:
+                self._em_andamento += 1
+                if coalescencia is not None:
+                    self._coalescendo.setdefault(chave, set()).add(coalescencia)
+                fila = self._filas.get(chave)
+                if fila is not None:
+                    # Já existe worker drenando este chat: mantém a ordem
+                    fila.append((update, time.time(), coalescencia))
+                    return True
+                self._filas[chave] = deque([(update, time.time(), coalescencia)])
+
+        if descartar:
+            logger.debug(f"Update {update_id} colapsado com ação idêntica pendente ({coalescencia})")
+            self._notificar_descarte(update)
+            return True
+
+        self._executor.submit(self._drenar_chat, chave)
+        return True
+
+    def _chave_coalescencia(self, update):
+        if not self.chave_coalescencia:
+            return None
+        try:
+            return self.chave_coalescencia(update)
+        except Exception as e:
+            logger.warning(f"Erro ao calcular coalescência do update {update.get('update_id')}: {e}")
+            return None
+
+    def _notificar_descarte(self, update):
+        if not self.ao_descartar:
+            return
+        try:
+            self.ao_descartar(update)
+        except Exception as e:
+            logger.warning(f"Erro ao responder update colapsado {update.get('update_id')}: {e}")
+
+    def _drenar_chat(self, chave):
+        """Processa em série todos os updates pendentes de um chat"""
+        while True:
+            with self._lock:
+                fila = self._filas[chave]
+                if not fila:
+                    del self._filas[chave]
+                    return
+                update, enfileirado_em, coalescencia = fila.popleft()
+
+            inicio = time.time()
+            self._esperas.append(inicio - enfileirado_em)
+            try:
+                self.handler(update)
+            except Exception as e:
+                with self._lock:
+                    self._erros += 1
+                logger.error(f"Erro ao processar update {update.get('update_id')}: {e}")
+            finally:
+                self._duracoes.append(time.time() - inicio)
+                with self._lock:
+                    self._processados += 1
+                    self._em_andamento -= 1
+                    if coalescencia is not None:
+                        pendentes = self._coalescendo.get(chave)
+                        if pendentes is not None:
+                            pendentes.discard(coalescencia)
+                            if not pendentes:
+                                del self._coalescendo[chave]
+                self._vagas.release()
+
+    @staticmethod
+    def _percentil(valores, p):
+        if not valores:
+            return 0.0
+        ordenados = sorted(valores)
+        return ordenados[min(len(ordenados) - 1, int(len(ordenados) * p))]
+
+    def obter_metricas(self):
+        """Retorna métricas de fila (tempos em milissegundos)"""
+        esperas = list(self._esperas)
+        duracoes = list(self._duracoes)
+        with self._lock:
+            chats_ativos = len(self._filas)
+            em_andamento = self._em_andamento
+        return {
+            'workers': self.max_workers,
+            'max_in_flight': self.max_in_flight,
+            'em_andamento': em_andamento,
+            'chats_ativos': chats_ativos,
+            'processados': self._processados,
+            'erros': self._erros,
+            'duplicados': self._duplicados,
+            'coalescidos': self._coalescidos,
+            'espera_media_ms': round(sum(esperas) / len(esperas) * 1000, 1) if esperas else 0.0,
+            'espera_p95_ms': round(self._percentil(esperas, 0.95) * 1000, 1),
+            'espera_max_ms': round(max(esperas) * 1000, 1) if esperas else 0.0,
+            'processamento_p95_ms': round(self._percentil(duracoes, 0.95) * 1000, 1),
+        }
+
+    def aguardar_vazio(self, timeout=30):
+        """Aguarda o processamento dos updates já enfileirados"""
+        limite = time.time() + timeout
+        while time.time() < limite:
+            with self._lock:
+                if self._em_andamento == 0:
+                    return True
+            time.sleep(0.05)
+        return False
+
+    def shutdown(self, timeout=30):
+        """Drena a fila e encerra o pool"""
+        self.aguardar_vazio(timeout)
+        self._executor.shutdown(wait=False)
@@ -4,6 +4,7 @@ Sistema de Gerenciamento de Usuários
 Controla cadastro, período de teste, pagamentos e acesso ao sistema
 """
 import os
+import time
 import logging
 from datetime import datetime, timedelta
 import pytz
@@ -20,6 +21,10 @@ class UserManager:
         self.valor_mensal = 20.00
         self.dias_teste_gratuito = 7
         
+        # Cache de decisões de acesso: chat_id -> (resultado, limite_acesso, expira_em)
+        self._acesso_cache = {}
+        self._acesso_cache_ttl = int(os.getenv('ACESSO_CACHE_TTL', '300'))
+        
     def cadastrar_usuario(self, chat_id, nome, email, telefone):
         """Cadastra novo usuário com período de teste gratuito"""
         try:
@@ -43,6 +48,7 @@ class UserManager:
                 agora, fim_teste, 'teste_gratuito', True
             ])
             
+            self.invalidar_acesso(chat_id)
             logger.info(f"Usuário cadastrado: {nome} (chat_id: {chat_id})")
             
             return {
@@ -79,8 +85,61 @@ class UserManager:
             logger.error(f"Erro ao obter usuário: {e}")
             return None
     
-    def verificar_acesso(self, chat_id):
-        """Verifica se usuário tem acesso ao sistema"""
+    def verificar_acesso(self, chat_id, usar_cache=True):
+        """Verifica se usuário tem acesso ao sistema (decisão em cache por chat_id)"""
+        if usar_cache:
+            resultado = self._obter_acesso_cache(chat_id)
+            if resultado is not None:
+                return resultado
+        
+        resultado = self._verificar_acesso_banco(chat_id)
+        self._guardar_acesso_cache(chat_id, resultado)
+        return resultado
+    
+    def _obter_acesso_cache(self, chat_id):
+        """Retorna decisão em cache ainda válida, sem consultar o banco"""
+        entrada = self._acesso_cache.get(chat_id)
+        if not entrada:
+            return None
+        
+        resultado, limite_acesso, expira_em = entrada
+        if time.time() >= expira_em:
+            self._acesso_cache.pop(chat_id, None)
+            return None
+        
+        resultado = dict(resultado)
+        if limite_acesso is not None:
+            resultado['dias_restantes'] = (limite_acesso - datetime.now(self.timezone_br)).days
+        return resultado
+    
+    def _guardar_acesso_cache(self, chat_id, resultado):
+        """Guarda decisão até o menor entre TTL e o fim do teste/plano do usuário"""
+        if resultado.get('motivo') == 'erro_interno':
+            return
+        
+        expira_em = time.time() + self._acesso_cache_ttl
+        limite_acesso = None
+        
+        if resultado.get('acesso'):
+            usuario = resultado.get('usuario') or {}
+            campo = 'fim_periodo_teste' if resultado.get('tipo') == 'teste' else 'proximo_vencimento'
+            limite_acesso = usuario.get(campo)
+            if limite_acesso is not None:
+                if limite_acesso.tzinfo is None:
+                    limite_acesso = self.timezone_br.localize(limite_acesso)
+                expira_em = min(expira_em, limite_acesso.timestamp())
+        
+        self._acesso_cache[chat_id] = (resultado, limite_acesso, expira_em)
+    
+    def invalidar_acesso(self, chat_id=None):
+        """Invalida decisão de acesso em cache (pagamento, mudança de plano, ação do admin)"""
+        if chat_id is None:
+            self._acesso_cache.clear()
+        else:
+            self._acesso_cache.pop(chat_id, None)
+    
+    def _verificar_acesso_banco(self, chat_id):
+        """Calcula decisão de acesso a partir do cadastro do usuário"""
         try:
             usuario = self.obter_usuario(chat_id)
             if not usuario:
@@ -139,6 +198,7 @@ class UserManager:
         try:
             query = "UPDATE usuarios SET status = %s, plano_ativo = %s WHERE chat_id = %s"
             self.db.execute_query(query, [status, plano_ativo, chat_id])
+            self.invalidar_acesso(chat_id)
             logger.info(f"Status do usuário {chat_id} atualizado para: {status}")
         except Exception as e:
             logger.error(f"Erro ao atualizar status do usuário: {e}")
@@ -164,6 +224,7 @@ class UserManager:
             valores.append(chat_id)
             
             self.db.execute_query(query, valores)
+            self.invalidar_acesso(chat_id)
             
             logger.info(f"Dados do usuário {chat_id} atualizados: {list(kwargs.keys())}")
             
@@ -196,6 +257,7 @@ class UserManager:
             self.db.execute_query(query, [
                 'pago', True, agora, proximo_vencimento, valor_pago, chat_id
             ])
+            self.invalidar_acesso(chat_id)
             
             # Registrar pagamento
             self.registrar_pagamento(chat_id, valor_pago, referencia_pagamento)
@@ -0,0 +1,239 @@
+"""
+Cache persistente de validade de números WhatsApp
+Evita enviar para números sem WhatsApp: verificação em lote no cadastro,
+renovação em segundo plano e consulta barata pelo agendador/fila
+"""
+
+import os
+import time
+import logging
+import threading
+import psycopg2.extras
+
+logger = logging.getLogger(__name__)
+
+
+class WhatsAppNumberCache:
+    def __init__(self, db_manager, baileys_api):
+        """Inicializa o cache de números (PostgreSQL + memória)"""
+        self.db = db_manager
+        self.baileys_api = baileys_api
+
+        # TTLs em horas: números válidos mudam pouco, inválidos são reverificados antes
+        self.ttl_valido = int(os.getenv('WHATSAPP_NUMERO_TTL_VALIDO_HORAS', '72'))
+        self.ttl_invalido = int(os.getenv('WHATSAPP_NUMERO_TTL_INVALIDO_HORAS', '24'))
+        self.tamanho_lote = int(os.getenv('WHATSAPP_NUMERO_LOTE', '50'))
+
+        # telefone -> (valido, expira_em epoch)
+        self._memoria = {}
+        self._lock = threading.Lock()
+
+    def normalizar(self, telefone):
+        """Normaliza telefone no mesmo formato usado pela API Baileys"""
+        return self.baileys_api._clean_phone_number(str(telefone or ''))
+
+    # ===================== Consulta =====================
+    def _ler_memoria(self, telefone):
+        """Retorna validade em memória ou None se ausente/expirada"""
+        entrada = self._memoria.get(telefone)
+        if not entrada:
+            return None
+        valido, expira_em = entrada
+        if expira_em <= time.time():
+            with self._lock:
+                self._memoria.pop(telefone, None)
+            return None
+        return valido
+
+    def _carregar_do_banco(self, telefones):
+        """Carrega para a memória as entradas não expiradas de vários números em uma consulta"""
+        if not telefones:
+            return
+        try:
+            with self.db.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        SELECT telefone, valido,
+                               EXTRACT(EPOCH FROM (expira_em - CURRENT_TIMESTAMP)) AS restante
+                        FROM whatsapp_numeros
+                        WHERE telefone = ANY(%s) AND expira_em > CURRENT_TIMESTAMP
+                    """, (list(telefones),))
+                    linhas = cursor.fetchall()
+
+            agora = time.time()
+            with self._lock:
+                for telefone, valido, restante in linhas:
+                    self._memoria[telefone] = (valido, agora + float(restante))
+        except Exception as e:
+            logger.error(f"Erro ao carregar números verificados: {e}")
+
+    def status(self, telefone):
+        """Retorna True/False se a validade é conhecida, ou None se desconhecida/expirada"""
+        numero = self.normalizar(telefone)
+        if not numero:
+            return None
+        valido = self._ler_memoria(numero)
+        if valido is None:
+            self._carregar_do_banco([numero])
+            valido = self._ler_memoria(numero)
+        return valido
+
+    def numero_invalido(self, telefone):
+        """Indica se o número é sabidamente sem WhatsApp (desconhecido não é inválido)"""
+        return self.status(telefone) is False
+
+    def filtrar_invalidos(self, telefones):
+        """Retorna o conjunto de números (normalizados) sabidamente sem WhatsApp"""
+        numeros = {self.normalizar(t) for t in telefones}
+        numeros.discard('')
+
+        faltantes = [n for n in numeros if self._ler_memoria(n) is None]
+        self._carregar_do_banco(faltantes)
+
+        return {n for n in numeros if self._ler_memoria(n) is False}
+
+    # ===================== Verificação =====================
+    def _salvar(self, resultados, chat_id_usuario):
+        """Persiste resultados de verificação e atualiza a memória"""
+        if not resultados:
+            return
+        linhas = []
+        agora = time.time()
+        for telefone, valido in resultados.items():
+            horas = self.ttl_valido if valido else self.ttl_invalido
+            linhas.append((telefone, valido, chat_id_usuario, f'{horas} hours'))
+            with self._lock:
+                self._memoria[telefone] = (valido, agora + horas * 3600)
+
+        try:
+            with self.db.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    psycopg2.extras.execute_values(cursor, """
+                        INSERT INTO whatsapp_numeros (telefone, valido, chat_id_usuario, expira_em)
+                        SELECT v.telefone, v.valido, v.chat_id_usuario,
+                               CURRENT_TIMESTAMP + v.ttl::interval
+                        FROM (VALUES %s) AS v(telefone, valido, chat_id_usuario, ttl)
+                        ON CONFLICT (telefone) DO UPDATE SET
+                            valido = EXCLUDED.valido,
+                            chat_id_usuario = EXCLUDED.chat_id_usuario,
+                            verificado_em = CURRENT_TIMESTAMP,
+                            expira_em = EXCLUDED.expira_em
+                    """, linhas)
+                    conn.commit()
+        except Exception as e:
+            logger.error(f"Erro ao salvar números verificados: {e}")
+
+    def verificar_em_lote(self, telefones, chat_id_usuario, forcar=False):
+        """Verifica números na sessão do usuário, consultando a API apenas para os desconhecidos"""
+        resultados = {}
+        numeros = []
+        for telefone in telefones:
+            numero = self.normalizar(telefone)
+            if numero and numero not in numeros:
+                numeros.append(numero)
+
+        if not forcar:
+            self._carregar_do_banco([n for n in numeros if self._ler_memoria(n) is None])
+            for numero in numeros:
+                valido = self._ler_memoria(numero)
+                if valido is not None:
+                    resultados[numero] = valido
+            numeros = [n for n in numeros if n not in resultados]
+
+        for inicio in range(0, len(numeros), self.tamanho_lote):
+            lote = numeros[inicio:inicio + self.tamanho_lote]
+            resposta = self.baileys_api.check_numbers(lote, chat_id_usuario)
+            if not resposta.get('success'):
+                # Sessão desconectada ou API fora: mantém desconhecido, tenta na próxima renovação
+                logger.warning(f"Verificação de números falhou para usuário {chat_id_usuario}: {resposta.get('error')}")
+                break
+
+            verificados = {n: v for n, v in resposta.get('results', {}).items() if v is not None}
+            self._salvar(verificados, chat_id_usuario)
+            resultados.update(verificados)
+
+        invalidos = sum(1 for v in resultados.values() if v is False)
+        if invalidos:
+            logger.info(f"📵 {invalidos} número(s) sem WhatsApp identificados (usuário {chat_id_usuario})")
+        return resultados
+
+    def verificar_em_segundo_plano(self, telefones, chat_id_usuario):
+        """Dispara verificação em lote sem bloquear o chamador (cadastro/importação)"""
+        threading.Thread(
+            target=self.verificar_em_lote,
+            args=(list(telefones), chat_id_usuario),
+            daemon=True
+        ).start()
+
+    def renovar_expirados(self, limite=500):
+        """Reverifica entradas expiradas e números de clientes ativos ainda não verificados"""
+        try:
+            with self.db.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        SELECT chat_id_usuario, telefone
+                        FROM whatsapp_numeros
+                        WHERE expira_em <= CURRENT_TIMESTAMP AND chat_id_usuario IS NOT NULL
+                        ORDER BY expira_em
+                        LIMIT %s
+                    """, (limite,))
+                    pendentes = cursor.fetchall()
+                    # Anti-join com o cache: só clientes ativos cujo número normalizado
+                    # (mesma regra de _clean_phone_number) ainda não foi verificado
+                    cursor.execute("""
+                        WITH normalizados AS (
+                            SELECT c.id, c.chat_id_usuario, c.telefone,
+                                   regexp_replace(c.telefone, '\\D', '', 'g') AS digitos
+                            FROM clientes c
+                            WHERE c.ativo = TRUE AND c.chat_id_usuario IS NOT NULL
+                        ),
+                        candidatos AS (
+                            SELECT id, chat_id_usuario, telefone,
+                                   CASE
+                                       WHEN digitos LIKE '55%%' AND length(digitos) >= 12 THEN digitos
+                                       WHEN digitos NOT LIKE '55%%' AND length(digitos) >= 10 THEN '55' || digitos
+                                       WHEN length(digitos) >= 10 THEN digitos
+                                   END AS numero
+                            FROM normalizados
+                        )
+                        SELECT c.chat_id_usuario, c.telefone
+                        FROM candidatos c
+                        WHERE c.numero IS NOT NULL
+                          AND NOT EXISTS (
+                              SELECT 1 FROM whatsapp_numeros w WHERE w.telefone = c.numero
+                          )
+                        ORDER BY c.id
+                        LIMIT %s
+                    """, (limite,))
+                    clientes = cursor.fetchall()
+
+            por_usuario = {}
+            for chat_id_usuario, telefone in pendentes:
+                por_usuario.setdefault(chat_id_usuario, []).append(telefone)
+
+            # Clientes nunca verificados entram na mesma rodada
+            for chat_id_usuario, telefone in clientes:
+                por_usuario.setdefault(chat_id_usuario, []).append(telefone)
+
+            total = 0
+            for chat_id_usuario, telefones in por_usuario.items():
+                total += len(self.verificar_em_lote(telefones, chat_id_usuario))
+
+            logger.info(f"🔄 Cache de números WhatsApp renovado: {total} número(s) com validade conhecida")
+        except Exception as e:
+            logger.error(f"Erro ao renovar cache de números WhatsApp: {e}")
+
+    def invalidar(self, telefone):
+        """Remove número do cache (ex.: telefone do cliente editado)"""
+        numero = self.normalizar(telefone)
+        if not numero:
+            return
+        with self._lock:
+            self._memoria.pop(numero, None)
+        try:
+            with self.db.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("DELETE FROM whatsapp_numeros WHERE telefone = %s", (numero,))
+                    conn.commit()
+        except Exception as e:
+            logger.error(f"Erro ao invalidar número {numero}: {e}")
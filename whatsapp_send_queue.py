@@ -0,0 +1,179 @@
+"""
+Envios imediatos de WhatsApp fora das threads do Telegram
+Cada envio manual vira uma mensagem de prioridade máxima em fila_mensagens e é
+entregue por um pool dedicado; o resultado chega por callback para o bot editar
+a mensagem "enviando…"
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Falhas de renderização que não mudam com nova tentativa: a mensagem sai da fila
+ERROS_RENDER_DEFINITIVOS = ('Template inativo', 'Cliente não encontrado')
+
+
+class WhatsAppSendQueue:
+    def __init__(self, db_manager, baileys_api, numeros_whatsapp=None, workers=None, template_manager=None):
+        """Inicializa o pool de envios prioritários"""
+        self.db = db_manager
+        self.baileys_api = baileys_api
+        self.numeros_whatsapp = numeros_whatsapp
+        # Renderiza mensagens agendadas que só guardam template/cliente
+        self.template_manager = template_manager
+        self.workers = workers or int(os.getenv('WHATSAPP_ENVIO_WORKERS', '4'))
+        # Tempo em que a mensagem fica reservada ao worker antes do dispatcher assumi-la
+        self.reserva_minutos = int(os.getenv('WHATSAPP_ENVIO_RESERVA_MIN', '10'))
+
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='wa-envio')
+        self._lock = threading.Lock()
+
+        # Métricas
+        self._em_andamento = 0
+        self._enviados = 0
+        self._falhas = 0
+        self._duracoes = deque(maxlen=500)
+
+    def enviar(self, chat_id_usuario, cliente_id, template_id, telefone, mensagem, tipo_envio, ao_concluir=None):
+        """Enfileira envio manual com prioridade máxima; retorna o id na fila
+
+        Falha é definitiva (o usuário vê o erro e decide reenviar).
+        """
+        fila_id = self.db.adicionar_envio_prioritario(
+            cliente_id, template_id, telefone, mensagem, tipo_envio,
+            chat_id_usuario, reserva_minutos=self.reserva_minutos)
+        job = {
+            'id': fila_id, 'chat_id_usuario': chat_id_usuario, 'cliente_id': cliente_id,
+            'template_id': template_id, 'telefone': telefone, 'mensagem': mensagem,
+            'tipo_mensagem': tipo_envio,
+        }
+        self._submeter(job, ao_concluir, definitivo=True)
+        return fila_id
+
+    def enviar_da_fila(self, chat_id_usuario=None, fila_ids=None, cliente_id=None, ao_concluir=None):
+        """Antecipa mensagens já agendadas ("enviar agora"); retorna quantas foram reservadas
+
+        Falha conta tentativa e a mensagem volta ao dispatcher após a reserva.
+        """
+        jobs = self.db.priorizar_mensagens_fila(
+            fila_ids=fila_ids, cliente_id=cliente_id, chat_id_usuario=chat_id_usuario,
+            reserva_minutos=self.reserva_minutos)
+        # Pré-carrega validade dos números do lote em uma única consulta
+        if self.numeros_whatsapp and jobs:
+            self.numeros_whatsapp.filtrar_invalidos(job['telefone'] for job in jobs)
+        for job in jobs:
+            self._submeter(job, ao_concluir, definitivo=False)
+        return len(jobs)
+
+    def _submeter(self, job, ao_concluir, definitivo):
+        with self._lock:
+            self._em_andamento += 1
+        self._executor.submit(self._executar, job, ao_concluir, definitivo, time.time())
+
+    def _executar(self, job, ao_concluir, definitivo, enfileirado_em):
+        resultado = self._entregar(job, definitivo)
+        with self._lock:
+            self._em_andamento -= 1
+            if resultado['success']:
+                self._enviados += 1
+            else:
+                self._falhas += 1
+        self._duracoes.append(time.time() - enfileirado_em)
+
+        if ao_concluir:
+            try:
+                ao_concluir(resultado)
+            except Exception as e:
+                logger.error(f"Erro no retorno do envio {job['id']}: {e}")
+
+    def _entregar(self, job, definitivo):
+        """Envia via Baileys, registra log e atualiza a fila"""
+        if job.get('mensagem') is None:
+            erro = self._renderizar(job)
+            if erro:
+                logger.warning(f"Envio prioritário {job['id']} não renderizado: {erro}")
+                try:
+                    # Erro transitório (banco, template manager) volta ao dispatcher como no envio abaixo
+                    concluido = definitivo or erro in ERROS_RENDER_DEFINITIVOS
+                    self.db.marcar_mensagem_processada(job['id'], concluido, erro=erro)
+                except Exception as e:
+                    logger.warning(f"Erro ao atualizar fila para envio {job['id']}: {e}")
+                return {'success': False, 'error': erro, 'message_id': None, 'fila_id': job['id'],
+                        'cliente_id': job['cliente_id'], 'telefone': job['telefone'], 'mensagem': None}
+
+        resultado = {'success': False, 'error': None, 'message_id': None,
+                     'fila_id': job['id'], 'cliente_id': job['cliente_id'],
+                     'telefone': job['telefone'], 'mensagem': job['mensagem']}
+        sem_whatsapp = False
+        try:
+            if self.numeros_whatsapp and self.numeros_whatsapp.numero_invalido(job['telefone']):
+                # Nova tentativa não muda o resultado: a mensagem sai da fila
+                sem_whatsapp = True
+                resultado['error'] = 'Número sem WhatsApp'
+            else:
+                envio = self.baileys_api.send_message(job['telefone'], job['mensagem'], job['chat_id_usuario']) or {}
+                resultado['success'] = bool(envio.get('success'))
+                resultado['error'] = None if resultado['success'] else envio.get('error', 'Erro desconhecido')
+                resultado['message_id'] = envio.get('messageId') or envio.get('message_id')
+        except Exception as e:
+            logger.error(f"Erro ao enviar mensagem {job['id']} via WhatsApp: {e}")
+            resultado['error'] = str(e)
+
+        try:
+            self.db.registrar_envio(
+                cliente_id=job['cliente_id'],
+                template_id=job['template_id'],
+                telefone=job['telefone'],
+                mensagem=job['mensagem'],
+                tipo_envio=job['tipo_mensagem'],
+                sucesso=resultado['success'],
+                erro=resultado['error'],
+                message_id=resultado['message_id'],
+                chat_id_usuario=job['chat_id_usuario']
+            )
+        except Exception as e:
+            logger.warning(f"Erro ao registrar log do envio {job['id']}: {e}")
+
+        try:
+            concluido = resultado['success'] or definitivo or sem_whatsapp
+            self.db.marcar_mensagem_processada(job['id'], concluido, erro=resultado['error'])
+        except Exception as e:
+            logger.warning(f"Erro ao atualizar fila para envio {job['id']}: {e}")
+
+        if resultado['success']:
+            logger.info(f"📤 Envio prioritário {job['id']} entregue para {job['telefone']}")
+        else:
+            logger.warning(f"Envio prioritário {job['id']} falhou: {resultado['error']}")
+        return resultado
+
+    def _renderizar(self, job):
+        """Renderiza no envio a mensagem agendada sem texto; retorna o erro ou None"""
+        if not self.template_manager:
+            return 'Renderização indisponível'
+        try:
+            cliente = self.db.buscar_cliente_por_id(job['cliente_id'], chat_id_usuario=job['chat_id_usuario'])
+            if not cliente:
+                return 'Cliente não encontrado'
+            job['mensagem'] = self.template_manager.renderizar_mensagem_fila(job, cliente)
+            return None if job['mensagem'] is not None else 'Template inativo'
+        except Exception as e:
+            logger.error(f"Erro ao renderizar mensagem {job['id']}: {e}")
+            return str(e)
+
+    def obter_metricas(self):
+        """Contadores e tempo de entrega (milissegundos)"""
+        duracoes = sorted(self._duracoes)
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'em_andamento': self._em_andamento,
+                'enviados': self._enviados,
+                'falhas': self._falhas,
+                'entrega_p95_ms': round(duracoes[min(len(duracoes) - 1, int(len(duracoes) * 0.95))] * 1000, 1)
+                                  if duracoes else 0.0,
+            }
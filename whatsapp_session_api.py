@@ -8,7 +8,6 @@ import json
 import logging
 import psycopg2.extras
 from flask import Blueprint, request, jsonify
-from database import DatabaseManager
 import os
 
 # Configurar logging
@@ -198,24 +197,26 @@ def restore_session():
 def list_sessions():
     """Lista todas as sessões salvas no banco"""
     try:
-        with DatabaseManager() as db:
-            with db.get_connection() as conn:
-                with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-                    cursor.execute("""
-                        SELECT DISTINCT session_id, numero_whatsapp, updated_at, chat_id_usuario
-                        FROM whatsapp_sessions 
-                        ORDER BY updated_at DESC
-                    """)
-                    
-                    sessions = cursor.fetchall()
-                    sessions_list = [dict(session) for session in sessions]
-                    
-                    return jsonify({
-                        'success': True,
-                        'sessions': sessions_list,
-                        'total': len(sessions_list)
-                    })
+        if not session_manager:
+            return jsonify({'success': False, 'error': 'Session manager não inicializado'}), 500
         
+        with session_manager.db.get_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                cursor.execute("""
+                    SELECT DISTINCT session_id, numero_whatsapp, updated_at, chat_id_usuario
+                    FROM whatsapp_sessions 
+                    ORDER BY updated_at DESC
+                """)
+                
+                sessions = cursor.fetchall()
+                sessions_list = [dict(session) for session in sessions]
+                
+                return jsonify({
+                    'success': True,
+                    'sessions': sessions_list,
+                    'total': len(sessions_list)
+                })
+    
     except Exception as e:
         logger.error(f"Erro ao listar sessões: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500